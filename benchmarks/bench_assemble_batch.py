@@ -0,0 +1,170 @@
+"""bench_assemble_batch.py
+
+Compare writing batches of patch outputs into the wsi prediction holder, a
+memory-mapped file or an array in RAM, with `_assemble_batch` (one copy of
+contiguous rows per patch) and with a single fancy indexing scatter of the
+whole batch. Then compare the inference loop of a chunk with the batches
+written within the loop and with the batches written by the background
+writer of `InferManager`, the model being stood in by a torch matmul of
+about `--model_ms` per batch.
+
+Usage:
+    python -m benchmarks.bench_assemble_batch [--chunk_shape=<n>]
+        [--batch_size=<n>] [--pred_map_dtype=<dtype>] [--model_ms=<n>]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from infer.wsi import _assemble_batch
+
+PATCH_INPUT_SHAPE = 256
+PATCH_OUTPUT_SHAPE = 164
+NR_CHANNELS = 4
+
+
+####
+def _scatter_batch(wsi_pred_map, chunk_output_tl, patch_tl_list, patch_output_list):
+    """Write a batch via a single fancy indexing scatter of all its pixels."""
+    nr_patches, height, width = patch_output_list.shape[:3]
+    patch_tl_list = patch_tl_list + chunk_output_tl
+    coord_y = patch_tl_list[:, 0, None, None] + np.arange(height)[None, :, None]
+    coord_x = patch_tl_list[:, 1, None, None] + np.arange(width)[None, None, :]
+    coord_y = np.broadcast_to(coord_y, (nr_patches, height, width))
+    coord_x = np.broadcast_to(coord_x, (nr_patches, height, width))
+    wsi_pred_map[coord_y, coord_x] = patch_output_list
+    return
+
+
+####
+def _get_batch_list(chunk_shape, batch_size, dtype):
+    """Top left of the patches of a chunk and their random outputs, per batch."""
+    nr_steps = (chunk_shape - PATCH_INPUT_SHAPE) // PATCH_OUTPUT_SHAPE + 1
+    coord = np.arange(nr_steps) * PATCH_OUTPUT_SHAPE
+    patch_tl_list = np.stack(np.meshgrid(coord, coord, indexing="ij"), -1)
+    patch_tl_list = patch_tl_list.reshape(-1, 2)
+    rng = np.random.RandomState(5)
+    batch_list = []
+    for start in range(0, patch_tl_list.shape[0], batch_size):
+        batch_tl_list = patch_tl_list[start : start + batch_size]
+        output_shape = (batch_tl_list.shape[0], PATCH_OUTPUT_SHAPE, PATCH_OUTPUT_SHAPE)
+        output = rng.randint(0, 255, output_shape + (NR_CHANNELS,)).astype(dtype)
+        batch_list.append((batch_tl_list, output))
+    return batch_list
+
+
+####
+def _run_write(assemble_func, wsi_pred_map, batch_list):
+    start = time.perf_counter()
+    for patch_tl_list, patch_output_list in batch_list:
+        assemble_func(wsi_pred_map, (0, 0), patch_tl_list, patch_output_list)
+    if isinstance(wsi_pred_map, np.memmap):
+        wsi_pred_map.flush()
+    return time.perf_counter() - start
+
+
+####
+def _run_chunk(wsi_pred_map, batch_list, model_step, writer=None):
+    """Infer then write the batches of a chunk, in a background `writer` if given."""
+    pending_list = []
+    start = time.perf_counter()
+    for patch_tl_list, patch_output_list in batch_list:
+        model_step()
+        if writer is None:
+            _assemble_batch(wsi_pred_map, (0, 0), patch_tl_list, patch_output_list)
+            continue
+        if len(pending_list) >= 2:
+            pending_list.pop(0).result()
+        pending_list.append(
+            writer.submit(
+                _assemble_batch, wsi_pred_map, (0, 0), patch_tl_list, patch_output_list
+            )
+        )
+    for future in pending_list:
+        future.result()
+    return time.perf_counter() - start
+
+
+####
+def run_assemble_benchmark(chunk_shape, batch_size, pred_map_dtype, model_ms):
+    work_dir = tempfile.mkdtemp()
+    batch_list = _get_batch_list(chunk_shape, batch_size, pred_map_dtype)
+    holder_shape = (chunk_shape, chunk_shape, NR_CHANNELS)
+    nr_patches = sum(v[0].shape[0] for v in batch_list)
+    print("%d batches of %d patches" % (len(batch_list), batch_size))
+    try:
+        holder_dict = {
+            "mmap": np.lib.format.open_memmap(
+                "%s/pred_map.npy" % work_dir, "w+", pred_map_dtype, holder_shape
+            ),
+            "ram": np.zeros(holder_shape, dtype=pred_map_dtype),
+        }
+        print("%8s %10s %14s" % ("holder", "method", "ms/batch"))
+        for holder_name, wsi_pred_map in holder_dict.items():
+            ref_map = None
+            for method_name, assemble_func in [
+                ("loop", _assemble_batch),
+                ("scatter", _scatter_batch),
+            ]:
+                wsi_pred_map[:] = 0
+                _run_write(assemble_func, wsi_pred_map, batch_list)  # warm up
+                write_time = _run_write(assemble_func, wsi_pred_map, batch_list)
+                if ref_map is None:
+                    ref_map = np.array(wsi_pred_map)
+                assert np.array_equal(ref_map, wsi_pred_map)
+                print(
+                    "%8s %10s %14.2f"
+                    % (holder_name, method_name, write_time / len(batch_list) * 1e3)
+                )
+
+        # * a matmul stands in for the model, torch releasing the GIL meanwhile
+        mat = torch.rand(512, 512)
+        torch.mm(mat, mat)  # warm up
+        start = time.perf_counter()
+        for _ in range(10):
+            torch.mm(mat, mat)
+        mm_time = (time.perf_counter() - start) / 10
+        nr_mm = max(int(round(model_ms / 1e3 / mm_time)), 1)
+        model_step = lambda: [torch.mm(mat, mat) for _ in range(nr_mm)]
+        start = time.perf_counter()
+        for _ in batch_list:
+            model_step()
+        model_time = time.perf_counter() - start
+        print("model %.1f ms/batch" % (model_time / len(batch_list) * 1e3))
+        print("%8s %10s %14s %10s" % ("holder", "write", "chunk(s)", "patches/s"))
+        writer = ThreadPoolExecutor(1)
+        for holder_name, wsi_pred_map in holder_dict.items():
+            for write_name, chunk_writer in [("inline", None), ("thread", writer)]:
+                chunk_time = _run_chunk(wsi_pred_map, batch_list, model_step, chunk_writer)
+                print(
+                    "%8s %10s %14.2f %10.1f"
+                    % (holder_name, write_name, chunk_time, nr_patches / chunk_time)
+                )
+        writer.shutdown()
+    finally:
+        shutil.rmtree(work_dir)
+    return
+
+
+####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk_shape", type=int, default=4096)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument(
+        "--pred_map_dtype", choices=["float32", "float16", "uint8"], default="float16"
+    )
+    parser.add_argument("--model_ms", type=float, default=50)
+    args = parser.parse_args()
+
+    run_assemble_benchmark(
+        args.chunk_shape, args.batch_size, args.pred_map_dtype, args.model_ms
+    )
@@ -0,0 +1,93 @@
+"""bench_chunk_transport.py
+
+Compare passing an inference chunk to the patch reader via a `.npy` file
+within the cache against a shared memory slot.
+
+Usage:
+    python -m benchmarks.bench_chunk_transport --cache_path=<path>
+
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from dataloader.infer_loader import SerializeArray
+from misc.shared_array import SharedArrayPool, shared_memory_available
+
+
+####
+def _read_all_patches(array_handle, chunk_shape, patch_size=256, step_size=164):
+    """Read every patch of the chunk as the inference workers would."""
+    coord_y = np.arange(0, chunk_shape[0] - patch_size + 1, step_size)
+    coord_x = np.arange(0, chunk_shape[1] - patch_size + 1, step_size)
+    coord_y, coord_x = np.meshgrid(coord_y, coord_x)
+    patch_info_list = np.stack([coord_y.flatten(), coord_x.flatten()], axis=-1)
+    dataset = SerializeArray(array_handle, patch_info_list, [patch_size, patch_size])
+    checksum = 0
+    for idx in range(len(dataset)):
+        patch_data, _ = dataset[idx]
+        checksum += int(patch_data[0, 0, 0])
+    return checksum
+
+
+####
+def run_transport_benchmark(cache_path, chunk_size_list, nr_repeats=3):
+    print("%8s %10s %10s %10s" % ("chunk", "mode", "write(s)", "read(s)"))
+    for chunk_size in chunk_size_list:
+        chunk_shape = (chunk_size, chunk_size, 3)
+        chunk_data = np.random.randint(0, 255, size=chunk_shape, dtype=np.uint8)
+
+        mode_list = ["file"]
+        if shared_memory_available(chunk_data.nbytes):
+            mode_list.append("shm")
+
+        for mode in mode_list:
+            chunk_pool = None
+            if mode == "shm":
+                chunk_pool = SharedArrayPool(1, chunk_shape, np.uint8)
+
+            write_time, read_time = [], []
+            for _ in range(nr_repeats):
+                start = time.perf_counter()
+                if mode == "shm":
+                    array_handle = chunk_pool.put(0, chunk_data)
+                else:
+                    array_handle = "%s/cache_chunk_bench.npy" % cache_path
+                    np.save(array_handle, chunk_data)
+                write_time.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                _read_all_patches(array_handle, chunk_shape)
+                read_time.append(time.perf_counter() - start)
+
+            if chunk_pool is not None:
+                chunk_pool.close()
+            print(
+                "%8d %10s %10.3f %10.3f"
+                % (chunk_size, mode, np.median(write_time), np.median(read_time))
+            )
+    bench_path = "%s/cache_chunk_bench.npy" % cache_path
+    if os.path.exists(bench_path):
+        os.remove(bench_path)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cache_path", help="directory used as cache for file mode", default="cache"
+    )
+    parser.add_argument(
+        "--chunk_sizes",
+        help="comma separated list of chunk sizes",
+        default="4000,6000,8000,10000,12000",
+    )
+    parser.add_argument("--nr_repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    os.makedirs(args.cache_path, exist_ok=True)
+    chunk_size_list = [int(v) for v in args.chunk_sizes.split(",")]
+    run_transport_benchmark(args.cache_path, chunk_size_list, args.nr_repeats)
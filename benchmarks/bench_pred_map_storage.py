@@ -0,0 +1,130 @@
+"""bench_pred_map_storage.py
+
+Check the footprint and the instance parity of the reduced precision storage
+of the wsi prediction map (`--pred_map_dtype`) against float32. Each data
+type must reach the dq, pq and type accuracy of `PARITY_THRESHOLD` wrt the
+instances of float32, with as many instances up to its relative tolerance:
+
+    float32: dq, pq, type_acc >= 0.9999, #inst within 0%
+    float16: dq, pq, type_acc >= 0.995,  #inst within 0.1%
+    uint8:   dq, pq, type_acc >= 0.99,   #inst within 0.5%
+
+The memory of `get_fast_pq` grows with the square of the number of instances,
+i.e several GB for tiles of 1024 pixels.
+
+Usage:
+    python -m benchmarks.bench_pred_map_storage [--tile_size=<n>]
+
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from infer.wsi import _decode_pred_map, _encode_pred_map
+from metrics.stats_utils import get_fast_pq, pair_coordinates, remap_label
+from models.hovernet.post_proc import process
+
+# minimal dq, pq, type accuracy and relative tolerance of the instance count
+PARITY_THRESHOLD = {
+    "float32": (0.9999, 0.9999, 0.9999, 0.0),
+    "float16": (0.995, 0.995, 0.995, 0.001),
+    "uint8": (0.99, 0.99, 0.99, 0.005),
+}
+
+
+####
+def gen_synthetic_pred_map(tile_size, nr_types=5, seed=5):
+    """Generate a raw HoVer-Net like prediction with touching nuclei."""
+    rng = np.random.RandomState(seed)
+    inst_map = np.zeros((tile_size, tile_size), dtype=np.int32)
+    nr_nuclei = tile_size * tile_size // 600
+    for inst_id in range(1, nr_nuclei + 1):
+        center = tuple(int(v) for v in rng.randint(0, tile_size, size=2))
+        axes = tuple(int(v) for v in rng.randint(5, 11, size=2))
+        angle = int(rng.randint(0, 180))
+        cv2.ellipse(inst_map, center, axes, angle, 0, 360, inst_id, -1)
+
+    h_map = np.zeros(inst_map.shape, dtype=np.float32)
+    v_map = np.zeros(inst_map.shape, dtype=np.float32)
+    for inst_id in np.unique(inst_map)[1:]:
+        inst_y, inst_x = np.nonzero(inst_map == inst_id)
+        inst_dx = inst_x - inst_x.mean()
+        inst_dy = inst_y - inst_y.mean()
+        h_map[inst_y, inst_x] = inst_dx / (np.abs(inst_dx).max() + 1.0e-6)
+        v_map[inst_y, inst_x] = inst_dy / (np.abs(inst_dy).max() + 1.0e-6)
+
+    type_map = (inst_map % nr_types).astype(np.float32)
+    type_map[inst_map == 0] = 0
+    prob_map = (inst_map > 0).astype(np.float32)
+    prob_map = cv2.GaussianBlur(prob_map, (5, 5), 0)  # soft boundary
+
+    pred_map = np.stack([type_map, prob_map, h_map, v_map], axis=-1)
+    noise = rng.normal(0, 0.05, size=pred_map.shape).astype(np.float32)
+    noise[..., 0] = 0
+    return pred_map + noise
+
+
+####
+def run_storage_benchmark(tile_size, nr_types=5):
+    pred_map = gen_synthetic_pred_map(tile_size, nr_types)
+    ref_inst, ref_info = process(pred_map, nr_types=nr_types, return_centroids=True)
+    ref_inst = remap_label(ref_inst)
+    ref_info = list(ref_info.values())
+    ref_centroid = np.array([v["centroid"] for v in ref_info])
+
+    print(
+        "%8s %10s %10s %8s %8s %10s"
+        % ("dtype", "bytes/px", "#inst", "dq", "pq", "type_acc")
+    )
+    for storage_dtype in ["float32", "float16", "uint8"]:
+        start = time.perf_counter()
+        stored_map = _encode_pred_map(pred_map, storage_dtype, nr_types)
+        decoded_map = _decode_pred_map(stored_map, storage_dtype, nr_types)
+        codec_time = time.perf_counter() - start
+
+        pred_inst, pred_info = process(
+            decoded_map, nr_types=nr_types, return_centroids=True
+        )
+        [dq, sq, pq], _ = get_fast_pq(ref_inst, remap_label(pred_inst))
+
+        # type agreement of the instances paired via their centroids
+        pred_info = list(pred_info.values())
+        pred_centroid = np.array([v["centroid"] for v in pred_info])
+        paired, _, _ = pair_coordinates(ref_centroid, pred_centroid, 2)
+        pred_type = [
+            ref_info[ref_idx]["type"] == pred_info[pred_idx]["type"]
+            for ref_idx, pred_idx in paired
+        ]
+        type_acc = np.mean(pred_type)
+        print(
+            "%8s %10d %10d %8.4f %8.4f %10.4f   (codec %.3fs)"
+            % (
+                storage_dtype,
+                stored_map.itemsize * stored_map.shape[-1],
+                len(pred_info),
+                dq,
+                pq,
+                type_acc,
+                codec_time,
+            )
+        )
+        min_dq, min_pq, min_type_acc, inst_tol = PARITY_THRESHOLD[storage_dtype]
+        assert dq >= min_dq and pq >= min_pq and type_acc >= min_type_acc, (
+            "%s: dq %.4f, pq %.4f or type_acc %.4f below %s."
+            % (storage_dtype, dq, pq, type_acc, PARITY_THRESHOLD[storage_dtype][:3])
+        )
+        assert abs(len(pred_info) - len(ref_info)) <= inst_tol * len(ref_info), (
+            "%s: %d instances instead of %d."
+            % (storage_dtype, len(pred_info), len(ref_info))
+        )
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tile_size", type=int, default=1024)
+    args = parser.parse_args()
+    run_storage_benchmark(args.tile_size)
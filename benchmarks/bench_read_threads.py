@@ -0,0 +1,72 @@
+"""bench_read_threads.py
+
+Compare reading large regions of a slide with `OpenSlideHandler` across a
+number of read threads, the tile cache being disabled so that every tile is
+decoded. Each number of threads reads the same regions with a new handler,
+and their content is checked against the single threaded read.
+
+Usage:
+    python -m benchmarks.bench_read_threads --wsi_path=<path>
+        [--region_size=<n>] [--nr_threads=<n>...] [--nr_regions=<n>]
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from misc.wsi_handler import OpenSlideHandler
+
+
+####
+def run_read_benchmark(wsi_path, region_size, nr_threads_list, nr_regions):
+    handler = OpenSlideHandler(wsi_path)
+    base_shape = handler.metadata["base_shape"]
+    region_size = np.minimum(region_size, base_shape)
+    # * distinct regions, so that OpenSlide can not serve them from its cache
+    rng = np.random.RandomState(5)
+    coord_list = [
+        rng.randint(0, base_shape - region_size + 1) for _ in range(nr_regions)
+    ]
+    nr_pixels = nr_regions * np.prod(region_size)
+
+    print("%8s %10s %10s %10s" % ("threads", "time(s)", "MP/s", "speedup"))
+    ref_checksum_list, ref_time = None, None
+    for nr_threads in nr_threads_list:
+        handler = OpenSlideHandler(wsi_path, nr_read_threads=nr_threads)
+        handler.prepare_reading(read_mag=handler.metadata["base_mag"])
+        checksum_list = []
+        start = time.perf_counter()
+        for coords in coord_list:
+            region = handler.read_region(coords, region_size)
+            checksum_list.append(int(region.sum(dtype=np.int64)))
+        read_time = time.perf_counter() - start
+        handler.close()
+
+        if ref_checksum_list is None:
+            ref_checksum_list, ref_time = checksum_list, read_time
+        assert checksum_list == ref_checksum_list, (
+            "Regions read with %d threads differ." % nr_threads
+        )
+        print(
+            "%8d %10.2f %10.1f %10.2f"
+            % (nr_threads, read_time, nr_pixels / read_time / 1.0e6, ref_time / read_time)
+        )
+    return
+
+
+####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wsi_path", type=str, required=True)
+    parser.add_argument("--region_size", type=int, default=10000)
+    parser.add_argument(
+        "--nr_threads", type=int, nargs="+", default=[1, 2, 4, 8, 16]
+    )
+    parser.add_argument("--nr_regions", type=int, default=3)
+    args = parser.parse_args()
+
+    run_read_benchmark(
+        args.wsi_path, args.region_size, args.nr_threads, args.nr_regions
+    )
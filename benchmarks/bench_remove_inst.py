@@ -0,0 +1,116 @@
+"""bench_remove_inst.py
+
+Compare the single pass instance removal and merging used when stitching
+boundary tiles against the former loop of 1 pass per instance id.
+
+Usage:
+    python -m benchmarks.bench_remove_inst [--tile_size=<n>] [--nr_ids=<n>]
+
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from infer.wsi import _merge_inst, _remove_inst
+
+
+####
+def _remove_inst_loop(inst_map, remove_id_list):
+    """Former implementation of `_remove_inst`."""
+    for inst_id in remove_id_list:
+        inst_map[inst_map == inst_id] = 0
+    return inst_map
+
+
+####
+def _merge_inst_loop(inst_map, new_inst_map, remove_id_list, id_offset):
+    """Former removal, offsetting and merging of the new instances."""
+    new_inst_map = _remove_inst_loop(new_inst_map, remove_id_list)
+    new_inst_map[new_inst_map > 0] += id_offset
+    return inst_map + new_inst_map
+
+
+####
+def gen_inst_map(tile_size, nr_insts, id_offset=0, seed=5):
+    """Draw `nr_insts` disk shaped instances with ids above `id_offset`."""
+    rng = np.random.RandomState(seed)
+    inst_map = np.zeros((tile_size, tile_size), dtype=np.int32)
+    for inst_id in range(1, nr_insts + 1):
+        center = tuple(int(v) for v in rng.randint(0, tile_size, size=2))
+        radius = int(rng.randint(5, 10))
+        cv2.circle(inst_map, center, radius, id_offset + inst_id, -1)
+    return inst_map
+
+
+####
+def _timeit(func, *args, nr_repeats=3):
+    """Median run time of `func`, each run is given fresh copies of the arrays."""
+    time_list = []
+    for _ in range(nr_repeats):
+        run_args = [np.copy(v) if isinstance(v, np.ndarray) else v for v in args]
+        start = time.perf_counter()
+        output = func(*run_args)
+        time_list.append(time.perf_counter() - start)
+    return np.median(time_list), output
+
+
+####
+def run_remove_benchmark(tile_size, nr_ids_list, nr_insts=8000):
+    # old map holds wsi wide ids, new map holds per tile ids
+    old_inst_map = gen_inst_map(tile_size, nr_insts, id_offset=2000000, seed=5)
+    new_inst_map = gen_inst_map(tile_size, nr_insts, seed=7)
+    old_id_list = np.unique(old_inst_map)[1:]
+    new_id_list = np.unique(new_inst_map)[1:]
+    rng = np.random.RandomState(5)
+
+    print(
+        "%8s %10s %10s %8s %10s %10s %8s"
+        % ("#ids", "rm_loop", "rm_isin", "speedup", "mrg_loop", "mrg_lut", "speedup")
+    )
+    for nr_ids in nr_ids_list:
+        old_remove_list = rng.choice(old_id_list, nr_ids, replace=False)
+        new_remove_list = rng.choice(new_id_list, nr_ids, replace=False)
+
+        loop_time, loop_output = _timeit(
+            _remove_inst_loop, old_inst_map, old_remove_list
+        )
+        fast_time, fast_output = _timeit(_remove_inst, old_inst_map, old_remove_list)
+        assert np.array_equal(loop_output, fast_output)
+
+        # the old instances are removed where the new ones are pasted
+        base_inst_map = np.copy(old_inst_map)
+        base_inst_map[new_inst_map > 0] = 0
+        merge_args = (base_inst_map, new_inst_map, new_remove_list, 2000000)
+        merge_loop_time, loop_output = _timeit(_merge_inst_loop, *merge_args)
+        merge_fast_time, fast_output = _timeit(_merge_inst, *merge_args)
+        assert np.array_equal(loop_output, fast_output)
+
+        print(
+            "%8d %10.4f %10.4f %8.1f %10.4f %10.4f %8.1f"
+            % (
+                nr_ids,
+                loop_time,
+                fast_time,
+                loop_time / fast_time,
+                merge_loop_time,
+                merge_fast_time,
+                merge_loop_time / merge_fast_time,
+            )
+        )
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tile_size", type=int, default=2048)
+    parser.add_argument(
+        "--nr_ids",
+        help="comma separated list of the number of ids to remove",
+        default="10,100,500,1000",
+    )
+    args = parser.parse_args()
+    nr_ids_list = [int(v) for v in args.nr_ids.split(",")]
+    run_remove_benchmark(args.tile_size, nr_ids_list)
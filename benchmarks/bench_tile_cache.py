@@ -0,0 +1,113 @@
+"""bench_tile_cache.py
+
+Replay the chunk reads of the wsi inference on a slide, in the order of
+`_get_chunk_patch_info`, with `OpenSlideHandler` across tile cache budgets.
+Report for each budget the hits and misses of the cache, its hit rate and
+that of an unbounded cache holding every tile, i.e the tiles shared by
+adjacent chunks, along with the read time. The budget `auto` only caches the
+tiles within the overlap of a chunk with the next ones and sizes the cache
+to fit them, as the inference does. The content of the chunks is checked
+against the reads without cache.
+
+Usage:
+    python -m benchmarks.bench_tile_cache --wsi_path=<path> [--proc_mag=<n>]
+        [--chunk_shape=<n>] [--budget=<mb>...]
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from infer.wsi import _get_chunk_patch_info
+from misc.wsi_handler import OpenSlideHandler
+
+PATCH_INPUT_SHAPE = 256
+PATCH_OUTPUT_SHAPE = 164
+
+
+####
+def _read_chunks(handler, chunk_info_list):
+    """Read the chunks in order, return their checksums and the read time."""
+    checksum_list = []
+    start = time.perf_counter()
+    for chunk_info in chunk_info_list:
+        chunk_data = handler.read_region(
+            chunk_info[0][0][::-1], (chunk_info[0][1] - chunk_info[0][0])[::-1]
+        )
+        checksum_list.append(int(chunk_data.sum(dtype=np.int64)))
+    return checksum_list, time.perf_counter() - start
+
+
+####
+def run_cache_benchmark(wsi_path, proc_mag, chunk_shape, budget_list):
+    margin = PATCH_INPUT_SHAPE - PATCH_OUTPUT_SHAPE
+    handler = OpenSlideHandler(wsi_path)
+    proc_shape = np.array(handler.get_dimensions(read_mag=proc_mag)[::-1])
+    chunk_info_list, _ = _get_chunk_patch_info(
+        proc_shape,
+        np.array([chunk_shape, chunk_shape]),
+        np.array([PATCH_INPUT_SHAPE, PATCH_INPUT_SHAPE]),
+        np.array([PATCH_OUTPUT_SHAPE, PATCH_OUTPUT_SHAPE]),
+    )
+    handler.prepare_reading(read_mag=proc_mag)
+    ref_checksum_list, ref_time = _read_chunks(handler, chunk_info_list)
+    handler.close()
+
+    # * an unbounded cache of all tiles hits every tile shared by chunks
+    handler = OpenSlideHandler(wsi_path, tile_cache_size=2 ** 20)
+    handler.prepare_reading(read_mag=proc_mag)
+    _read_chunks(handler, chunk_info_list)
+    nr_ideal_hits = handler.tile_cache.nr_hits
+    handler.close()
+
+    print("%d chunks, %d tile reads shareable" % (len(chunk_info_list), nr_ideal_hits))
+    print(
+        "%10s %10s %10s %10s %10s %10s"
+        % ("budget(MB)", "hits", "misses", "hit rate", "of ideal", "time(s)")
+    )
+    print("%10s %10s %10s %10s %10s %10.2f" % (0, "-", "-", "-", "-", ref_time))
+    for budget in budget_list:
+        handler = OpenSlideHandler(
+            wsi_path,
+            tile_cache_size=budget,
+            tile_cache_margin=margin if budget == "auto" else None,
+        )
+        handler.prepare_reading(read_mag=proc_mag)
+        checksum_list, read_time = _read_chunks(handler, chunk_info_list)
+        tile_cache = handler.tile_cache
+        handler.close()
+        assert checksum_list == ref_checksum_list, (
+            "Chunks read with the budget %s differ." % budget
+        )
+        if budget == "auto":
+            budget = "auto=%.0f" % (tile_cache.max_nbytes / 2 ** 20)
+        nr_reads = tile_cache.nr_hits + tile_cache.nr_misses
+        print(
+            "%10s %10d %10d %10.3f %10.3f %10.2f"
+            % (
+                budget,
+                tile_cache.nr_hits,
+                tile_cache.nr_misses,
+                tile_cache.nr_hits / max(nr_reads, 1),
+                tile_cache.nr_hits / max(nr_ideal_hits, 1),
+                read_time,
+            )
+        )
+    return
+
+
+####
+if __name__ == "__main__":
+    to_size = lambda x: x if x == "auto" else float(x)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wsi_path", type=str, required=True)
+    parser.add_argument("--proc_mag", type=float, default=40)
+    parser.add_argument("--chunk_shape", type=int, default=10000)
+    parser.add_argument(
+        "--budget", type=to_size, nargs="+", default=["auto", 64, 256, 1024]
+    )
+    args = parser.parse_args()
+
+    run_cache_benchmark(args.wsi_path, args.proc_mag, args.chunk_shape, args.budget)
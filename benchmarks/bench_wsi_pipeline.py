@@ -0,0 +1,219 @@
+"""bench_wsi_pipeline.py
+
+Run the wsi pipeline end to end on synthetic slides, on CPU and without
+OpenSlide, with a stub (or randomly initialized) model. Report for each
+combination of slide size, chunk shape and number of post processing workers
+the wall time, the time spent within each stage, the peak RSS and the peak
+size of the cache on disk.
+
+Stage times are summed over all threads and processes, so that they may add
+up to more than the wall time when stages overlap. The RSS is summed over the
+run and its child processes, so that shared pages are counted several times.
+
+Usage:
+    python -m benchmarks.bench_wsi_pipeline [--slide_size=<n>...]
+        [--chunk_shape=<n>...] [--nr_post_proc_workers=<n>...]
+        [--model=<name>] [--cache_mode=<mode>] [--work_dir=<path>]
+
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+import psutil
+
+from benchmarks.stub_model import get_run_step
+from benchmarks.synthetic_wsi import SyntheticFileHandler
+from misc.metrics import get_disk_usage
+
+# * stages reported, as named by the spans of the trace
+STAGE_LIST = [
+    ("read", ["read chunk", "read tile"]),
+    ("model", ["model batch"]),
+    ("flush", ["flush batch", "flush pred map"]),
+    ("post proc", ["post proc tile"]),
+    ("merge", ["merge tile", "stitch tile", "stitch tile info"]),
+    ("save", ["save json", "save binary", "checkpoint"]),
+]
+
+
+####
+def _run_pipeline(config, work_dir):
+    """Process a synthetic slide, within its own process."""
+    from infer.wsi import InferManager
+    from models.hovernet.post_proc import process
+
+    class BenchInferManager(InferManager):
+        def _InferManager__load_model(self):
+            self.run_step = get_run_step(
+                config["model"], 164, nr_types=self.method["model_args"]["nr_types"]
+            )
+            self.post_proc_func = process
+            return
+
+    method_args = {
+        "method": {"model_args": {"nr_types": 3, "mode": "fast"}, "model_path": ""},
+        "type_info_path": None,
+    }
+    run_args = {
+        "batch_size": 16,
+        "nr_inference_workers": config["nr_inference_workers"],
+        "nr_post_proc_workers": config["nr_post_proc_workers"],
+        "patch_input_shape": 256,
+        "patch_output_shape": 164,
+        "input_dir": work_dir,
+        "output_dir": "%s/output/" % work_dir,
+        "input_mask_dir": "",
+        "cache_path": "%s/cache/" % work_dir,
+        "proc_mag": 40,
+        "ambiguous_size": 128,
+        "chunk_shape": config["chunk_shape"],
+        "tile_shape": 2048,
+        "mem_usage": 0.5,
+        "chunk_prefetch": 1,
+        "tile_cache_size": "auto",
+        "nr_read_threads": 4,
+        "chunk_transport": "shm",
+        "pred_map_dtype": "float16",
+        "sparse_cache": False,
+        "cache_mode": config["cache_mode"],
+        "save_thumb": False,
+        "save_mask": False,
+        "save_binary": False,
+        "resume": False,
+        "nr_slides_in_flight": 1,
+        "claim_slides": False,
+        "claim_timeout": 600,
+        "trace_path": "%s/trace.json" % work_dir,
+        "metrics_interval": 0,
+        "metrics_format": "json",
+    }
+    slide_size = config["slide_size"]
+    wsi_handler = SyntheticFileHandler((slide_size, slide_size), seed=config["seed"])
+
+    # the slide file only gives its name to the outputs
+    wsi_path = "%s/synthetic.svs" % work_dir
+    open(wsi_path, "w").close()
+    os.makedirs(run_args["output_dir"])
+    os.makedirs(run_args["cache_path"])
+
+    infer = BenchInferManager(**method_args)
+    infer._parse_args(run_args)
+    with mock.patch("infer.wsi.get_file_handler", return_value=wsi_handler):
+        infer.process_single_file(wsi_path, None, run_args["output_dir"])
+    return
+
+
+####
+def _get_stage_time(trace_path):
+    """Seconds spent within each span of the trace, summed over all threads."""
+    with open(trace_path, "r") as handle:
+        event_list = json.load(handle)["traceEvents"]
+    span_time = collections.defaultdict(float)
+    for event in event_list:
+        if event["ph"] == "X":
+            span_time[event["name"]] += event["dur"] / 1.0e6
+    return [sum(span_time[v] for v in name_list) for _, name_list in STAGE_LIST]
+
+
+####
+def run_config(config, work_dir, sample_interval=0.1):
+    """Run a configuration within a spawned process, sampling its resources."""
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    ctx = mp.get_context("spawn")
+    proc = ctx.Process(target=_run_pipeline, args=(config, work_dir))
+
+    start = time.perf_counter()
+    proc.start()
+    proc_info = psutil.Process(proc.pid)
+    peak_rss, peak_cache_bytes = 0, 0
+    while proc.is_alive():
+        rss = 0
+        try:
+            for sub_proc in [proc_info] + proc_info.children(recursive=True):
+                rss += sub_proc.memory_info().rss
+        except psutil.Error:
+            pass  # exited meanwhile
+        peak_rss = max(peak_rss, rss)
+        cache_bytes = get_disk_usage("%s/cache/" % work_dir)
+        peak_cache_bytes = max(peak_cache_bytes, cache_bytes)
+        proc.join(sample_interval)
+    wall_time = time.perf_counter() - start
+    assert proc.exitcode == 0, "Run failed: %s" % config
+
+    with open("%s/output/synthetic.json" % work_dir, "r") as handle:
+        nr_nuclei = len(json.load(handle)["nuc"])
+    stage_time = _get_stage_time("%s/trace.json" % work_dir)
+    return wall_time, stage_time, peak_rss, peak_cache_bytes, nr_nuclei
+
+
+####
+def run_pipeline_benchmark(
+    slide_size_list,
+    chunk_shape_list,
+    nr_workers_list,
+    model,
+    cache_mode,
+    nr_inference_workers,
+    work_dir,
+):
+    header = ["slide", "chunk", "workers", "wall(s)"]
+    header += ["%s(s)" % name for name, _ in STAGE_LIST]
+    header += ["rss(MB)", "cache(MB)", "nuclei"]
+    print(("%8s" + " %10s" * (len(header) - 1)) % tuple(header))
+    for slide_size in slide_size_list:
+        for chunk_shape in chunk_shape_list:
+            for nr_workers in nr_workers_list:
+                config = {
+                    "slide_size": slide_size,
+                    "chunk_shape": chunk_shape,
+                    "nr_post_proc_workers": nr_workers,
+                    "nr_inference_workers": nr_inference_workers,
+                    "model": model,
+                    "cache_mode": cache_mode,
+                    "seed": 0,
+                }
+                result = run_config(config, "%s/run/" % work_dir)
+                wall_time, stage_time, peak_rss, peak_cache_bytes, nr_nuclei = result
+                row = [slide_size, chunk_shape, nr_workers, "%.2f" % wall_time]
+                row += ["%.2f" % v for v in stage_time]
+                row += ["%.0f" % (peak_rss / 2 ** 20)]
+                row += ["%.0f" % (peak_cache_bytes / 2 ** 20), nr_nuclei]
+                print(("%8s" + " %10s" * (len(row) - 1)) % tuple(row))
+    return
+
+
+####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slide_size", type=int, nargs="+", default=[4096, 8192])
+    parser.add_argument("--chunk_shape", type=int, nargs="+", default=[2048, 4096])
+    parser.add_argument("--nr_post_proc_workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--nr_inference_workers", type=int, default=2)
+    parser.add_argument("--model", choices=["stub", "random"], default="stub")
+    parser.add_argument("--cache_mode", choices=["mmap", "ram", "auto"], default="mmap")
+    parser.add_argument("--work_dir", type=str, default=None)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp() if args.work_dir is None else args.work_dir
+    try:
+        run_pipeline_benchmark(
+            args.slide_size,
+            args.chunk_shape,
+            args.nr_post_proc_workers,
+            args.model,
+            args.cache_mode,
+            args.nr_inference_workers,
+            work_dir,
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
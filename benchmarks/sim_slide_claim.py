@@ -0,0 +1,118 @@
+"""sim_slide_claim.py
+
+Simulate several nodes processing the same slide list with `SlideClaimer`,
+each node is a local process and processing a slide is a sleep. One node is
+killed while holding a slide, so that its claim turns stale and the slide is
+recovered by another node. Check that every slide is done exactly once.
+
+Usage:
+    python -m benchmarks.sim_slide_claim [--nr_nodes=<n>] [--nr_slides=<n>]
+        [--stale_timeout=<seconds>]
+
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from misc.work_claim import SlideClaimer
+
+
+####
+def run_node(node_idx, work_dir, name_list, stale_timeout, hang_after=None):
+    """Process the slides claimed by this node, i.e write their output.
+
+    Outputs are created with `O_EXCL`, so that a slide done twice is caught.
+    The node hangs while holding its `hang_after`-th slide, to be killed.
+    """
+    rng = np.random.RandomState(node_idx)
+    slide_claimer = SlideClaimer(
+        "%s/lock/" % work_dir, stale_timeout, heartbeat_interval=stale_timeout / 10
+    )
+    get_output_path = lambda name: "%s/output/%s.txt" % (work_dir, name)
+    is_done = lambda name: os.path.exists(get_output_path(name))
+    claim_iter = slide_claimer.claim_iter(name_list, is_done, stale_timeout / 10)
+    for claim_idx, name in enumerate(claim_iter):
+        if claim_idx == hang_after:
+            open("%s/hang.txt" % work_dir, "w").close()
+            while True:
+                time.sleep(1.0)
+        # some slides take longer than the timeout, kept alive by the heartbeat
+        duration_list = [0.05, 0.1, 0.2, 1.5 * stale_timeout]
+        time.sleep(rng.choice(duration_list, p=[0.4, 0.3, 0.25, 0.05]))
+        output_path = get_output_path(name)
+        if os.path.exists(output_path):
+            output_path = "%s/duplicate/%s.%d" % (work_dir, name, node_idx)
+        with open(output_path, "x") as handle:
+            handle.write(str(node_idx))
+        slide_claimer.release(name)
+    slide_claimer.close()
+    return
+
+
+####
+def run_simulation(nr_nodes, nr_slides, stale_timeout):
+    work_dir = tempfile.mkdtemp()
+    for sub_dir in ["lock", "output", "duplicate"]:
+        os.makedirs("%s/%s" % (work_dir, sub_dir))
+    name_list = ["slide_%04d" % idx for idx in range(nr_slides)]
+
+    ctx = mp.get_context("spawn")
+    node_list = []
+    for node_idx in range(nr_nodes):
+        hang_after = 2 if node_idx == 0 else None
+        node = ctx.Process(
+            target=run_node,
+            args=(node_idx, work_dir, name_list, stale_timeout, hang_after),
+        )
+        node_list.append(node)
+
+    start = time.perf_counter()
+    for node in node_list:
+        node.start()
+    # * kill the node once it holds the slide, leaving its lock behind
+    while not os.path.exists("%s/hang.txt" % work_dir):
+        assert node_list[0].is_alive(), "Node 0 has finished before hanging."
+        time.sleep(0.05)
+    node_list[0].kill()
+    for node in node_list:
+        node.join()
+    end = time.perf_counter()
+
+    done_list = sorted(v[:-4] for v in os.listdir("%s/output" % work_dir))
+    duplicate_list = os.listdir("%s/duplicate" % work_dir)
+    node_count = np.zeros(nr_nodes, dtype=np.int64)
+    for name in done_list:
+        with open("%s/output/%s.txt" % (work_dir, name)) as handle:
+            node_count[int(handle.read())] += 1
+    lock_list = os.listdir("%s/lock" % work_dir)
+    shutil.rmtree(work_dir)
+
+    print("time: %.2fs" % (end - start))
+    print("slides done per node:", node_count.tolist(), "(node 0 was killed)")
+    print("done: %d/%d" % (len(done_list), nr_slides))
+    print("duplicates: %d" % len(duplicate_list))
+    print("locks left: %d" % len(lock_list))
+    assert done_list == name_list, "Some slides are not done."
+    assert len(duplicate_list) == 0, "Some slides are done more than once."
+    assert len(lock_list) == 0, "Some locks are left behind."
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nr_nodes", type=int, default=4)
+    parser.add_argument("--nr_slides", type=int, default=64)
+    parser.add_argument(
+        "--stale_timeout",
+        type=float,
+        default=1.0,
+        help="seconds without heartbeat after which a claim is broken",
+    )
+    args = parser.parse_args()
+    run_simulation(args.nr_nodes, args.nr_slides, args.stale_timeout)
@@ -0,0 +1,82 @@
+"""stub_model.py
+
+Models to benchmark the wsi pipeline on CPU: a stub deriving the outputs of
+HoVerNet from the dark pixels of the patches, or a randomly initialized
+HoVerNet.
+
+"""
+
+import numpy as np
+import torch
+from scipy import ndimage
+
+from models.hovernet.net_desc import create_model
+from models.hovernet.run_desc import infer_step
+
+
+####
+def stub_infer_step(batch_data, patch_output_shape, nr_types=None, threshold=120):
+    """Stand-in of `infer_step`, each connected dark area is a nucleus.
+
+    The output channels are laid out as those of HoVerNet, i.e the type (if
+    `nr_types` is not None), then the nuclei probability then the horizontal
+    and vertical maps, so that the post processing finds realistic instances.
+
+    Args:
+        batch_data: N x H x W x 3 input patches
+        patch_output_shape: size of the output patches, at their centre
+        nr_types: number of nuclei types, None if the model has no type branch
+        threshold: red intensity below which a pixel belongs to a nucleus
+
+    """
+    if isinstance(batch_data, torch.Tensor):
+        batch_data = batch_data.numpy()
+    crop = (batch_data.shape[1] - patch_output_shape) // 2
+    batch_data = batch_data[
+        :, crop : crop + patch_output_shape, crop : crop + patch_output_shape
+    ]
+    nuclei_map = batch_data[..., 0] < threshold
+    # * all patches are labelled at once, without connectivity across them
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    label_map, nr_labels = ndimage.label(nuclei_map, structure=structure)
+
+    output = np.zeros(nuclei_map.shape + (4,), dtype=np.float32)
+    output[..., 0] = 1  # all nuclei are of the first type
+    output[..., 1] = nuclei_map
+    if nr_labels > 0:
+        label_idx = np.arange(1, nr_labels + 1)
+        coord_y, coord_x = np.mgrid[: nuclei_map.shape[1], : nuclei_map.shape[2]]
+        centroid = ndimage.center_of_mass(nuclei_map, label_map, label_idx)
+        centroid = np.concatenate([np.zeros((1, 3)), np.array(centroid)])
+        for channel, coord, axis in [(2, coord_x, 2), (3, coord_y, 1)]:
+            offset = (coord[None] - centroid[label_map, axis]) * nuclei_map
+            max_offset = ndimage.maximum(np.abs(offset), label_map, label_idx)
+            max_offset = np.concatenate([[1.0], np.asarray(max_offset) + 1.0e-6])
+            output[..., channel] = offset / max_offset[label_map]
+
+    if nr_types is None:
+        output = output[..., 1:]
+    return output
+
+
+####
+def get_run_step(model_name, patch_output_shape, nr_types=None, mode="fast"):
+    """Run step of the model to benchmark with, on CPU.
+
+    Args:
+        model_name: `stub` for `stub_infer_step`, `random` for HoVerNet with
+                    random weights
+        patch_output_shape: size of the output patches
+        nr_types: number of nuclei types, None if the model has no type branch
+        mode: mode of HoVerNet
+
+    """
+    if model_name == "stub":
+        return lambda batch_data: stub_infer_step(
+            batch_data, patch_output_shape, nr_types=nr_types
+        )
+    assert model_name == "random", "Unknown model `%s`." % model_name
+    torch.manual_seed(0)
+    net = create_model(mode=mode, nr_types=nr_types)
+    return lambda batch_data: infer_step(batch_data, net, device="cpu")
@@ -0,0 +1,186 @@
+"""synthetic_wsi.py
+
+Procedurally generated H&E-like slides served from memory, so that the wsi
+pipeline can be run without OpenSlide nor actual slides.
+
+"""
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from misc.wsi_handler import FileHandler
+
+# * colours of the background, the stroma (eosin) and the nuclei (hematoxylin)
+_BACKGROUND_RGB = np.array([242, 240, 245], dtype=np.float32)
+_STROMA_RGB = np.array([225, 155, 200], dtype=np.float32)
+_NUCLEI_RGB = np.array([75, 50, 140], dtype=np.float32)
+_MAX_NUCLEI_RADIUS = 10  # at the base level
+_BORDER_SIZE = 512  # base pixels without tissue along the border of the slide
+
+
+####
+def _hash_noise(coord_y, coord_x, seed):
+    """Deterministic noise within [-1, 1] for each pixel, whatever the region read."""
+    coord_y = coord_y.astype(np.uint32)[:, None]
+    coord_x = coord_x.astype(np.uint32)[None, :]
+    noise = coord_y * np.uint32(73856093) ^ coord_x * np.uint32(19349663)
+    noise = noise ^ np.uint32(seed * 83492791 % 2 ** 32)
+    noise = (noise * np.uint32(2654435761)) >> np.uint32(24)
+    return noise.astype(np.float32) / 127.5 - 1.0
+
+
+####
+def _get_interp_weights(coord, cell_size, nr_cells):
+    """Linear interpolation weights of the cells for each coordinate, N x `nr_cells`."""
+    position = np.clip(coord / cell_size + 0.5, 0, nr_cells - 1)
+    cell_idx = np.floor(position).astype(np.int64)
+    fraction = (position - cell_idx).astype(np.float32)
+    weights = np.zeros((coord.shape[0], nr_cells), dtype=np.float32)
+    weights[np.arange(coord.shape[0]), cell_idx] = 1.0 - fraction
+    next_idx = np.minimum(cell_idx + 1, nr_cells - 1)
+    weights[np.arange(coord.shape[0]), next_idx] += fraction
+    return weights
+
+
+####
+class SyntheticFileHandler(FileHandler):
+    """Slide with blobs of tissue sprinkled with nuclei, rendered on the fly.
+
+    Every region is rendered from the slide coordinates only, so that the same
+    pixel is identical whatever the region it is read from and at a cost that
+    only depends on the size of the region. Levels are downsampled by 1, 4,
+    16 and 32 wrt the base one.
+
+    Args:
+        base_shape: (W, H) of the slide at `base_mag`
+        base_mag: magnification of the base level
+        seed: seed of the slide
+        nuclei_density: average number of nuclei per 128x128 pixels of tissue
+                        at the base level
+
+    """
+
+    def __init__(self, base_shape, base_mag=40.0, seed=0, nuclei_density=6.0):
+        super().__init__()
+        self.seed = seed
+        self.nuclei_density = nuclei_density
+        self.downsample_list = [1, 4, 16, 32]
+        self.metadata = OrderedDict(
+            [
+                ("available_mag", [base_mag / v for v in self.downsample_list]),
+                ("base_mag", base_mag),
+                ("vendor", "synthetic"),
+                ("mpp  ", np.array([0.25, 0.25])),
+                ("base_shape", np.array(base_shape)),
+            ]
+        )
+
+        # * coarse random field, its bilinear interpolation above 0 is tissue
+        rng = np.random.RandomState(seed)
+        self.field_cell = 2048  # base pixels per cell of the coarse field
+        self.nuclei_cell = 128  # base pixels per cell of the nuclei placement
+        field_shape = np.array(base_shape[::-1]) // self.field_cell + 3
+        field = rng.normal(size=field_shape).astype(np.float32)
+        self.field = ndimage.gaussian_filter(field, 0.75) + 0.3
+        return
+
+    def __get_field(self, coord_y, coord_x):
+        """Field at the base coordinates, on the grid `coord_y` x `coord_x`."""
+        # * bilinear interpolation is separable, so 2 small matrix products
+        weight_y = _get_interp_weights(coord_y, self.field_cell, self.field.shape[0])
+        weight_x = _get_interp_weights(coord_x, self.field_cell, self.field.shape[1])
+        return weight_y @ self.field @ weight_x.T
+
+    def __draw_nuclei(self, canvas, tl, downsample):
+        """Draw the nuclei overlapping the region of `canvas` at `tl` (base Y, X)."""
+        max_radius = _MAX_NUCLEI_RADIUS
+        canvas_shape = np.array(canvas.shape[:2]) * downsample
+        cell_tl = (np.array(tl) - max_radius) // self.nuclei_cell
+        cell_br = (np.array(tl) + canvas_shape + max_radius) // self.nuclei_cell + 1
+        centre_list, shape_list = [], []
+        for cell_y in range(max(cell_tl[0], 0), cell_br[0]):
+            for cell_x in range(max(cell_tl[1], 0), cell_br[1]):
+                cell_seed = (self.seed * 1000003 + cell_y * 7919 + cell_x) % 2 ** 32
+                rng = np.random.RandomState(cell_seed)
+                nr_nuclei = rng.poisson(self.nuclei_density)
+                centre = rng.uniform(0, self.nuclei_cell, size=(nr_nuclei, 2))
+                centre += np.array([cell_y, cell_x]) * self.nuclei_cell
+                # axes, angle and darkness of each nucleus
+                shape = rng.uniform(
+                    [4, 0.6, 0, 0.8], [max_radius, 1.0, 180, 1.1], size=(nr_nuclei, 4)
+                )
+                centre_list.append(centre)
+                shape_list.append(shape)
+        if len(centre_list) == 0:
+            return
+        centre_list = np.concatenate(centre_list)
+        shape_list = np.concatenate(shape_list)
+        if centre_list.shape[0] == 0:
+            return
+        # only within the tissue
+        in_tissue = ndimage.map_coordinates(
+            self.field, (centre_list / self.field_cell + 0.5).T, order=1
+        )
+        base_shape = self.metadata["base_shape"][::-1]
+        border = np.minimum(centre_list, base_shape - centre_list) / _BORDER_SIZE
+        in_tissue = np.minimum(in_tissue, np.min(border, axis=-1) - 1.0) > 0
+        for centre, shape in zip(centre_list[in_tissue], shape_list[in_tissue]):
+            centre = (centre - tl) / downsample
+            axes = (shape[0] / downsample, shape[0] * shape[1] / downsample)
+            colour = np.clip(_NUCLEI_RGB * shape[3], 0, 255).tolist()
+            cv2.ellipse(
+                canvas,
+                (int(round(centre[1] * 16)), int(round(centre[0] * 16))),
+                (int(round(axes[0] * 16)), int(round(axes[1] * 16))),
+                shape[2],
+                0,
+                360,
+                colour,
+                -1,
+                cv2.LINE_AA,
+                4,  # fixed point with 4 fractional bits
+            )
+        return
+
+    def __render(self, tl, shape, downsample):
+        """Render a region at a level, `tl` and `shape` in (Y, X) wrt the level."""
+        # ! anti-aliased shapes are drawn differently when clipped by the canvas,
+        # ! so the region is rendered with a margin wider than any nucleus
+        margin = 2 * _MAX_NUCLEI_RADIUS + 2
+        tl, shape = np.array(tl) - margin, np.array(shape) + 2 * margin
+        coord_y = (tl[0] + np.arange(shape[0])) * downsample
+        coord_x = (tl[1] + np.arange(shape[1])) * downsample
+        field = self.__get_field(coord_y, coord_x)
+        noise = _hash_noise(coord_y, coord_x, self.seed)
+
+        # no tissue along the border of the slide
+        base_shape = self.metadata["base_shape"][::-1]
+        border_y = np.minimum(coord_y, base_shape[0] - coord_y) / _BORDER_SIZE
+        border_x = np.minimum(coord_x, base_shape[1] - coord_x) / _BORDER_SIZE
+        border = np.minimum(border_y[:, None], border_x[None, :]) - 1.0
+        field = np.minimum(field, border)
+
+        tissue = np.clip(field * 8.0, 0.0, 1.0)[..., None]
+        canvas = _BACKGROUND_RGB * (1.0 - tissue) + _STROMA_RGB * tissue
+        canvas += noise[..., None] * np.array([6.0, 8.0, 6.0], dtype=np.float32)
+        canvas = np.clip(canvas, 0, 255).astype(np.uint8)
+        if downsample <= 4:  # nuclei are less than a pixel wide below that
+            self.__draw_nuclei(canvas, tl * downsample, downsample)
+        canvas = canvas[margin:-margin, margin:-margin]
+        tl = tl + margin
+
+        # outside of the slide is empty, as read via OpenSlide
+        level_shape = base_shape // downsample
+        canvas[np.maximum(level_shape[0] - tl[0], 0) :] = 0
+        canvas[:, np.maximum(level_shape[1] - tl[1], 0) :] = 0
+        return canvas
+
+    def _get_level_dimensions(self, read_lv):
+        return self.metadata["base_shape"] // self.downsample_list[read_lv]
+
+    def _read_level_region(self, coords, size, read_lv):
+        downsample = self.downsample_list[read_lv]
+        return self.__render(coords[::-1], size[::-1], downsample)
@@ -13,6 +13,7 @@ import pathlib
 import numpy as np
 import shutil
 
+from misc.inst_store import InstanceReader
 from misc.utils import rm_n_mkdir, mkdir
 
 ####
@@ -80,6 +81,17 @@ if __name__ == "__main__":
             continue
         print(code_name)
 
+        # * use the binary output if available, only the needed columns are read
+        nuc_binary_path = "%s/%s.nuc" % (root_dir, code_name)
+        if os.path.exists(nuc_binary_path):
+            reader = InstanceReader(nuc_binary_path)
+            centroid_list = reader.column("centroid") * scale_factor
+            centroid_list = centroid_list.astype(np.int32)
+            type_list = np.array(reader.column("type"))
+            save_path = "%s/%s.tsv" % (output_dir, code_name)
+            to_qupath(save_path, centroid_list, type_list, type_info_dict)
+            continue
+
         with open(nuc_info_path, "r") as handle:
             info_dict = json.load(handle)["nuc"]
 
@@ -1,14 +1,20 @@
+import os
+import queue
 import sys
 import math
+import time
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 
 import torch
+import torch.multiprocessing as torch_mp
 import torch.utils.data as data
 
 import psutil
 
+from misc.tracer import init_tracer, trace_span
+
 
 ####
 class SerializeFileList(data.IterableDataset):
@@ -74,22 +80,42 @@ class SerializeFileList(data.IterableDataset):
 
 ####
 class SerializeArray(data.Dataset):
-    def __init__(self, mmap_array_path, patch_info_list, patch_size, preproc=None):
+    """Read patches from an array shared with the main process.
+
+    `array_handle` is either the path to a `.npy` file or a `SharedArray`,
+    the array is only opened once accessed so that it is attached within
+    each torch worker rather than pickled along with the dataset.
+
+    """
+
+    def __init__(self, array_handle, patch_info_list, patch_size, preproc=None):
         super().__init__()
         self.patch_size = patch_size
 
-        # use mmap as intermediate sharing, else variable will be duplicated
-        # accross torch worker => OOM error, open in read only mode
-        self.image = np.load(mmap_array_path, mmap_mode="r")
+        # use mmap or shared memory as intermediate sharing, else variable will be
+        # duplicated accross torch worker => OOM error
+        self.array_handle = array_handle
+        self.image = None
 
         self.patch_info_list = patch_info_list
         self.preproc = preproc
         return
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["image"] = None  # re-attach within the worker
+        return state
+
     def __len__(self):
         return len(self.patch_info_list)
 
     def __getitem__(self, idx):
+        if self.image is None:
+            if isinstance(self.array_handle, str):
+                # open in read only mode
+                self.image = np.load(self.array_handle, mmap_mode="r")
+            else:
+                self.image = self.array_handle.array
         patch_info = self.patch_info_list[idx]
         patch_data = self.image[
             patch_info[0] : patch_info[0] + self.patch_size[0],
@@ -98,3 +124,141 @@ class SerializeArray(data.Dataset):
         if self.preproc is not None:
             patch_data = self.preproc(patch_data)
         return patch_data, patch_info
+
+
+####
+def _patch_feeder_worker(task_queue, output_queue, patch_size, trace_dir=None):
+    """Long-lived worker reading batches of patches for `PatchFeeder`."""
+    if trace_dir is not None:
+        init_tracer(trace_dir, "patch feeder")
+    output_queue.put((None, os.getpid(), None, None))
+    curr_chunk_id, dataset = None, None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        chunk_id, batch_idx, array_handle, patch_info_list = task
+        try:
+            # the array of a chunk is attached once and reused for all its batches
+            if chunk_id != curr_chunk_id:
+                curr_chunk_id = chunk_id
+                dataset = SerializeArray(array_handle, None, patch_size)
+            dataset.patch_info_list = patch_info_list
+            with trace_span("read patches", "io", batch=batch_idx):
+                patch_data = [dataset[idx][0] for idx in range(len(patch_info_list))]
+                patch_data = torch.from_numpy(np.stack(patch_data))
+            patch_info = torch.from_numpy(patch_info_list)
+            output_queue.put((chunk_id, batch_idx, patch_data, patch_info))
+        except Exception as exception:
+            output_queue.put((chunk_id, batch_idx, exception, None))
+    return
+
+
+####
+class PatchFeeder(object):
+    """Pool of patch reading workers that persists across chunks and slides.
+
+    Replace the creation of a `DataLoader` over `SerializeArray` for each
+    chunk, the workers are spawned once and receive the chunk handle along
+    with the patch coordinates of each batch via a queue.
+
+    Args:
+        nr_workers: number of worker processes, 0 to read within the main process
+        batch_size: number of patches per batch
+        patch_size: input patch shape
+        trace_dir: if given, the workers record their spans there, see `init_tracer`
+
+    """
+
+    def __init__(self, nr_workers, batch_size, patch_size, trace_dir=None):
+        self.nr_workers = nr_workers
+        self.batch_size = batch_size
+        self.patch_size = patch_size
+        self.chunk_id = 0
+        self.worker_list = []
+        self.startup_time = 0.0
+        if nr_workers == 0:
+            return
+
+        start = time.perf_counter()
+        ctx = torch_mp.get_context("spawn")
+        self.task_queue = ctx.Queue()
+        self.output_queue = ctx.Queue()
+        for _ in range(nr_workers):
+            worker = ctx.Process(
+                target=_patch_feeder_worker,
+                args=(self.task_queue, self.output_queue, patch_size, trace_dir),
+                daemon=True,
+            )
+            worker.start()
+            self.worker_list.append(worker)
+        for _ in range(nr_workers):
+            self._get_output()
+        self.startup_time = time.perf_counter() - start
+        return
+
+    def _get_output(self):
+        while True:
+            try:
+                return self.output_queue.get(timeout=1.0)
+            except queue.Empty:
+                # ! a worker killed (e.g OOM) will never reply
+                for worker in self.worker_list:
+                    assert worker.is_alive(), "Patch feeder worker died unexpectedly."
+
+    def nr_batches(self, patch_info_list):
+        return int(math.ceil(len(patch_info_list) / self.batch_size))
+
+    def run(self, array_handle, patch_info_list):
+        """Yield batches of `(patch_data, patch_info)` in the same order as a
+        `DataLoader` over `SerializeArray(array_handle, patch_info_list)`.
+
+        """
+        nr_batches = self.nr_batches(patch_info_list)
+        batch_info_list = [
+            patch_info_list[idx * self.batch_size : (idx + 1) * self.batch_size]
+            for idx in range(nr_batches)
+        ]
+
+        if self.nr_workers == 0:
+            dataset = SerializeArray(array_handle, None, self.patch_size)
+            for batch_info in batch_info_list:
+                dataset.patch_info_list = batch_info
+                with trace_span("read patches", "io"):
+                    patch_data = [dataset[idx][0] for idx in range(len(batch_info))]
+                    patch_data = torch.from_numpy(np.stack(patch_data))
+                yield patch_data, torch.from_numpy(batch_info)
+            return
+
+        self.chunk_id += 1
+        # * keep 2 batches per worker in flight, similar to `DataLoader`
+        nr_in_flight = 2 * self.nr_workers
+        next_submit_idx = 0
+        ready_batch_dict = {}
+        for batch_idx in range(nr_batches):
+            while next_submit_idx < min(batch_idx + nr_in_flight, nr_batches):
+                task = (
+                    self.chunk_id,
+                    next_submit_idx,
+                    array_handle,
+                    batch_info_list[next_submit_idx],
+                )
+                self.task_queue.put(task)
+                next_submit_idx += 1
+            while batch_idx not in ready_batch_dict:
+                chunk_id, output_idx, patch_data, patch_info = self._get_output()
+                if chunk_id != self.chunk_id:
+                    continue  # left over from an interrupted chunk
+                if isinstance(patch_data, Exception):
+                    raise patch_data
+                ready_batch_dict[output_idx] = (patch_data, patch_info)
+            yield ready_batch_dict.pop(batch_idx)
+        return
+
+    def close(self):
+        for _ in self.worker_list:
+            self.task_queue.put(None)
+        for worker in self.worker_list:
+            worker.join()
+        self.worker_list = []
+        return
@@ -78,17 +78,33 @@ class InferManager(object):
         return
 
     def __save_json(self, path, old_dict, mag=None):
-        new_dict = {}
-        for inst_id, inst_info in old_dict.items():
-            new_inst_info = {}
-            for info_name, info_value in inst_info.items():
-                # convert to jsonable
-                if isinstance(info_value, np.ndarray):
-                    info_value = info_value.tolist()
-                new_inst_info[info_name] = info_value
-            new_dict[int(inst_id)] = new_inst_info
-
-        json_dict = {"mag": mag, "nuc": new_dict}  # to sync the format protocol
-        with open(path, "w") as handle:
-            json.dump(json_dict, handle)
-        return new_dict
+        """Save the instances as `{"mag": mag, "nuc": {inst_id: inst_info}}`.
+
+        The document is streamed instance by instance rather than converted as a
+        whole beforehand, the output is the same as `json.dump` of that dict. It
+        is written to a temporary file then renamed, so that `path` only exists
+        once complete.
+
+        Args:
+            path: path to the output json
+            old_dict: `{inst_id: inst_info}`, or any store providing `items()`
+            mag: magnification the instances are defined at
+
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as handle:
+            # to sync the format protocol
+            handle.write('{"mag": %s, "nuc": {' % json.dumps(mag))
+            for idx, (inst_id, inst_info) in enumerate(old_dict.items()):
+                new_inst_info = {}
+                for info_name, info_value in inst_info.items():
+                    # convert to jsonable
+                    if isinstance(info_value, np.ndarray):
+                        info_value = info_value.tolist()
+                    new_inst_info[info_name] = info_value
+                if idx > 0:
+                    handle.write(", ")
+                handle.write('"%d": %s' % (int(inst_id), json.dumps(new_inst_info)))
+            handle.write("}}")
+        os.replace(tmp_path, path)
+        return
@@ -27,6 +27,7 @@ import torch
 import torch.utils.data as data
 import tqdm
 from dataloader.infer_loader import SerializeArray, SerializeFileList
+from misc.metrics import MetricsWriter
 from misc.utils import (
     color_deconvolution,
     cropping_center,
@@ -167,6 +168,33 @@ class InferManager(base.InferManager):
         if self.save_qupath:
             rm_n_mkdir(self.output_dir + "/qupath/")
 
+        # * progress of the run, only read by the metrics writer thread
+        nr_files = len(file_path_list)
+        progress_dict = {
+            "files_done": 0,
+            "patches_done": 0,
+            "nuclei_found": 0,
+            "cache_bytes": 0,
+        }
+
+        def collect_metrics():
+            metric_list = [("files_total", nr_files)]
+            metric_list.extend(progress_dict.items())
+            return metric_list
+
+        metrics_writer = None
+        if self.metrics_interval > 0:
+            assert self.metrics_format in ["json", "prometheus"], (
+                "Unknown metrics format `%s`" % self.metrics_format
+            )
+            metrics_ext = "prom" if self.metrics_format == "prometheus" else "json"
+            metrics_writer = MetricsWriter(
+                "%s/metrics.%s" % (self.output_dir, metrics_ext),
+                collect_metrics,
+                self.metrics_interval,
+                rate_name_list=["patches_done"],
+            )
+
         def proc_callback(results):
             """Post processing callback.
             
@@ -203,6 +231,8 @@ class InferManager(base.InferManager):
 
             save_path = "%s/json/%s.json" % (self.output_dir, img_name)
             self.__save_json(save_path, inst_info_dict, None)
+            progress_dict["files_done"] += 1
+            progress_dict["nuclei_found"] += len(inst_info_dict)
             return img_name
 
         def detach_items_of_uid(items_list, uid, nr_expected_items):
@@ -275,6 +305,8 @@ class InferManager(base.InferManager):
                 # TODO: refactor to explicit protocol
                 cache_image_info_list.append([src_shape, len(patch_info), top_corner])
 
+            progress_dict["cache_bytes"] = sum(v.nbytes for v in cache_image_list)
+
             # * apply neural net on cached data
             dataset = SerializeFileList(
                 cache_image_list, cache_patch_info_list, self.patch_input_shape
@@ -308,6 +340,7 @@ class InferManager(base.InferManager):
                 sample_info_list = np.split(sample_info_list, curr_batch_size, axis=0)
                 sample_output_list = list(zip(sample_info_list, sample_output_list))
                 accumulated_patch_output.extend(sample_output_list)
+                progress_dict["patches_done"] += curr_batch_size
                 pbar.update()
             pbar.close()
 
@@ -378,5 +411,7 @@ class InferManager(base.InferManager):
                     else:
                         file_path = proc_callback(future.result())
                         log_info("Done Assembling %s" % file_path)
+        if metrics_writer is not None:
+            metrics_writer.close()
         return
 
@@ -1,21 +1,31 @@
 import multiprocessing as mp
-from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, as_completed, wait
-from multiprocessing import Lock, Pool
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    FIRST_EXCEPTION,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from multiprocessing import Lock
 
 mp.set_start_method("spawn", True)  # ! must be at top for VScode debugging
 
 import argparse
 import glob
+import hashlib
 import json
 import logging
 import math
 import os
 import pathlib
+import queue
 import re
 import shutil
+import socket
 import sys
+import threading
 import time
-from functools import reduce
+from functools import partial, reduce
 from importlib import import_module
 
 import cv2
@@ -23,10 +33,22 @@ import numpy as np
 import psutil
 import scipy.io as sio
 import torch
-import torch.utils.data as data
 import tqdm
-from dataloader.infer_loader import SerializeArray, SerializeFileList
+from dataloader.infer_loader import PatchFeeder, SerializeFileList
 from docopt import docopt
+from misc.block_store import BlockArray, get_block_mask, open_cache_array
+from misc.inst_store import InstanceTable, save_inst_arrays
+from misc.journal import ProgressJournal
+from misc.mask_utils import TissueMaskIndex, get_tissue_mask
+from misc.metrics import MetricsWriter, get_disk_usage
+from misc.shared_array import SharedArray, SharedArrayPool, shared_memory_available
+from misc.tracer import (
+    close_tracer,
+    get_trace_dir,
+    init_tracer,
+    save_trace,
+    trace_span,
+)
 from misc.utils import (
     cropping_center,
     get_bounding_box,
@@ -34,6 +56,7 @@ from misc.utils import (
     log_info,
     rm_n_mkdir,
 )
+from misc.work_claim import SlideClaimer
 from misc.wsi_handler import get_file_handler
 
 from . import base
@@ -50,16 +73,39 @@ def _init_worker_child(lock_):
 ####
 def _remove_inst(inst_map, remove_id_list):
     """Remove instances with id in remove_id_list.
+
+    Done in a single pass over inst_map rather than 1 pass per id.
     
     Args:
         inst_map: map of instances
         remove_id_list: list of ids to remove from inst_map
     """
-    for inst_id in remove_id_list:
-        inst_map[inst_map == inst_id] = 0
+    if len(remove_id_list) == 0:
+        return inst_map
+    inst_map[np.isin(inst_map, remove_id_list)] = 0
     return inst_map
 
 
+####
+def _merge_inst(inst_map, new_inst_map, remove_id_list, id_offset):
+    """Paste the instances of new_inst_map into inst_map.
+
+    Removing the instances in remove_id_list, offsetting the ids and merging
+    are done via a lookup table over the ids of new_inst_map, in a single pass.
+
+    Args:
+        inst_map: map of instances, must be 0 wherever new_inst_map is kept
+        new_inst_map: map of instances with small (i.e per tile) ids
+        remove_id_list: list of ids to remove from new_inst_map
+        id_offset: value added to the ids of the kept instances of new_inst_map
+
+    """
+    id_lut = np.arange(new_inst_map.max() + 1, dtype=inst_map.dtype) + id_offset
+    id_lut[0] = 0
+    id_lut[np.asarray(remove_id_list, dtype=np.int64)] = 0
+    return inst_map + id_lut[new_inst_map]
+
+
 ####
 def _get_patch_top_left_info(img_shape, input_size, output_size):
     """Get top left coordinate information of patches from original image.
@@ -221,81 +267,788 @@ def _get_chunk_patch_info(
     return chunk_info_list, patch_info_list
 
 
+# * rough memory footprint, in bytes, used to plan the chunk and tile shapes
+_CHUNK_READ_BYTES_PER_PIXEL = 10  # RGBA region from the reader and its RGB copy
+_POST_PROC_BYTES_PER_PIXEL = 80  # peak of the HoVer-Net post processing
+_POST_PROC_WORKER_BYTES = 640 << 20  # worker process along with its imports
+_MAX_CHUNK_SHAPE = 20000
+_MAX_TILE_SHAPE = 4096
+
+# blocks of the sparse cache, must be larger than the output patches
+_CACHE_BLOCK_SHAPE = (512, 512)
+
+
+####
+def _plan_chunk_tile_shape(
+    mem_budget,
+    patch_input_shape,
+    patch_output_shape,
+    ambiguous_size,
+    out_ch,
+    batch_size,
+    nr_inference_workers,
+    nr_post_proc_workers,
+    chunk_prefetch,
+    chunk_shape=None,
+    tile_shape=None,
+):
+    """Choose the chunk and tile shapes whose memory usage fits within a budget.
+
+    The usage is estimated from the chunks held in RAM (prefetched ones and the
+    one being read), the tiles post processed by each worker along with the
+    instance maps waiting to be merged, and the batches in flight. The shapes
+    left to plan are scaled down from their max by a same factor until the
+    estimate fits, then rounded down as within `_get_chunk_patch_info`, i.e
+    the chunk output and the tile are multiples of `patch_output_shape`.
+
+    Args:
+        mem_budget: memory available for processing a slide, in bytes
+        patch_input_shape: input patch shape
+        patch_output_shape: output patch shape
+        ambiguous_size: ambiguous region along the tiling grid, bounds the tile shape
+        out_ch: number of channels of the prediction map
+        batch_size: number of patches per batch
+        nr_inference_workers: number of workers feeding the batches
+        nr_post_proc_workers: number of post processing workers
+        chunk_prefetch: number of chunks read ahead
+        chunk_shape: chunk shape to keep, `None` to plan it
+        tile_shape: tile shape to keep, `None` to plan it
+
+    Returns:
+        chunk_shape, tile_shape, estimated memory usage in bytes
+
+    """
+    patch_diff_shape = patch_input_shape - patch_output_shape
+    nr_post_proc_procs = max(nr_post_proc_workers, 1)  # else done by the main process
+
+    # batches in flight, input patches (uint8 then float32) and output maps
+    batch_bytes = batch_size * (
+        patch_input_shape ** 2 * 3 * 5 + patch_output_shape ** 2 * out_ch * 4
+    )
+    fixed_bytes = batch_bytes * (nr_inference_workers + 2)
+    fixed_bytes += nr_post_proc_workers * _POST_PROC_WORKER_BYTES
+    # the slots of prefetched chunks, along with the chunk being read
+    chunk_bytes_per_pixel = (chunk_prefetch + 2) * 3 + _CHUNK_READ_BYTES_PER_PIXEL
+    # each worker decodes then post processes a tile, and about 2 instance
+    # maps per worker wait to be merged within the main process
+    tile_bytes_per_pixel = nr_post_proc_procs * (
+        out_ch * 4 + _POST_PROC_BYTES_PER_PIXEL + 2 * 4
+    )
+
+    def get_usage(chunk_shape, tile_shape):
+        usage = fixed_bytes + chunk_bytes_per_pixel * chunk_shape ** 2
+        return usage + tile_bytes_per_pixel * tile_shape ** 2
+
+    # usage is quadratic wrt the scale of the planned shapes
+    planned_chunk_shape = _MAX_CHUNK_SHAPE if chunk_shape is None else 0
+    planned_tile_shape = _MAX_TILE_SHAPE if tile_shape is None else 0
+    kept_usage = get_usage(
+        0 if chunk_shape is None else chunk_shape,
+        0 if tile_shape is None else tile_shape,
+    )
+    planned_usage = get_usage(planned_chunk_shape, planned_tile_shape) - fixed_bytes
+    scale = 1.0
+    if planned_usage > 0:
+        scale = math.sqrt(max(mem_budget - kept_usage, 0) / planned_usage)
+        scale = min(scale, 1.0)
+
+    round_down = lambda x, y: max(int(x // y), 1) * y
+    # ! tiles must be larger than the regions fixing their boundaries, chunks
+    # ! are kept at least as large so that they still hold many patches
+    min_shape = round_down(4 * ambiguous_size, patch_output_shape) + patch_output_shape
+    if chunk_shape is None:
+        chunk_output_shape = scale * _MAX_CHUNK_SHAPE - patch_diff_shape
+        chunk_output_shape = round_down(chunk_output_shape, patch_output_shape)
+        chunk_shape = max(chunk_output_shape, min_shape) + patch_diff_shape
+    if tile_shape is None:
+        tile_shape = round_down(scale * _MAX_TILE_SHAPE, patch_output_shape)
+        tile_shape = max(tile_shape, min_shape)
+    return chunk_shape, tile_shape, get_usage(chunk_shape, tile_shape)
+
+
+####
+def _encode_pred_map(pred_map, storage_dtype, nr_types):
+    """Convert the raw prediction to the data type used to store it for the wsi.
+
+    For `uint8`, the nuclei probability is scaled from [0, 1] and the hv maps
+    from [-1, 1] to [0, 255], the type channel is stored as is. The 0.5
+    threshold of the nuclei probability falls between 2 integer steps, so
+    the binarization done in post processing is unaffected.
+
+    Args:
+        pred_map: HxWxC raw prediction, channels are (type), np, h, v
+        storage_dtype: `float32`, `float16` or `uint8`
+        nr_types: number of types, `None` if there is no type channel
+
+    """
+    if storage_dtype == "float32":
+        return pred_map
+    if storage_dtype == "float16":
+        return pred_map.astype(np.float16)
+    np_ch = 0 if nr_types is None else 1
+    pred_map = np.array(pred_map, dtype=np.float32)
+    pred_map[..., np_ch] *= 255.0
+    pred_map[..., np_ch + 1 :] = (pred_map[..., np_ch + 1 :] + 1.0) * 127.5
+    pred_map = np.clip(np.rint(pred_map), 0, 255)
+    return pred_map.astype(np.uint8)
+
+
+####
+def _decode_pred_map(pred_map, storage_dtype, nr_types):
+    """Convert the stored prediction back to float32, see `_encode_pred_map`."""
+    if storage_dtype == "float32":
+        return pred_map
+    pred_map = pred_map.astype(np.float32)
+    if storage_dtype == "uint8":
+        np_ch = 0 if nr_types is None else 1
+        pred_map[..., np_ch] /= 255.0
+        pred_map[..., np_ch + 1 :] = pred_map[..., np_ch + 1 :] / 127.5 - 1.0
+    return pred_map
+
+
+####
+def _open_holder_ref(holder_ref, mode="r"):
+    """Open a wsi holder passed to the workers, its path within the cache or a `SharedArray`."""
+    if isinstance(holder_ref, SharedArray):
+        return holder_ref.array
+    return open_cache_array(holder_ref, mode=mode)
+
+
 ####
-def _post_proc_para_wrapper(pred_map_mmap_path, tile_info, func, func_kwargs):
+def _init_worker_tracer(trace_dir):
+    """Enable the tracer within a post processing worker on its first task.
+
+    Done here rather than via the `initializer` of the pool, which requires
+    python >= 3.7.
+    """
+    if trace_dir is not None and get_trace_dir() != trace_dir:
+        init_tracer(trace_dir, "post proc")
+    return
+
+
+####
+def _post_proc_para_wrapper(
+    pred_map_ref,
+    tile_info,
+    func,
+    func_kwargs,
+    storage_dtype="float32",
+    trace_dir=None,
+):
     """Wrapper for parallel post processing."""
+    _init_worker_tracer(trace_dir)
     idx, tile_tl, tile_br = tile_info
-    wsi_pred_map_ptr = np.load(pred_map_mmap_path, mmap_mode="r")
-    tile_pred_map = wsi_pred_map_ptr[tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]]
-    tile_pred_map = np.array(tile_pred_map)  # from mmap to ram
-    return func(tile_pred_map, **func_kwargs), tile_info
+    tile_bbox = [int(v) for v in tile_tl] + [int(v) for v in tile_br]
+    with trace_span("read tile", "io", tile=tile_bbox):
+        wsi_pred_map_ptr = _open_holder_ref(pred_map_ref, mode="r")
+        tile_pred_map = wsi_pred_map_ptr[
+            tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]
+        ]
+        tile_pred_map = np.array(tile_pred_map)  # from mmap to ram
+    tile_pred_map = _decode_pred_map(
+        tile_pred_map, storage_dtype, func_kwargs["nr_types"]
+    )
+    with trace_span("post proc tile", "post_proc", tile=tile_bbox):
+        results = func(tile_pred_map, **func_kwargs)
+    return results, tile_info
 
 
 ####
-def _assemble_and_flush(wsi_pred_map_mmap_path, chunk_info, patch_output_list):
-    """Assemble the results. Write to newly created holder for this wsi"""
-    wsi_pred_map_ptr = np.load(wsi_pred_map_mmap_path, mmap_mode="r+")
-    chunk_pred_map = wsi_pred_map_ptr[
-        chunk_info[1][0][0] : chunk_info[1][1][0],
-        chunk_info[1][0][1] : chunk_info[1][1][1],
-    ]
-    if patch_output_list is None:
-        # chunk_pred_map[:] = 0 # zero flush when there is no-results
-        # print(chunk_info.flatten(), 'flush 0')
-        return
+def _post_proc_fixing_merge(
+    wsi_inst_map, tile_info, pred_inst, id_offset, undo_path=None, trace_dir=None
+):
+    """Stitch the instances of a boundary or cross tile into the wsi instance map.
+
+    For fixing the boundary, keep all nuclei split at boundary (i.e within
+    unambigous region) of the existing instance map, and replace all nuclei
+    within the region with newly predicted. Tiles overlapping each other must
+    not be merged concurrently.
+
+    Args:
+        wsi_inst_map: instance map of the entire wsi, or its path within the cache
+                      or its `SharedArray` when called within a worker
+        tile_info: `(idx, tile_tl, tile_br)` of the tile
+        pred_inst: instance map predicted for the tile
+        id_offset: added to the ids of `pred_inst`, must be above all the ids
+                   used within the wsi instance map
+        undo_path: if given, the region is saved there before being modified so
+                   that the merging can be rolled back when resuming a run
+        trace_dir: directory of the tracer to enable within a worker, if any
+
+    Returns:
+        tile_info, ids removed from the wsi instance map, ids (wrt `pred_inst`)
+        of the newly predicted instances that have been kept
+
+    """
+    _init_worker_tracer(trace_dir)
+    if isinstance(wsi_inst_map, (str, SharedArray)):
+        wsi_inst_map = _open_holder_ref(wsi_inst_map, mode="r+")
+    _, tile_tl, tile_br = tile_info
+    tile_bbox = [int(v) for v in tile_tl] + [int(v) for v in tile_br]
+    with trace_span("merge tile", "post_proc", tile=tile_bbox):
+        # * exclude ambiguous out from old prediction map
+        # check 1 pix of 4 edges to find nuclei split at boundary
+        roi_inst = wsi_inst_map[tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]]
+        roi_inst = np.copy(roi_inst)
+        if undo_path is not None:
+            with open("%s.tmp" % undo_path, "wb") as handle:
+                np.save(handle, roi_inst)
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace("%s.tmp" % undo_path, undo_path)
+        roi_edge = np.concatenate(
+            [roi_inst[[0, -1], :].flatten(), roi_inst[:, [0, -1]].flatten()]
+        )
+        roi_boundary_inst_list = np.unique(roi_edge)[1:]  # exclude background
+        roi_inner_inst_list = np.unique(roi_inst)[1:]
+        roi_inner_inst_list = np.setdiff1d(
+            roi_inner_inst_list, roi_boundary_inst_list, assume_unique=True
+        )
+        roi_inst = _remove_inst(roi_inst, roi_inner_inst_list)
+
+        # * exclude unambiguous out from new prediction map
+        # check 1 pix of 4 edges to find nuclei split at boundary
+        roi_edge = pred_inst[roi_inst > 0]  # remove all overlap
+        boundary_inst_list = np.unique(roi_edge)  # no background to exclude
+        inner_inst_list = np.unique(pred_inst)[1:]
+        inner_inst_list = np.setdiff1d(
+            inner_inst_list, boundary_inst_list, assume_unique=True
+        )
+
+        # * proceed to overwrite
+        pred_inst = _merge_inst(roi_inst, pred_inst, boundary_inst_list, id_offset)
+        wsi_inst_map[tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]] = pred_inst
+    return tile_info, roi_inner_inst_list, inner_inst_list
+
 
-    for pinfo in patch_output_list:
-        pcoord, pdata = pinfo
-        pdata = np.squeeze(pdata)
-        pcoord = np.squeeze(pcoord)[:2]
-        chunk_pred_map[
-            pcoord[0] : pcoord[0] + pdata.shape[0],
-            pcoord[1] : pcoord[1] + pdata.shape[1],
-        ] = pdata
-    # print(chunk_info.flatten(), 'pass')
+####
+def _assemble_batch(wsi_pred_map, chunk_output_tl, patch_tl_list, patch_output_list):
+    """Write a batch of patch outputs into the prediction holder of the wsi.
+
+    Args:
+        wsi_pred_map: prediction map of the entire wsi, may be memory-mapped
+        chunk_output_tl: top left (Y, X) of the chunk output wrt the wsi
+        patch_tl_list: Nx2 top left (Y, X) of the patches input wrt the chunk input,
+                       which is also the top left of their output wrt the chunk output
+        patch_output_list: NxHxWxC output of the batch
+
+    """
+    patch_output_shape = np.array(patch_output_list.shape[1:3])
+    patch_tl_list = patch_tl_list + chunk_output_tl
+    patch_br_list = patch_tl_list + patch_output_shape
+    # ! 1 copy of contiguous rows per patch is much faster than a fancy
+    # ! indexing scatter of the whole batch on memory-mapped array
+    for idx in range(patch_output_list.shape[0]):
+        tl, br = patch_tl_list[idx], patch_br_list[idx]
+        wsi_pred_map[tl[0] : br[0], tl[1] : br[1]] = patch_output_list[idx]
     return
 
 
 ####
-class InferManager(base.InferManager):
-    def __run_model(self, patch_top_left_list, pbar_desc):
-        # TODO: the cost of creating dataloader may not be cheap ?
-        dataset = SerializeArray(
-            "%s/cache_chunk.npy" % self.cache_path,
-            patch_top_left_list,
-            self.patch_input_shape,
+class _ChunkPrefetcher(object):
+    """Read chunks of the slide ahead of the inference loop.
+
+    A background thread reads each chunk via the file handler and stores it in
+    one of `nr_prefetch + 2` rotating slots, so that at most `nr_prefetch`
+    chunks are waiting while one is being inferred and another is being read.
+    Chunks are yielded in the same order as `chunk_job_list`, along with the
+    handle of the slot holding them (a cache file path or a `SharedArray`).
+
+    Args:
+        read_func: function taking a job and returning the chunk image, or
+                   `None` if there is nothing to read for that job
+        chunk_job_list: list of jobs, one per chunk
+        cache_path: directory to store the cached chunks
+        nr_prefetch: number of chunks to read ahead, 0 to read in the main thread
+        chunk_pool: `SharedArrayPool` with at least `nr_prefetch + 2` slots, `None`
+                    to store the chunks as files within `cache_path`
+
+    """
+
+    def __init__(
+        self, read_func, chunk_job_list, cache_path, nr_prefetch=1, chunk_pool=None
+    ):
+        self.read_func = read_func
+        self.chunk_job_list = chunk_job_list
+        self.cache_path = cache_path
+        self.nr_prefetch = nr_prefetch
+        self.nr_slots = nr_prefetch + 2
+        self.chunk_pool = chunk_pool
+
+        self.stop_event = threading.Event()
+        self.job_queue = queue.Queue(maxsize=max(nr_prefetch, 1))
+        return
+
+    def _read_job(self, job_idx):
+        job = self.chunk_job_list[job_idx]
+        chunk_data = self.read_func(job)
+        if chunk_data is None:
+            return job, None
+        slot_idx = job_idx % self.nr_slots
+        with trace_span("save chunk", "io", chunk=job_idx):
+            if self.chunk_pool is not None:
+                return job, self.chunk_pool.put(slot_idx, chunk_data)
+            slot_path = "%s/cache_chunk_%d.npy" % (self.cache_path, slot_idx)
+            np.save(slot_path, chunk_data)
+        return job, slot_path
+
+    def _put(self, item):
+        # ! dont block forever if the consumer crashed
+        while not self.stop_event.is_set():
+            try:
+                self.job_queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_reader(self):
+        try:
+            for job_idx in range(len(self.chunk_job_list)):
+                if not self._put(self._read_job(job_idx)):
+                    return
+        except Exception as exception:
+            self._put(exception)
+        return
+
+    def __iter__(self):
+        if self.nr_prefetch == 0:
+            for job_idx in range(len(self.chunk_job_list)):
+                yield self._read_job(job_idx)
+            return
+
+        reader = threading.Thread(target=self._run_reader, daemon=True)
+        reader.start()
+        try:
+            for _ in range(len(self.chunk_job_list)):
+                item = self.job_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop_event.set()
+            reader.join()
+        return
+
+
+####
+def _get_overlap(bbox, bbox_list):
+    """Flag the boxes within `bbox_list` overlapping `bbox`, all as [[tl], [br]]."""
+    return np.all((bbox_list[:, 0] < bbox[1]) & (bbox[0] < bbox_list[:, 1]), axis=-1)
+
+
+####
+def _get_tile_colour(tile_info_list):
+    """Greedy colouring of tiles such that overlapping tiles have different colours.
+
+    Tiles sharing a colour are disjoint and can be stitched concurrently, the
+    colours follow the tile ordering (i.e the first tile has colour 0 and so on).
+
+    Args:
+        tile_info_list: Nx2x2 array of tiles [[top_left], [bot_right]]
+
+    Returns:
+        array of N colours
+
+    """
+    colour_list = np.full(tile_info_list.shape[0], -1, dtype=np.int64)
+    for idx in range(tile_info_list.shape[0]):
+        overlap = _get_overlap(tile_info_list[idx], tile_info_list[:idx])
+        used_colour_list = np.unique(colour_list[:idx][overlap])
+        colour = 0
+        while colour < len(used_colour_list) and used_colour_list[colour] == colour:
+            colour += 1
+        colour_list[idx] = colour
+    return colour_list
+
+
+####
+class _PostProcScheduler(object):
+    """Dispatch the post processing of tiles as soon as their input is ready, so
+    that it overlaps with the inference of the remaining chunks.
+
+    The tiles of all phases are scheduled at once. A tile is post processed once
+    every chunk whose output overlaps it has been written into the prediction
+    map (see `release_chunk`). Its result is then merged by the callback of its
+    phase, within the main thread, once every overlapping tile that precedes it
+    has been merged. Tiles are ordered by phase then by colour within a phase
+    (see `_get_tile_colour`), so that the merging of each region happens in the
+    same order as when running the phases and colours one after another.
+
+    A callback either merges the tile itself and returns `None`, or delegates
+    the merging to a worker and returns `(future, on_done)`, `on_done` being
+    then called within the main thread with the result of the future.
+
+    Args:
+        phase_list: list of `(tile_info_list, callback)`, in running order
+        chunk_output_list: Nx2x2 output boxes of the inference chunks
+        compute_func: function taking `(idx, tile_tl, tile_br)` and returning the
+                      args of the callback, must be picklable if `proc_pool` is used
+        proc_pool: `ProcessPoolExecutor` to post process the tiles, `None` to
+                   post process within the main thread upon polling
+        merged_tile_list: indices of the tiles (in running order) already merged
+                          by a previous run, they are neither computed nor merged
+
+    """
+
+    def __init__(
+        self,
+        phase_list,
+        chunk_output_list,
+        compute_func,
+        proc_pool=None,
+        merged_tile_list=None,
+    ):
+        self.compute_func = compute_func
+        self.proc_pool = proc_pool
+
+        # * flatten all tiles in running order, (tile_info, callback) each
+        self.tile_list = []
+        self.tile_phase_list = []
+        for phase_idx, (tile_info_list, callback) in enumerate(phase_list):
+            colour_list = _get_tile_colour(tile_info_list)
+            for idx in np.argsort(colour_list, kind="stable"):
+                tile_info = (idx, tile_info_list[idx][0], tile_info_list[idx][1])
+                self.tile_list.append((tile_info, callback))
+                self.tile_phase_list.append(phase_idx)
+        self.nr_phases = len(phase_list)
+        self.tile_phase_list = np.array(self.tile_phase_list, dtype=np.int64)
+        nr_tiles = len(self.tile_list)
+        tile_bbox_list = np.array([v[0][1:] for v in self.tile_list])
+        tile_bbox_list = tile_bbox_list.reshape(-1, 2, 2)
+
+        # * for each chunk, the tiles waiting for its output
+        self.chunk_wait_count = np.zeros(nr_tiles, dtype=np.int64)
+        self.chunk_dependent_list = []
+        for chunk_bbox in chunk_output_list:
+            dependent_list = np.nonzero(_get_overlap(chunk_bbox, tile_bbox_list))[0]
+            self.chunk_wait_count[dependent_list] += 1
+            self.chunk_dependent_list.append(dependent_list)
+
+        # * for each tile, the subsequent overlapping tiles waiting for its merging
+        self.merge_wait_count = np.zeros(nr_tiles, dtype=np.int64)
+        self.merge_dependent_list = []
+        for idx in range(nr_tiles):
+            overlap = _get_overlap(tile_bbox_list[idx], tile_bbox_list[idx + 1 :])
+            dependent_list = np.nonzero(overlap)[0] + idx + 1
+            self.merge_wait_count[dependent_list] += 1
+            self.merge_dependent_list.append(dependent_list)
+
+        self.pbar = None
+        self.nr_merged = 0
+        self.silent_crash = False
+        self.future_dict = {}  # future => tile idx
+        self.merge_future_dict = {}  # future => (tile idx, on_done)
+        self.compute_list = []  # tile idx, to post process within main thread
+        self.result_dict = {}  # tile idx => results, waiting to be merged
+        self.merged = np.zeros(nr_tiles, dtype=bool)
+        self.merged_log = []  # tile idx merged since the last `pop_merged_log`
+        if merged_tile_list is not None:
+            for idx in merged_tile_list:
+                self.merged[idx] = True
+                self.nr_merged += 1
+                self.merge_wait_count[self.merge_dependent_list[idx]] -= 1
+        for idx in np.nonzero(self.chunk_wait_count == 0)[0]:
+            self.__submit(idx)
+        return
+
+    def __len__(self):
+        return len(self.tile_list)
+
+    def __submit(self, idx):
+        if self.merged[idx]:
+            return
+        tile_info = self.tile_list[idx][0]
+        if self.proc_pool is None:
+            self.compute_list.append(idx)
+            return
+        # ! manually poll future and call callback later as there is no guarantee
+        # ! that the callback is called from main thread
+        future = self.proc_pool.submit(self.compute_func, tile_info)
+        self.future_dict[future] = idx
+        return
+
+    def __merge(self, idx, results):
+        """Merge the results of a tile then those of its dependents that are ready."""
+        stack = [(idx, results)]
+        while len(stack) > 0:
+            idx, results = stack.pop()
+            with trace_span("stitch tile", "post_proc", tile=int(idx)):
+                output = self.tile_list[idx][1](results)
+            if output is not None:
+                future, on_done = output
+                self.merge_future_dict[future] = (idx, on_done)
+                continue
+            stack.extend(self.__on_merged(idx))
+        return
+
+    def __on_merged(self, idx):
+        """Mark a tile as merged and return its dependents that are now ready."""
+        self.nr_merged += 1
+        self.merged[idx] = True
+        self.merged_log.append(idx)
+        if self.pbar is not None:
+            self.pbar.update()
+        ready_list = []
+        for dependent_idx in self.merge_dependent_list[idx]:
+            self.merge_wait_count[dependent_idx] -= 1
+            if self.merge_wait_count[dependent_idx] > 0:
+                continue
+            if dependent_idx in self.result_dict:
+                ready_list.append((dependent_idx, self.result_dict.pop(dependent_idx)))
+        return ready_list
+
+    def __on_computed(self, idx, results):
+        if self.merge_wait_count[idx] > 0:
+            self.result_dict[idx] = results
+        else:
+            self.__merge(idx, results)
+        return
+
+    def release_chunk(self, chunk_idx):
+        """Mark the output of a chunk as written into the prediction map."""
+        for idx in self.chunk_dependent_list[chunk_idx]:
+            self.chunk_wait_count[idx] -= 1
+            if self.chunk_wait_count[idx] == 0:
+                self.__submit(idx)
+        return
+
+    def __nr_in_flight(self):
+        return (
+            len(self.future_dict) + len(self.merge_future_dict) + len(self.compute_list)
         )
 
-        dataloader = data.DataLoader(
-            dataset,
-            num_workers=self.nr_inference_workers,
-            batch_size=self.batch_size,
-            drop_last=False,
+    def poll(self, block=False):
+        """Merge the tiles whose post processing is done.
+
+        Args:
+            block: wait until at least one tile is done if there is any in flight
+
+        """
+        while len(self.compute_list) > 0:
+            idx = self.compute_list.pop(0)
+            self.__on_computed(idx, self.compute_func(self.tile_list[idx][0]))
+
+        future_list = list(self.future_dict.keys())
+        future_list += list(self.merge_future_dict.keys())
+        if len(future_list) == 0:
+            return
+        if block:
+            done_list, _ = wait(future_list, return_when=FIRST_COMPLETED)
+        else:
+            done_list = [v for v in future_list if v.done()]
+        for future in done_list:
+            # ! silent crash, poll all remaining then crash, cancelling
+            # ! somehow leads to cascade error later
+            if future.exception() is not None:
+                log_info("Post processing crashed: %s" % future.exception())
+                self.silent_crash = True
+                self.future_dict.pop(future, None)
+                self.merge_future_dict.pop(future, None)
+                continue
+            if future in self.future_dict:
+                idx = self.future_dict.pop(future)
+                self.__on_computed(idx, future.result())
+                continue
+            idx, on_done = self.merge_future_dict.pop(future)
+            with trace_span("stitch tile info", "post_proc", tile=int(idx)):
+                on_done(future.result())
+            for dependent_idx, results in self.__on_merged(idx):
+                self.__merge(dependent_idx, results)
+        return
+
+    def get_nr_tiles_per_phase(self):
+        """Get the number of tiles merged and in total, for each phase."""
+        nr_merged = np.bincount(
+            self.tile_phase_list[self.merged], minlength=self.nr_phases
         )
+        nr_total = np.bincount(self.tile_phase_list, minlength=self.nr_phases)
+        return nr_merged, nr_total
+
+    def pop_merged_log(self):
+        """Get the indices of the tiles merged since the previous call."""
+        merged_log, self.merged_log = self.merged_log, []
+        return merged_log
+
+    def finish(self, pbar=None, checkpoint_func=None, checkpoint_interval=60.0):
+        """Wait for all tiles to be post processed and merged.
+
+        Args:
+            pbar: progress bar updated for each merged tile
+            checkpoint_func: function called every `checkpoint_interval` seconds
+                             while waiting
+
+        """
+        self.pbar = pbar
+        if pbar is not None:
+            pbar.update(self.nr_merged)
+        last_checkpoint = time.perf_counter()
+        while self.__nr_in_flight() > 0:
+            self.poll(block=True)
+            if checkpoint_func is None:
+                continue
+            if time.perf_counter() - last_checkpoint > checkpoint_interval:
+                checkpoint_func()
+                last_checkpoint = time.perf_counter()
+        assert not self.silent_crash
+        assert self.nr_merged == len(self), "Some tiles have never been merged."
+        return
+
+
+####
+class _SlideState(object):
+    """Holders of a slide that are needed until its output is saved.
+
+    The post processing of a slide may still run after its inference, while
+    the next slide is inferred, hence what it touches is kept per slide here
+    rather than within the `InferManager`.
+
+    Args:
+        wsi_name: name of the slide
+        cache_path: cache directory of the slide, removed once it is saved
+        json_path: path of the output json
+        sparse_cache: whether the prediction holders are `BlockArray`
+
+    The holders are opened by the workers via `pred_map_ref` and `inst_map_ref`,
+    their path within `cache_path`, or their `SharedArray` when kept in RAM.
+
+    """
+
+    def __init__(self, wsi_name, cache_path, json_path, sparse_cache=False):
+        self.wsi_name = wsi_name
+        self.cache_path = cache_path
+        self.json_path = json_path
+        holder_ext = "blk" if sparse_cache else "npy"
+        self.pred_map_path = "%s/pred_map.%s" % (cache_path, holder_ext)
+        self.inst_map_path = "%s/pred_inst.%s" % (cache_path, holder_ext)
+        self.pred_map_ref = self.pred_map_path
+        self.inst_map_ref = self.inst_map_path
+        self.shared_holder_list = []  # owned, released along with the slide
+        self.nr_chunks = 0
+        self.nr_chunks_done = 0
+        self.journal = None
+        self.inst_info = None
+        self.inst_map = None
+        self.post_proc_scheduler = None
+
+        # * region of each fixing tile is saved before merging when journaling
+        self.undo_dir = "%s/undo/" % cache_path
+        self.undo_path_dict = {}
+        self.undo_seq = 0
+        return
+
+    def get_undo_path(self, tile_tl, tile_br):
+        if self.journal is None:
+            return None
+        tile_bbox = tuple(int(v) for v in tile_tl) + tuple(int(v) for v in tile_br)
+        undo_name = "%08d_%d_%d_%d_%d.npy" % ((self.undo_seq,) + tile_bbox)
+        undo_path = "%s/%s" % (self.undo_dir, undo_name)
+        self.undo_seq += 1
+        self.undo_path_dict[(tuple(tile_tl), tuple(tile_br))] = undo_path
+        return undo_path
+
+    def release_holders(self):
+        """Drop the prediction holders, freeing those kept in RAM."""
+        self.inst_map = None
+        self.pred_map_ref = self.pred_map_path
+        self.inst_map_ref = self.inst_map_path
+        for shared_holder in self.shared_holder_list:
+            shared_holder.unlink()
+        self.shared_holder_list = []
+        return
+
+
+####
+class InferManager(base.InferManager):
+    def __get_patch_feeder(self):
+        """Get the patch feeding workers, spawned once and kept for the whole run."""
+        if getattr(self, "patch_feeder", None) is None:
+            self.patch_feeder = PatchFeeder(
+                self.nr_inference_workers,
+                self.batch_size,
+                self.patch_input_shape,
+                trace_dir=get_trace_dir(),
+            )
+            if self.nr_inference_workers > 0:
+                log_info(
+                    "Patch Feeder Startup ({0} workers): {1}".format(
+                        self.nr_inference_workers, self.patch_feeder.startup_time
+                    )
+                )
+        return self.patch_feeder
+
+    def __close_patch_feeder(self):
+        if getattr(self, "patch_feeder", None) is not None:
+            self.patch_feeder.close()
+            self.patch_feeder = None
+        return
+
+    def __create_proc_pool(self):
+        """Spawn the post processing workers."""
+        return ProcessPoolExecutor(self.nr_post_proc_workers)
+
+    def __close_proc_pool(self):
+        if getattr(self, "proc_pool", None) is not None:
+            self.proc_pool.shutdown()
+        self.proc_pool = None
+        return
+
+    def __run_model(self, chunk_handle, chunk_info, patch_top_left_list, pbar_desc):
+        patch_feeder = self.__get_patch_feeder()
 
         pbar = tqdm.tqdm(
             desc=pbar_desc,
             leave=True,
-            total=int(len(dataloader)),
+            total=patch_feeder.nr_batches(patch_top_left_list),
             ncols=80,
             ascii=True,
             position=0,
         )
 
-        # run inference on input patches
-        accumulated_patch_output = []
-        for batch_idx, batch_data in enumerate(dataloader):
-            sample_data_list, sample_info_list = batch_data
-            sample_output_list = self.run_step(sample_data_list)
-            sample_info_list = sample_info_list.numpy()
-            curr_batch_size = sample_output_list.shape[0]
-            sample_output_list = np.split(sample_output_list, curr_batch_size, axis=0)
-            sample_info_list = np.split(sample_info_list, curr_batch_size, axis=0)
-            sample_output_list = list(zip(sample_info_list, sample_output_list))
-            accumulated_patch_output.extend(sample_output_list)
-            pbar.update()
-        pbar.close()
-        return accumulated_patch_output
+        # run inference on input patches and write the output of each batch
+        # into the wsi holder as soon as it is available
+        # * within a background thread, so that the next batch is fed to the
+        # * model meanwhile, at most 2 batches waiting to be written
+        writer = ThreadPoolExecutor(1)
+        future_list = []
+        try:
+            for batch_data in patch_feeder.run(chunk_handle, patch_top_left_list):
+                sample_data_list, sample_info_list = batch_data
+                with trace_span("model batch", "model"):
+                    sample_output_list = self.run_step(sample_data_list)
+                while len(future_list) >= 2:
+                    future_list.pop(0).result()
+                future = writer.submit(
+                    self.__write_batch,
+                    chunk_info[1][0],
+                    np.array(sample_info_list),  # the batch may be reused
+                    sample_output_list,
+                )
+                future_list.append(future)
+                pbar.update()
+            for future in future_list:
+                future.result()
+        finally:
+            writer.shutdown()
+            pbar.close()
+        return
+
+    def __write_batch(self, chunk_output_tl, sample_info_list, sample_output_list):
+        """Encode then write the output of a batch into the wsi holder."""
+        with trace_span("flush batch", "io"):
+            sample_output_list = _encode_pred_map(
+                sample_output_list,
+                self.pred_map_dtype,
+                self.method["model_args"]["nr_types"],
+            )
+            _assemble_batch(
+                self.wsi_pred_map,
+                chunk_output_tl,
+                sample_info_list,
+                sample_output_list,
+            )
+        self.nr_patches_done += sample_info_list.shape[0]
+        return
 
     def __select_valid_patches(self, patch_info_list, has_output_info=True):
         """Select valid patches from the list of input patch information.
@@ -305,42 +1058,40 @@ class InferManager(base.InferManager):
             has_output_info: whether output information is given
         
         """
-        down_sample_ratio = self.wsi_mask.shape[0] / self.wsi_proc_shape[0]
-        selected_indices = []
-        for idx in range(patch_info_list.shape[0]):
-            patch_info = patch_info_list[idx]
-            patch_info = np.squeeze(patch_info)
-            # get the box at corresponding mag of the mask
-            if has_output_info:
-                output_bbox = patch_info[1] * down_sample_ratio
-            else:
-                output_bbox = patch_info * down_sample_ratio
-            output_bbox = np.rint(output_bbox).astype(np.int64)
-            # coord of the output of the patch (i.e center regions)
-            output_roi = self.wsi_mask[
-                output_bbox[0][0] : output_bbox[1][0],
-                output_bbox[0][1] : output_bbox[1][1],
-            ]
-            if np.sum(output_roi) > 0:
-                selected_indices.append(idx)
-        sub_patch_info_list = patch_info_list[selected_indices]
+        # coord of the output of the patch (i.e center regions)
+        if has_output_info:
+            output_bbox_list = patch_info_list[:, 1]
+        else:
+            output_bbox_list = patch_info_list
+        selection = self.wsi_mask_index.has_tissue(output_bbox_list)
+        sub_patch_info_list = patch_info_list[selection]
         return sub_patch_info_list
 
-    def __get_raw_prediction(self, chunk_info_list, patch_info_list):
+    def __get_raw_prediction(self, chunk_info_list, patch_info_list, slide):
         """Process input tiles (called chunks for inference) with HoVer-Net.
 
         Args:
             chunk_info_list: list of inference tile coordinate information
             patch_info_list: list of patch coordinate information
+            slide: `_SlideState` of the slide, its post processing scheduler is
+                   notified once the output of each chunk is written, so that
+                   the post processing of ready tiles overlaps inference
         
         """
-        # 1 dedicated thread just to write results back to disk
-        proc_pool = Pool(processes=1)
-        wsi_pred_map_mmap_path = "%s/pred_map.npy" % self.cache_path
-
         masking = lambda x, a, b: (a <= x) & (x <= b)
-        for idx in range(0, chunk_info_list.shape[0]):
-            chunk_info = chunk_info_list[idx]
+        post_proc_scheduler = slide.post_proc_scheduler
+
+        # chunks whose output is already within the prediction map of a previous run
+        flushed_chunk_set = set()
+        if slide.journal is not None:
+            flushed_chunk_set = set(slide.journal.chunk_list)
+
+        def read_chunk(chunk_job):
+            """Select the patches of a chunk then read it, done ahead of inference."""
+            idx, chunk_info = chunk_job
+            if idx in flushed_chunk_set:
+                chunk_patch_info_list_dict[idx] = None
+                return None
             # select patch basing on top left coordinate of input
             start_coord = chunk_info[0, 0]
             end_coord = chunk_info[0, 1] - self.patch_input_shape
@@ -353,107 +1104,389 @@ class InferManager(base.InferManager):
 
             # further select only the patches within the provided mask
             chunk_patch_info_list = self.__select_valid_patches(chunk_patch_info_list)
+            chunk_patch_info_list_dict[idx] = chunk_patch_info_list
 
-            # there no valid patches, so flush 0 and skip
+            # there no valid patches, nothing to read
             if chunk_patch_info_list.shape[0] == 0:
-                proc_pool.apply_async(
-                    _assemble_and_flush, args=(wsi_pred_map_mmap_path, chunk_info, None)
+                return None
+
+            with trace_span("read chunk", "io", chunk=int(idx)):
+                chunk_data = self.wsi_handler.read_region(
+                    chunk_info[0][0][::-1], (chunk_info[0][1] - chunk_info[0][0])[::-1]
+                )
+                chunk_data = np.array(chunk_data)[..., :3]
+            return chunk_data
+
+        chunk_pool = None
+        if self.chunk_transport == "shm":
+            nr_slots = self.chunk_prefetch + 2
+            chunk_shape = chunk_info_list[:, 0, 1] - chunk_info_list[:, 0, 0]
+            chunk_shape = tuple(np.max(chunk_shape, axis=0)) + (3,)
+            if shared_memory_available(nr_slots * np.prod(chunk_shape)):
+                chunk_pool = SharedArrayPool(nr_slots, chunk_shape, np.uint8)
+            else:
+                log_info(
+                    "WARNING: Not enough shared memory for chunks, using `cache_path`!"
                 )
-                continue
 
-            # shift the coordinare from wrt slide to wrt chunk
-            chunk_patch_info_list -= chunk_info[:, 0]
-            chunk_data = self.wsi_handler.read_region(
-                chunk_info[0][0][::-1], (chunk_info[0][1] - chunk_info[0][0])[::-1]
-            )
-            chunk_data = np.array(chunk_data)[..., :3]
-            np.save("%s/cache_chunk.npy" % self.cache_path, chunk_data)
+        chunk_patch_info_list_dict = {}
+        chunk_job_list = list(enumerate(chunk_info_list))
+        slide.nr_chunks = len(chunk_job_list)
+        slide.nr_chunks_done = len(flushed_chunk_set)
+        chunk_prefetcher = _ChunkPrefetcher(
+            read_chunk,
+            chunk_job_list,
+            slide.cache_path,
+            self.chunk_prefetch,
+            chunk_pool,
+        )
+        try:
+            for chunk_job, chunk_handle in chunk_prefetcher:
+                idx, chunk_info = chunk_job
+                chunk_patch_info_list = chunk_patch_info_list_dict.pop(idx)
+
+                # there no valid patches, so skip the inference
+                if chunk_handle is not None:
+                    # shift the coordinare from wrt slide to wrt chunk
+                    chunk_patch_info_list -= chunk_info[:, 0]
+
+                    pbar_desc = "Process Chunk %d/%d" % (idx, chunk_info_list.shape[0])
+                    self.__run_model(
+                        chunk_handle,
+                        chunk_info,
+                        chunk_patch_info_list[:, 0, 0],
+                        pbar_desc,
+                    )
+                    if slide.journal is not None:
+                        with trace_span("flush pred map", "io", chunk=int(idx)):
+                            self.wsi_pred_map.flush()
+                            slide.journal.log_chunk(idx)
+
+                if idx not in flushed_chunk_set:
+                    slide.nr_chunks_done += 1
+                if post_proc_scheduler is not None:
+                    post_proc_scheduler.release_chunk(idx)
+                    post_proc_scheduler.poll()
+                    self.__checkpoint(slide)
+        finally:
+            if chunk_pool is not None:
+                chunk_pool.close()
+        return
+
+    def __open_holder(self, path, mode, shape, dtype, block_mask=None):
+        """Open a prediction holder of the wsi, a `BlockArray` if `block_mask` is given."""
+        if block_mask is None:
+            return np.lib.format.open_memmap(path, mode=mode, shape=shape, dtype=dtype)
+        if mode == "r+":
+            return BlockArray(path, mode=mode)
+        return BlockArray(path, mode, shape, dtype, _CACHE_BLOCK_SHAPE, block_mask)
 
-            pbar_desc = "Process Chunk %d/%d" % (idx, chunk_info_list.shape[0])
-            patch_output_list = self.__run_model(
-                chunk_patch_info_list[:, 0, 0], pbar_desc
+    def __use_ram_cache(self, holder_nbytes):
+        """Whether to keep the prediction holders of the slide within shared memory.
+
+        With 'auto', the holders are kept in RAM if they fit within `mem_usage`
+        of the available memory and within the shared memory file system, and
+        on disk when resuming or with a sparse cache.
+        """
+        if self.cache_mode == "mmap":
+            return False
+        if self.cache_mode == "ram":
+            assert shared_memory_available(holder_nbytes), (
+                "Not enough shared memory for the holders (%.1fGB), "
+                "use `cache_mode=mmap`" % (holder_nbytes / 2 ** 30)
             )
+            return True
+        # * resuming needs the holders to be on disk, and only the holders on
+        # * disk are sparse
+        if self.resume or self.sparse_cache:
+            return False
+        available_ram = getattr(psutil.virtual_memory(), "available")
+        mem_budget = int(available_ram * self.mem_usage)
+        if holder_nbytes > mem_budget:
+            return False
+        return shared_memory_available(holder_nbytes)
+
+    def __get_mask_cache_path(self, wsi_path):
+        """Get the path of the cached tissue mask generated for the slide.
+
+        The mask is kept within `cache_path` across runs, keyed on the path,
+        size and modification time of the slide.
+        """
+        wsi_stat = os.stat(wsi_path)
+        mask_key = "%s|%d|%d" % (
+            os.path.abspath(wsi_path),
+            wsi_stat.st_size,
+            wsi_stat.st_mtime_ns,
+        )
+        mask_key = hashlib.md5(mask_key.encode()).hexdigest()[:16]
+        wsi_name = pathlib.Path(wsi_path).stem
+        mask_cache_dir = "%s/tissue_mask/" % self.cache_path
+        os.makedirs(mask_cache_dir, exist_ok=True)
+        return "%s/%s_%s.png" % (mask_cache_dir, wsi_name, mask_key)
+
+    def __get_journal(self, wsi_path, slide):
+        """Open the progress journal of the slide within its cache directory.
 
-            proc_pool.apply_async(
-                _assemble_and_flush,
-                args=(wsi_pred_map_mmap_path, chunk_info, patch_output_list),
+        The journal is only resumed if it has been written for the same slide,
+        mask and settings, and if the cached prediction holders still exist.
+        """
+        journal_path = "%s/journal.pkl" % slide.cache_path
+        signature = {
+            "wsi_path": os.path.abspath(wsi_path),
+            "wsi_proc_shape": tuple(int(v) for v in self.wsi_proc_shape),
+            "mask": hashlib.md5(np.ascontiguousarray(self.wsi_mask)).hexdigest(),
+            "method": self.method,
+            "proc_mag": self.proc_mag,
+            "ambiguous_size": self.ambiguous_size,
+            "chunk_shape": list(self.chunk_shape),
+            "tile_shape": list(self.tile_shape),
+            "patch_input_shape": list(self.patch_input_shape),
+            "patch_output_shape": list(self.patch_output_shape),
+            "pred_map_dtype": self.pred_map_dtype,
+            "sparse_cache": self.sparse_cache,
+        }
+        for cache_file in [slide.pred_map_path, slide.inst_map_path]:
+            if not os.path.exists(cache_file) and os.path.exists(journal_path):
+                os.remove(journal_path)
+        return ProgressJournal(journal_path, signature)
+
+    def __checkpoint(self, slide):
+        """Make the tiles merged since the previous checkpoint durable in the journal."""
+        if slide.journal is None:
+            return
+        post_proc_scheduler = slide.post_proc_scheduler
+        merged_tile_list = post_proc_scheduler.pop_merged_log()
+        if len(merged_tile_list) == 0:
+            return
+        # ! the instance map must be on disk before the commit is recorded
+        with trace_span("checkpoint", "io", nr_tiles=len(merged_tile_list)):
+            slide.inst_map.flush()
+            slide.journal.log_commit(
+                merged_tile_list,
+                slide.inst_info.pop_change_log(),
+                slide.inst_info.max_id,
             )
-        proc_pool.close()
-        proc_pool.join()
+        for idx in merged_tile_list:
+            _, tile_tl, tile_br = post_proc_scheduler.tile_list[idx][0]
+            undo_path = slide.undo_path_dict.pop((tuple(tile_tl), tuple(tile_br)), None)
+            if undo_path is not None:
+                os.remove(undo_path)
         return
 
-    def __dispatch_post_processing(self, tile_info_list, callback):
-        """Post processing initialisation."""
-        proc_pool = None
-        if self.nr_post_proc_workers > 0:
-            proc_pool = ProcessPoolExecutor(self.nr_post_proc_workers)
+    def __rollback_merges(self, slide):
+        """Undo the merging of tiles that were not committed by the previous run.
 
-        future_list = []
-        wsi_pred_map_mmap_path = "%s/pred_map.npy" % self.cache_path
-        for idx in list(range(tile_info_list.shape[0])):
-            tile_tl = tile_info_list[idx][0]
-            tile_br = tile_info_list[idx][1]
-
-            tile_info = (idx, tile_tl, tile_br)
-            func_kwargs = {
-                "nr_types": self.method["model_args"]["nr_types"],
-                "return_centroids": True,
-            }
-
-            # TODO: standarize protocol
-            if proc_pool is not None:
-                proc_future = proc_pool.submit(
-                    _post_proc_para_wrapper,
-                    wsi_pred_map_mmap_path,
-                    tile_info,
-                    self.post_proc_func,
-                    func_kwargs,
-                )
-                # ! manually poll future and call callback later as there is no guarantee
-                # ! that the callback is called from main thread
-                future_list.append(proc_future)
-            else:
-                results = _post_proc_para_wrapper(
-                    wsi_pred_map_mmap_path, tile_info, self.post_proc_func, func_kwargs
-                )
-                callback(results)
-        if proc_pool is not None:
-            silent_crash = False
-            # loop over all to check state a.k.a polling
-            for future in as_completed(future_list):
-                # ! silent crash, cancel all and raise error
-                if future.exception() is not None:
-                    silent_crash = True
-                    # ! cancel somehow leads to cascade error later
-                    # ! so just poll it then crash once all future
-                    # ! acquired for now
-                    # for future in future_list:
-                    #     future.cancel()
-                    # break
-                else:
-                    callback(future.result())
-            assert not silent_crash
+        Regions are restored from the latest to the earliest merging, so that
+        the instance map returns to its state as of the last commit.
+        """
+        post_proc_scheduler = slide.post_proc_scheduler
+        merged_bbox_set = set()
+        for idx in np.nonzero(post_proc_scheduler.merged)[0]:
+            _, tile_tl, tile_br = post_proc_scheduler.tile_list[idx][0]
+            merged_bbox_set.add(tuple(tile_tl) + tuple(tile_br))
+        undo_path_list = glob.glob("%s/*.npy" % slide.undo_dir)
+        undo_path_list.sort(reverse=True)  # latest first
+        for undo_path in undo_path_list:
+            undo_info = pathlib.Path(undo_path).stem.split("_")
+            tile_bbox = tuple(int(v) for v in undo_info[1:])
+            if tile_bbox in merged_bbox_set:
+                continue  # the commit happened before removing the file
+            slide.inst_map[
+                tile_bbox[0] : tile_bbox[2], tile_bbox[1] : tile_bbox[3]
+            ] = np.load(undo_path)
+        slide.inst_map.flush()
+        return
+
+    def __open_trace(self):
+        """Enable the tracer if `trace_path` is given, return whether it is now enabled."""
+        if self.trace_path in [None, ""] or get_trace_dir() is not None:
+            return False
+        # * the cache may be shared by several nodes when claiming slides
+        self.trace_dir = "%s/trace_%s_%d/" % (
+            self.cache_path,
+            socket.gethostname(),
+            os.getpid(),
+        )
+        rm_n_mkdir(self.trace_dir)
+        init_tracer(self.trace_dir, "main")
+        return True
+
+    def __save_trace(self):
+        """Disable the tracer and merge the spans of all processes into `trace_path`."""
+        close_tracer()
+        save_trace(self.trace_dir, self.trace_path)
+        shutil.rmtree(self.trace_dir)
+        log_info("Trace: %s" % self.trace_path)
+        return
+
+    def __collect_metrics(self):
+        """Get the progress of the run, called by the `MetricsWriter` thread."""
+        with self.metrics_lock:
+            slide_list = list(self.active_slide_dict.values())
+            nr_chunks_done = self.nr_chunks_done
+            nr_chunks_total = self.nr_chunks_total
+            nr_tiles_done = self.nr_tiles_done.copy()
+            nr_tiles_total = self.nr_tiles_total.copy()
+            nr_nuclei = self.nr_nuclei_done
+        cache_bytes, cache_ram_bytes = 0, 0
+        for slide in slide_list:
+            nr_chunks_done += slide.nr_chunks_done
+            nr_chunks_total += slide.nr_chunks
+            if slide.post_proc_scheduler is not None:
+                nr_done, nr_total = slide.post_proc_scheduler.get_nr_tiles_per_phase()
+                nr_tiles_done += nr_done
+                nr_tiles_total += nr_total
+            if slide.inst_info is not None:
+                nr_nuclei += len(slide.inst_info)
+            cache_bytes += get_disk_usage(slide.cache_path)
+            for shared_holder in slide.shared_holder_list:
+                holder_nbytes = np.prod(shared_holder.shape)
+                cache_ram_bytes += holder_nbytes * shared_holder.dtype.itemsize
+        phase_name_list = ["grid", "boundary", "cross"]
+        nr_tiles_done = ("phase", dict(zip(phase_name_list, nr_tiles_done)))
+        nr_tiles_total = ("phase", dict(zip(phase_name_list, nr_tiles_total)))
+        return [
+            ("slides_total", self.nr_slides_total),
+            ("slides_done", self.nr_slides_done),
+            ("slides_skipped", self.nr_slides_skipped),
+            ("slides_failed", self.nr_slides_failed),
+            ("slides_in_flight", len(slide_list)),
+            ("chunks_done", nr_chunks_done),
+            ("chunks_total", nr_chunks_total),
+            ("patches_done", self.nr_patches_done),
+            ("post_proc_tiles_done", nr_tiles_done),
+            ("post_proc_tiles_total", nr_tiles_total),
+            ("nuclei_found", nr_nuclei),
+            ("cache_bytes", cache_bytes),
+            ("cache_ram_bytes", cache_ram_bytes),
+        ]
+
+    def __open_metrics(self, nr_slides):
+        """Start writing the progress of the run into `output_dir`, if enabled."""
+        self.nr_slides_total = nr_slides
+        self.nr_slides_done = 0
+        self.nr_slides_skipped = 0  # already done or without tissue
+        self.nr_slides_failed = 0
+        self.nr_nuclei_done = 0
+        self.nr_patches_done = 0
+        # * the chunks and tiles of the slides no longer in flight
+        self.nr_chunks_done = 0
+        self.nr_chunks_total = 0
+        self.nr_tiles_done = np.zeros(3, dtype=np.int64)  # per phase
+        self.nr_tiles_total = np.zeros(3, dtype=np.int64)
+        self.active_slide_dict = {}  # name => `_SlideState` of the slides in flight
+        self.metrics_lock = threading.Lock()
+        if self.metrics_interval <= 0:
+            return None
+        metrics_ext = "prom" if self.metrics_format == "prometheus" else "json"
+        metrics_name = "metrics"
+        # * the output directory is shared by several nodes when claiming slides
+        if self.claim_slides:
+            metrics_name = "metrics_%s_%d" % (socket.gethostname(), os.getpid())
+        metrics_path = "%s/%s.%s" % (self.output_dir, metrics_name, metrics_ext)
+        return MetricsWriter(
+            metrics_path,
+            self.__collect_metrics,
+            self.metrics_interval,
+            rate_name_list=["patches_done"],
+        )
+
+    def __retire_slide(self, wsi_name, done=False):
+        """Move the progress of a slide no longer in flight to the run totals."""
+        with self.metrics_lock:
+            slide = self.active_slide_dict.pop(wsi_name, None)
+            if slide is None:
+                return
+            self.nr_chunks_done += slide.nr_chunks_done
+            self.nr_chunks_total += slide.nr_chunks
+            if slide.post_proc_scheduler is not None:
+                nr_done, nr_total = slide.post_proc_scheduler.get_nr_tiles_per_phase()
+                self.nr_tiles_done += nr_done
+                self.nr_tiles_total += nr_total
+            if done:
+                self.nr_nuclei_done += len(slide.inst_info)
+        return
+
+    def __plan_shapes(self):
+        """Replace the chunk and tile shapes set to 'auto' with planned ones."""
+        assert self.mem_usage < 1.0 and self.mem_usage > 0.0
+        available_ram = getattr(psutil.virtual_memory(), "available")
+        mem_budget = int(available_ram * self.mem_usage)
+        if self.tile_cache_size != "auto":  # else only holds the chunk overlaps
+            mem_budget -= int(self.tile_cache_size * 2 ** 20)  # held by the reader
+        out_ch = 3 if self.method["model_args"]["nr_types"] is None else 4
+        chunk_shape, tile_shape, mem_usage = _plan_chunk_tile_shape(
+            mem_budget,
+            self.patch_input_shape,
+            self.patch_output_shape,
+            self.ambiguous_size,
+            out_ch,
+            self.batch_size,
+            self.nr_inference_workers,
+            self.nr_post_proc_workers,
+            self.chunk_prefetch,
+            chunk_shape=None if self.chunk_shape == "auto" else self.chunk_shape,
+            tile_shape=None if self.tile_shape == "auto" else self.tile_shape,
+        )
+        log_info(
+            "Plan: chunk_shape={0} tile_shape={1}, estimated memory {2:.1f}GB"
+            " out of a budget of {3:.1f}GB ({4} of available)".format(
+                chunk_shape,
+                tile_shape,
+                mem_usage / 2 ** 30,
+                mem_budget / 2 ** 30,
+                self.mem_usage,
+            )
+        )
+        if mem_usage > mem_budget:
+            log_info("WARNING: Estimated memory usage exceeds the budget!")
+        self.chunk_shape = chunk_shape
+        self.tile_shape = tile_shape
         return
 
     def _parse_args(self, run_args):
         """Parse command line arguments and set as instance variables."""
         for variable, value in run_args.items():
             self.__setattr__(variable, value)
+        if "auto" in [self.chunk_shape, self.tile_shape]:
+            self.__plan_shapes()
         # to tuple
         self.chunk_shape = [self.chunk_shape, self.chunk_shape]
         self.tile_shape = [self.tile_shape, self.tile_shape]
         self.patch_input_shape = [self.patch_input_shape, self.patch_input_shape]
         self.patch_output_shape = [self.patch_output_shape, self.patch_output_shape]
+        assert self.chunk_transport in ["shm", "file"], (
+            "Unknown chunk transport `%s`" % self.chunk_transport
+        )
+        assert self.pred_map_dtype in ["float32", "float16", "uint8"], (
+            "Unsupported `pred_map_dtype` %s" % self.pred_map_dtype
+        )
+        assert self.nr_slides_in_flight >= 1, "`nr_slides_in_flight` must be >= 1"
+        assert self.metrics_format in ["json", "prometheus"], (
+            "Unknown metrics format `%s`" % self.metrics_format
+        )
+        assert self.cache_mode in ["ram", "mmap", "auto"], (
+            "Unknown cache mode `%s`" % self.cache_mode
+        )
+        if self.cache_mode == "ram":
+            assert not self.resume, "`resume` needs `cache_mode=mmap` or `auto`"
+            assert not self.sparse_cache, (
+                "`sparse_cache` needs `cache_mode=mmap` or `auto`"
+            )
         return
 
-    def process_single_file(self, wsi_path, msk_path, output_dir):
-        """Process a single whole-slide image and save the results.
+    def __infer_single_file(self, wsi_path, msk_path, output_dir):
+        """Infer a single whole-slide image, along with most of its post processing.
 
         Args:
             wsi_path: path to input whole-slide image
             msk_path: path to input mask. If not supplied, mask will be automatically generated.
             output_dir: path where output will be saved
 
+        Returns:
+            `_SlideState` of the slide to be finished by `__finish_single_file`,
+            `None` if there is nothing to process
+
         """
         # TODO: customize universal file handler to sync the protocol
         ambiguous_size = self.ambiguous_size
@@ -466,79 +1499,106 @@ class InferManager(base.InferManager):
         wsi_ext = path_obj.suffix
         wsi_name = path_obj.stem
 
+        # ! cant possibly save the inst map at high res, too large
+        if self.save_mask or self.save_thumb:
+            json_path = "%s/json/%s.json" % (output_dir, wsi_name)
+        else:
+            json_path = "%s/%s.json" % (output_dir, wsi_name)
+        # * each slide has its own cache directory, as several may be in flight
+        slide = _SlideState(
+            wsi_name,
+            "%s/%s/" % (self.cache_path, wsi_name),
+            json_path,
+            self.sparse_cache,
+        )
+        os.makedirs(slide.cache_path, exist_ok=True)
+        with self.metrics_lock:
+            self.active_slide_dict[wsi_name] = slide
+
         start = time.perf_counter()
-        self.wsi_handler = get_file_handler(wsi_path, backend=wsi_ext)
-        self.wsi_proc_shape = self.wsi_handler.get_dimensions(self.proc_mag)
-        self.wsi_handler.prepare_reading(
-            read_mag=self.proc_mag, cache_path="%s/src_wsi.npy" % self.cache_path
+        self.wsi_handler = get_file_handler(
+            wsi_path,
+            backend=wsi_ext,
+            tile_cache_size=self.tile_cache_size,
+            nr_read_threads=self.nr_read_threads,
+            # * only the overlap of a chunk with the next ones is read again
+            tile_cache_margin=self.patch_input_shape[0] - self.patch_output_shape[0],
         )
+        self.wsi_proc_shape = self.wsi_handler.get_dimensions(self.proc_mag)
+        self.wsi_handler.prepare_reading(read_mag=self.proc_mag)
         self.wsi_proc_shape = np.array(self.wsi_proc_shape[::-1])  # to Y, X
 
+        # * the thumbnail is read at most once, shared by the mask and the thumb
+        wsi_thumb_rgb = None
         if msk_path is not None and os.path.isfile(msk_path):
             self.wsi_mask = cv2.imread(msk_path)
             self.wsi_mask = cv2.cvtColor(self.wsi_mask, cv2.COLOR_BGR2GRAY)
             self.wsi_mask[self.wsi_mask > 0] = 1
         else:
-            log_info(
-                "WARNING: No mask found, generating mask via thresholding at 1.25x!"
-            )
-
-            from skimage import morphology
-
-            # simple method to extract tissue regions using intensity thresholding and morphological operations
-            def simple_get_mask():
-                scaled_wsi_mag = 1.25  # ! hard coded
-                wsi_thumb_rgb = self.wsi_handler.get_full_img(read_mag=scaled_wsi_mag)
-                gray = cv2.cvtColor(wsi_thumb_rgb, cv2.COLOR_RGB2GRAY)
-                _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
-                mask = morphology.remove_small_objects(
-                    mask == 0, min_size=16 * 16, connectivity=2
+            mask_cache_path = self.__get_mask_cache_path(wsi_path)
+            self.wsi_mask = None
+            if os.path.exists(mask_cache_path):
+                self.wsi_mask = cv2.imread(mask_cache_path, cv2.IMREAD_GRAYSCALE)
+            if self.wsi_mask is not None:
+                log_info("Load cached mask: %s" % mask_cache_path)
+                self.wsi_mask[self.wsi_mask > 0] = 1
+            else:
+                log_info(
+                    "WARNING: No mask found, generating mask via thresholding at 1.25x!"
                 )
-                mask = morphology.remove_small_holes(mask, area_threshold=128 * 128)
-                mask = morphology.binary_dilation(mask, morphology.disk(16))
-                return mask
-
-            self.wsi_mask = np.array(simple_get_mask() > 0, dtype=np.uint8)
+                wsi_thumb_rgb = self.wsi_handler.get_full_img(read_mag=1.25)
+                self.wsi_mask = get_tissue_mask(wsi_thumb_rgb)
+                # * atomic, as nodes sharing the cache may write the same mask
+                tmp_path = "%s.%d.tmp.png" % (mask_cache_path[:-4], os.getpid())
+                cv2.imwrite(tmp_path, self.wsi_mask * 255)
+                os.replace(tmp_path, mask_cache_path)
         if np.sum(self.wsi_mask) == 0:
             log_info("Skip due to empty mask!")
-            return
+            shutil.rmtree(slide.cache_path, ignore_errors=True)
+            self.__retire_slide(wsi_name)
+            self.nr_slides_skipped += 1
+            return None
+        self.wsi_mask_index = TissueMaskIndex(self.wsi_mask, self.wsi_proc_shape)
         if self.save_mask:
             cv2.imwrite("%s/mask/%s.png" % (output_dir, wsi_name), self.wsi_mask * 255)
         if self.save_thumb:
-            wsi_thumb_rgb = self.wsi_handler.get_full_img(read_mag=1.25)
+            if wsi_thumb_rgb is None:
+                wsi_thumb_rgb = self.wsi_handler.get_full_img(read_mag=1.25)
             cv2.imwrite(
                 "%s/thumb/%s.png" % (output_dir, wsi_name),
                 cv2.cvtColor(wsi_thumb_rgb, cv2.COLOR_RGB2BGR),
             )
 
+        # * journal of the progress, to resume the slide if the run dies midway
+        if self.resume:
+            slide.journal = self.__get_journal(wsi_path, slide)
+        resumed = slide.journal is not None and slide.journal.resumed
+        cache_mode = "r+" if resumed else "w+"
+
         # * declare holder for output
         # create a memory-mapped .npy file with the predefined dimensions and dtype
         # TODO: dynamicalize this, retrieve from model?
         out_ch = 3 if self.method["model_args"]["nr_types"] is None else 4
-        self.wsi_inst_info = {}
-        # TODO: option to use entire RAM if users have too much available, would be faster than mmap
-        self.wsi_inst_map = np.lib.format.open_memmap(
-            "%s/pred_inst.npy" % self.cache_path,
-            mode="w+",
-            shape=tuple(self.wsi_proc_shape),
-            dtype=np.int32,
-        )
-        # self.wsi_inst_map[:] = 0 # flush fill
-
-        # warning, the value within this is uninitialized
-        self.wsi_pred_map = np.lib.format.open_memmap(
-            "%s/pred_map.npy" % self.cache_path,
-            mode="w+",
-            shape=tuple(self.wsi_proc_shape) + (out_ch,),
-            dtype=np.float32,
+        inst_map_shape = tuple(self.wsi_proc_shape)
+        pred_map_shape = tuple(self.wsi_proc_shape) + (out_ch,)
+        holder_nbytes = np.prod(inst_map_shape) * np.dtype(np.int32).itemsize
+        pred_map_itemsize = np.dtype(self.pred_map_dtype).itemsize
+        holder_nbytes += np.prod(pred_map_shape) * pred_map_itemsize
+        use_ram_cache = self.__use_ram_cache(holder_nbytes)
+        log_info(
+            "Cache Mode: {0} ({1:.1f}GB)".format(
+                "ram" if use_ram_cache else "mmap", holder_nbytes / 2 ** 30
+            )
         )
-        # ! for debug
-        # self.wsi_pred_map = np.load('%s/pred_map.npy' % self.cache_path, mmap_mode='r')
-        end = time.perf_counter()
-        log_info("Preparing Input Output Placement: {0}".format(end - start))
-
-        # * raw prediction
-        start = time.perf_counter()
+        slide.inst_info = InstanceTable()
+        if resumed:
+            for commit_state in slide.journal.commit_list:
+                slide.inst_info.apply_change_log(commit_state["table_log"])
+                slide.inst_info.max_id = max(
+                    slide.inst_info.max_id, commit_state["max_id"]
+                )
+        if slide.journal is not None:
+            slide.inst_info.enable_change_log()
         chunk_info_list, patch_info_list = _get_chunk_patch_info(
             self.wsi_proc_shape,
             chunk_input_shape,
@@ -546,15 +1606,56 @@ class InferManager(base.InferManager):
             patch_output_shape,
         )
 
-        # get the raw prediction of HoVer-Net, given info of inference tiles and patches
-        self.__get_raw_prediction(chunk_info_list, patch_info_list)
+        # * with a sparse cache, only the blocks covered by the output of
+        # * patches with tissue are allocated, i.e those that are inferred
+        block_mask = None
+        if self.sparse_cache and not use_ram_cache:
+            valid_patch_info_list = self.__select_valid_patches(patch_info_list)
+            block_mask = get_block_mask(
+                self.wsi_proc_shape, _CACHE_BLOCK_SHAPE, valid_patch_info_list[:, 1]
+            )
+            log_info(
+                "Sparse Cache: {0}/{1} blocks allocated".format(
+                    np.count_nonzero(block_mask), block_mask.size
+                )
+            )
+
+        # * in RAM, the holders are shared with the post processing workers
+        # * which attach to them, instead of faulting pages in from the cache
+        if use_ram_cache:
+            inst_map_shm = SharedArray.create(inst_map_shape, np.int32)
+            pred_map_shm = SharedArray.create(pred_map_shape, self.pred_map_dtype)
+            slide.shared_holder_list = [inst_map_shm, pred_map_shm]
+            slide.inst_map_ref = inst_map_shm
+            slide.pred_map_ref = pred_map_shm
+            slide.inst_map = inst_map_shm.array
+            self.wsi_pred_map = pred_map_shm.array
+        else:
+            slide.inst_map = self.__open_holder(
+                slide.inst_map_path,
+                cache_mode,
+                inst_map_shape,
+                np.int32,
+                block_mask,
+            )
+            # slide.inst_map[:] = 0 # flush fill
+
+            # warning, the value within this is uninitialized
+            self.wsi_pred_map = self.__open_holder(
+                slide.pred_map_path,
+                cache_mode,
+                pred_map_shape,
+                np.dtype(self.pred_map_dtype),
+                block_mask,
+            )
+        # ! for debug
+        # self.wsi_pred_map = open_cache_array(slide.pred_map_path, mode='r')
         end = time.perf_counter()
-        log_info("Inference Time: {0}".format(end - start))
+        log_info("Preparing Input Output Placement: {0}".format(end - start))
 
         # TODO: deal with error banding
         ##### * post processing
         ##### * done in 3 stages to ensure that nuclei at the boundaries are dealt with accordingly
-        start = time.perf_counter()
         tile_coord_set = _get_tile_info(self.wsi_proc_shape, tile_shape, ambiguous_size)
         # 3 sets of patches are extracted and are dealt with differently
         # tile_grid_info: central region of post processing tiles
@@ -565,6 +1666,17 @@ class InferManager(base.InferManager):
         tile_boundary_info = self.__select_valid_patches(tile_boundary_info, False)
         tile_cross_info = self.__select_valid_patches(tile_cross_info, False)
 
+        # ! the callbacks may run after the inference of the slide, only
+        # ! `slide` and the shared pool must be used within them
+        proc_pool = self.proc_pool
+        trace_dir = get_trace_dir()  # enabled by the workers on their first task
+
+        # ! WARNING:
+        # ! inst ID may not be contiguous, hence ids are reserved
+        # ! with the max of each tile as safeguard
+        def reserve_inst_id(pred_inst):
+            return slide.inst_info.reserve_id(pred_inst.max())
+
         ####################### * Callback can only receive 1 arg
         def post_proc_normal_tile_callback(args):
             results, pos_args = args
@@ -572,30 +1684,17 @@ class InferManager(base.InferManager):
             pred_inst, inst_info_dict = results
 
             if len(inst_info_dict) == 0:
-                pbar.update()  # external
                 return  # when there is nothing to do
 
             top_left = pos_args[1][::-1]
 
-            # ! WARNING:
-            # ! inst ID may not be contiguous,
-            # ! hence must use max as safeguard
-
-            wsi_max_id = 0
-            if len(self.wsi_inst_info) > 0:
-                wsi_max_id = max(self.wsi_inst_info.keys())
-            for inst_id, inst_info in inst_info_dict.items():
-                # now correct the coordinate wrt to wsi
-                inst_info["bbox"] += top_left
-                inst_info["contour"] += top_left
-                inst_info["centroid"] += top_left
-                self.wsi_inst_info[inst_id + wsi_max_id] = inst_info
+            wsi_max_id = reserve_inst_id(pred_inst)
+            # now correct the coordinate wrt to wsi
+            slide.inst_info.add_dict(inst_info_dict, wsi_max_id, top_left)
             pred_inst[pred_inst > 0] += wsi_max_id
-            self.wsi_inst_map[
+            slide.inst_map[
                 tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]
             ] = pred_inst
-
-            pbar.update()  # external
             return
 
         ####################### * Callback can only receive 1 arg
@@ -605,112 +1704,216 @@ class InferManager(base.InferManager):
             pred_inst, inst_info_dict = results
 
             if len(inst_info_dict) == 0:
-                pbar.update()  # external
                 return  # when there is nothing to do
 
             top_left = pos_args[1][::-1]
-
-            # for fixing the boundary, keep all nuclei split at boundary (i.e within unambigous region)
-            # of the existing prediction map, and replace all nuclei within the region with newly predicted
-
-            # ! WARNING:
-            # ! inst ID may not be contiguous,
-            # ! hence must use max as safeguard
-
-            # ! must get before the removal happened
-            wsi_max_id = 0
-            if len(self.wsi_inst_info) > 0:
-                wsi_max_id = max(self.wsi_inst_info.keys())
-
-            # * exclude ambiguous out from old prediction map
-            # check 1 pix of 4 edges to find nuclei split at boundary
-            roi_inst = self.wsi_inst_map[
-                tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]
-            ]
-            roi_inst = np.copy(roi_inst)
-            roi_edge = np.concatenate(
-                [roi_inst[[0, -1], :].flatten(), roi_inst[:, [0, -1]].flatten()]
-            )
-            roi_boundary_inst_list = np.unique(roi_edge)[1:]  # exclude background
-            roi_inner_inst_list = np.unique(roi_inst)[1:]
-            roi_inner_inst_list = np.setdiff1d(
-                roi_inner_inst_list, roi_boundary_inst_list, assume_unique=True
-            )
-            roi_inst = _remove_inst(roi_inst, roi_inner_inst_list)
-            self.wsi_inst_map[
-                tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]
-            ] = roi_inst
-            for inst_id in roi_inner_inst_list:
-                self.wsi_inst_info.pop(inst_id, None)
-
-            # * exclude unambiguous out from new prediction map
-            # check 1 pix of 4 edges to find nuclei split at boundary
-            roi_edge = pred_inst[roi_inst > 0]  # remove all overlap
-            boundary_inst_list = np.unique(roi_edge)  # no background to exclude
-            inner_inst_list = np.unique(pred_inst)[1:]
-            inner_inst_list = np.setdiff1d(
-                inner_inst_list, boundary_inst_list, assume_unique=True
-            )
-            pred_inst = _remove_inst(pred_inst, boundary_inst_list)
-
-            # * proceed to overwrite
-            for inst_id in inner_inst_list:
-                # ! happen because we alrd skip thoses with wrong
-                # ! contour (<3 points) within the postproc, so
-                # ! sanity gate here
-                if inst_id not in inst_info_dict:
-                    log_info("Nuclei id=%d not in saved dict WRN1." % inst_id)
-                    continue
-                inst_info = inst_info_dict[inst_id]
+            wsi_max_id = reserve_inst_id(pred_inst)
+
+            # * only the instance info is reconciled within the main thread
+            def update_inst_info(merge_results):
+                _, roi_inner_inst_list, inner_inst_list = merge_results
+                slide.inst_info.remove(roi_inner_inst_list)
+                kept_inst_list = []
+                for inst_id in inner_inst_list:
+                    # ! happen because we alrd skip thoses with wrong
+                    # ! contour (<3 points) within the postproc, so
+                    # ! sanity gate here
+                    if inst_id not in inst_info_dict:
+                        log_info("Nuclei id=%d not in saved dict WRN1." % inst_id)
+                        continue
+                    kept_inst_list.append(inst_id)
                 # now correct the coordinate wrt to wsi
-                inst_info["bbox"] += top_left
-                inst_info["contour"] += top_left
-                inst_info["centroid"] += top_left
-                self.wsi_inst_info[inst_id + wsi_max_id] = inst_info
-            pred_inst[pred_inst > 0] += wsi_max_id
-            pred_inst = roi_inst + pred_inst
-            self.wsi_inst_map[
-                tile_tl[0] : tile_br[0], tile_tl[1] : tile_br[1]
-            ] = pred_inst
-
-            pbar.update()  # external
-            return
+                slide.inst_info.add_dict(
+                    inst_info_dict, wsi_max_id, top_left, kept_inst_list
+                )
+                return
+
+            # * tiles of a same colour are disjoint, so their instance maps
+            # * are stitched concurrently by the workers
+            undo_path = slide.get_undo_path(tile_tl, tile_br)
+            if proc_pool is None:
+                merge_results = _post_proc_fixing_merge(
+                    slide.inst_map, pos_args, pred_inst, wsi_max_id, undo_path
+                )
+                update_inst_info(merge_results)
+                return
+            merge_future = proc_pool.submit(
+                _post_proc_fixing_merge,
+                slide.inst_map_ref,
+                pos_args,
+                pred_inst,
+                wsi_max_id,
+                undo_path,
+                trace_dir,
+            )
+            return merge_future, update_inst_info
 
         #######################
-        pbar_creator = lambda x, y: tqdm.tqdm(
-            desc=y, leave=True, total=int(len(x)), ncols=80, ascii=True, position=0
+        # * the 3 stages are run as a wavefront along with the inference, each
+        # * tile is post processed once the chunks covering it are done
+        func_kwargs = {
+            "nr_types": self.method["model_args"]["nr_types"],
+            "return_centroids": True,
+        }
+        # TODO: standarize protocol
+        compute_func = partial(
+            _post_proc_para_wrapper,
+            slide.pred_map_ref,
+            func=self.post_proc_func,
+            func_kwargs=func_kwargs,
+            storage_dtype=self.pred_map_dtype,
+            trace_dir=trace_dir,
         )
-        pbar = pbar_creator(tile_grid_info, "Post Proc Phase 1")
-        # * must be in sequential ordering
-        self.__dispatch_post_processing(tile_grid_info, post_proc_normal_tile_callback)
-        pbar.close()
-
-        pbar = pbar_creator(tile_boundary_info, "Post Proc Phase 2")
-        self.__dispatch_post_processing(
-            tile_boundary_info, post_proc_fixing_tile_callback
+        slide.post_proc_scheduler = _PostProcScheduler(
+            [
+                (tile_grid_info, post_proc_normal_tile_callback),
+                (tile_boundary_info, post_proc_fixing_tile_callback),
+                (tile_cross_info, post_proc_fixing_tile_callback),
+            ],
+            chunk_info_list[:, 1],
+            compute_func,
+            proc_pool,
+            slide.journal.merged_tile_list if resumed else None,
         )
-        pbar.close()
+        if resumed:
+            log_info(
+                "Resume: {0} chunks and {1} post proc tiles already done".format(
+                    len(slide.journal.chunk_list), slide.post_proc_scheduler.nr_merged
+                )
+            )
+            self.__rollback_merges(slide)
+        if slide.journal is not None:
+            rm_n_mkdir(slide.undo_dir)
+
+        # * raw prediction
+        start = time.perf_counter()
+        # get the raw prediction of HoVer-Net, given info of inference tiles and patches
+        try:
+            self.__get_raw_prediction(chunk_info_list, patch_info_list, slide)
+        except BaseException:
+            self.wsi_pred_map = None
+            slide.release_holders()
+            raise
+        finally:
+            self.wsi_handler.close()  # nothing left to read
+        # * only read by the post processing from now on, via `slide.pred_map_ref`
+        self.wsi_pred_map = None
+        end = time.perf_counter()
+        log_info("Inference Time: {0}".format(end - start))
+        tile_cache = getattr(self.wsi_handler, "tile_cache", None)
+        if tile_cache is not None and tile_cache.max_nbytes > 0:
+            log_info(
+                "Tile Cache: {0} hits, {1} misses".format(
+                    tile_cache.nr_hits, tile_cache.nr_misses
+                )
+            )
+        return slide
+
+    def __finish_single_file(self, slide):
+        """Wait for the remaining post processing of a slide then save its output.
+
+        Only `slide` is used, so that this may run while the next slide is inferred.
 
-        pbar = pbar_creator(tile_cross_info, "Post Proc Phase 3")
-        self.__dispatch_post_processing(tile_cross_info, post_proc_fixing_tile_callback)
-        pbar.close()
+        Args:
+            slide: `_SlideState` returned by `__infer_single_file`
 
+        """
+        start = time.perf_counter()
+        pbar = tqdm.tqdm(
+            desc="Post Proc",
+            leave=True,
+            total=len(slide.post_proc_scheduler),
+            ncols=80,
+            ascii=True,
+            position=0,
+        )
+        try:
+            slide.post_proc_scheduler.finish(
+                pbar, checkpoint_func=lambda: self.__checkpoint(slide)
+            )
+        except BaseException:
+            self.__retire_slide(slide.wsi_name)
+            raise
+        finally:
+            pbar.close()
+            slide.release_holders()
         end = time.perf_counter()
-        log_info("Total Post Proc Time: {0}".format(end - start))
+        log_info("Remaining Post Proc Time: {0}".format(end - start))
 
-        # ! cant possibly save the inst map at high res, too large
         start = time.perf_counter()
-        if self.save_mask or self.save_thumb:
-            json_path = "%s/json/%s.json" % (output_dir, wsi_name)
-        else:
-            json_path = "%s/%s.json" % (output_dir, wsi_name)
-        self.__save_json(json_path, self.wsi_inst_info, mag=self.proc_mag)
+        with trace_span("save json", "io", slide=slide.wsi_name):
+            self.__save_json(slide.json_path, slide.inst_info, mag=self.proc_mag)
+        if self.save_binary:
+            with trace_span("save binary", "io", slide=slide.wsi_name):
+                binary_path = "%s.nuc" % os.path.splitext(slide.json_path)[0]
+                inst_arrays = slide.inst_info.to_arrays()
+                save_inst_arrays(binary_path, inst_arrays, mag=self.proc_mag)
         end = time.perf_counter()
         log_info("Save Time: {0}".format(end - start))
 
+        # output is complete, nothing left to resume
+        if slide.journal is not None:
+            slide.journal.close(remove=True)
+            slide.journal = None
+        shutil.rmtree(slide.cache_path, ignore_errors=True)
+        self.__retire_slide(slide.wsi_name, done=True)
+        return
+
+    def process_single_file(self, wsi_path, msk_path, output_dir):
+        """Process a single whole-slide image and save the results.
+
+        Args:
+            wsi_path: path to input whole-slide image
+            msk_path: path to input mask. If not supplied, mask will be automatically generated.
+            output_dir: path where output will be saved
+
+        """
+        own_trace = self.__open_trace()
+        metrics_writer = self.__open_metrics(1)
+        # the post processing workers are kept if spawned by `process_wsi_list`
+        own_proc_pool = getattr(self, "proc_pool", None) is None
+        if own_proc_pool and self.nr_post_proc_workers > 0:
+            self.proc_pool = self.__create_proc_pool()
+        elif own_proc_pool:
+            self.proc_pool = None
+        # likewise the inference workers, else spawned on the first chunk
+        own_patch_feeder = getattr(self, "patch_feeder", None) is None
+        wsi_name = pathlib.Path(wsi_path).stem
+        try:
+            with trace_span("infer slide", slide=wsi_name):
+                slide = self.__infer_single_file(wsi_path, msk_path, output_dir)
+            if slide is not None:
+                with trace_span("finish slide", slide=wsi_name):
+                    self.__finish_single_file(slide)
+                self.nr_slides_done += 1
+        except:
+            self.nr_slides_failed += 1
+            self.__retire_slide(wsi_name)
+            raise
+        finally:
+            if own_proc_pool:
+                self.__close_proc_pool()
+            # * before saving the trace, as the workers write within its dir
+            if own_patch_feeder:
+                self.__close_patch_feeder()
+            if metrics_writer is not None:
+                metrics_writer.close()
+            if own_trace:
+                self.__save_trace()
+        return
+
     def process_wsi_list(self, run_args):
         """Process a list of whole-slide images.
 
+        With `nr_slides_in_flight` > 1, the slides are pipelined: the remaining
+        post processing and saving of a slide run in the background while the
+        next slide is inferred. At most `nr_slides_in_flight` slides (and so
+        their cache directories) are in flight at any time.
+
+        With `claim_slides`, several nodes may process the same input directory,
+        each slide is claimed via a lock file within `<output_dir>/lock/` before
+        being processed, see `SlideClaimer`.
+
         Args:
             run_args: arguments as defined in run_infer.py
         
@@ -729,23 +1932,105 @@ class InferManager(base.InferManager):
             if not os.path.exists(self.output_dir + "/mask/"):
                 rm_n_mkdir(self.output_dir + "/mask/")
 
+        own_trace = self.__open_trace()
+
+        slide_claimer = None
+        if self.claim_slides:
+            slide_claimer = SlideClaimer(
+                "%s/lock/" % self.output_dir, stale_timeout=self.claim_timeout
+            )
+
+        def release_claim(wsi_name):
+            if slide_claimer is not None:
+                slide_claimer.release(wsi_name)
+
+        def finish_single_file(slide):
+            try:
+                with trace_span("finish slide", slide=slide.wsi_name):
+                    self.__finish_single_file(slide)
+                log_info("Finish: %s" % slide.wsi_name)
+                self.nr_slides_done += 1
+            except:
+                logging.exception("Crash")
+                self.nr_slides_failed += 1
+            release_claim(slide.wsi_name)
+
+        def get_json_path(wsi_name):
+            if self.save_thumb or self.save_mask:
+                return "%s/json/%s.json" % (self.output_dir, wsi_name)
+            return "%s/%s.json" % (self.output_dir, wsi_name)
+
+        def is_done(wsi_name):
+            if os.path.exists(get_json_path(wsi_name)):
+                log_info("Skip: %s" % wsi_name)
+                self.nr_slides_skipped += 1
+                return True
+            return False
+
         wsi_path_list = glob.glob(self.input_dir + "/*")
         wsi_path_list.sort()  # ensure ordering
-        for wsi_path in wsi_path_list[:]:
-            wsi_base_name = pathlib.Path(wsi_path).stem
-            msk_path = "%s/%s.png" % (self.input_mask_dir, wsi_base_name)
-            if self.save_thumb or self.save_mask:
-                output_file = "%s/json/%s.json" % (self.output_dir, wsi_base_name)
-            else:
-                output_file = "%s/%s.json" % (self.output_dir, wsi_base_name)
-            if os.path.exists(output_file):
-                log_info("Skip: %s" % wsi_base_name)
-                continue
+        wsi_path_dict = {pathlib.Path(v).stem: v for v in wsi_path_list}
+        wsi_name_list = [pathlib.Path(v).stem for v in wsi_path_list]
+        metrics_writer = self.__open_metrics(len(wsi_name_list))
+        if slide_claimer is None:
+            wsi_name_iter = (v for v in wsi_name_list if not is_done(v))
+        else:
+            wsi_name_iter = slide_claimer.claim_iter(wsi_name_list, is_done)
+
+        self.__get_patch_feeder()  # spawn once for all slides
+        self.proc_pool = None
+        if self.nr_post_proc_workers > 0:
+            # shared by the post processing of all slides in flight
+            self.proc_pool = self.__create_proc_pool()
+        finish_thread_list = []
+        for wsi_name in wsi_name_iter:
+            wsi_path = wsi_path_dict[wsi_name]
+            msk_path = "%s/%s.png" % (self.input_mask_dir, wsi_name)
             try:
-                log_info("Process: %s" % wsi_base_name)
-                self.process_single_file(wsi_path, msk_path, self.output_dir)
-                log_info("Finish")
+                log_info("Process: %s" % wsi_name)
+                with trace_span("infer slide", slide=wsi_name):
+                    slide = self.__infer_single_file(
+                        wsi_path, msk_path, self.output_dir
+                    )
             except:
                 logging.exception("Crash")
-        rm_n_mkdir(self.cache_path)  # clean up all cache
+                self.nr_slides_failed += 1
+                self.__retire_slide(wsi_name)
+                slide = None
+            if slide is None:
+                release_claim(wsi_name)
+                continue
+            if self.nr_slides_in_flight == 1:
+                finish_single_file(slide)
+                continue
+            finish_thread = threading.Thread(target=finish_single_file, args=(slide,))
+            finish_thread.start()
+            finish_thread_list.append(finish_thread)
+
+            # * wait for the oldest slides, so that the next one can be inferred
+            finish_thread_list = [v for v in finish_thread_list if v.is_alive()]
+            while len(finish_thread_list) >= self.nr_slides_in_flight:
+                finish_thread_list.pop(0).join()
+        for finish_thread in finish_thread_list:
+            finish_thread.join()
+        if slide_claimer is not None:
+            slide_claimer.close()
+        self.__close_proc_pool()
+        self.__close_patch_feeder()
+        if metrics_writer is not None:
+            metrics_writer.close()
+        if own_trace:
+            self.__save_trace()
+        # the caches of slides that crashed are kept to be resumed, and the
+        # cache may be shared with other nodes when claiming slides
+        if not self.resume and not self.claim_slides:
+            # clean up all cache but the tissue masks, reused by later runs
+            for cache_name in os.listdir(self.cache_path):
+                if cache_name == "tissue_mask":
+                    continue
+                cache_name = "%s/%s" % (self.cache_path, cache_name)
+                if os.path.isdir(cache_name):
+                    shutil.rmtree(cache_name)
+                else:
+                    os.remove(cache_name)
         return
@@ -0,0 +1,158 @@
+import json
+import os
+
+import numpy as np
+
+
+####
+class BlockArray(object):
+    """Array of shape (H, W, ...) stored as fixed size blocks along H and W.
+
+    Only the blocks flagged within `block_mask` are allocated, one after
+    another within a single memory-mapped file, the slot of each block is
+    kept within an index. Reading unallocated blocks yields 0, writing non
+    zero values into them is an error. Supports the slicing used for the
+    wsi holders, i.e `array[y0:y1, x0:x1]` and `array[y0:y1, x0:x1] = value`.
+
+    Files within the `path` directory:
+        data.bin: allocated blocks, array of shape (N, block_h, block_w, ...)
+        index.npy: slot of each block within `data.bin`, -1 if unallocated
+        meta.json: shape, dtype and block shape
+
+    Args:
+        path: directory holding the array
+        mode: 'r' or 'r+' to open an existing array, 'w+' to create it
+        shape: shape of the array, only when creating it
+        dtype: data type of the array, only when creating it
+        block_shape: (block_h, block_w), only when creating it
+        block_mask: flag of the blocks to allocate, of shape
+                    `ceil(shape[:2] / block_shape)`, only when creating it
+
+    """
+
+    def __init__(
+        self, path, mode="r", shape=None, dtype=None, block_shape=None, block_mask=None
+    ):
+        self.path = path
+        if mode == "w+":
+            os.makedirs(path, exist_ok=True)
+            block_index = np.full(block_mask.shape, -1, dtype=np.int64)
+            block_index[block_mask] = np.arange(np.count_nonzero(block_mask))
+            np.save("%s/index.npy" % path, block_index)
+            meta = {
+                "shape": [int(v) for v in shape],
+                "dtype": np.dtype(dtype).str,
+                "block_shape": [int(v) for v in block_shape],
+            }
+            with open("%s/meta.json" % path, "w") as handle:
+                json.dump(meta, handle)
+        with open("%s/meta.json" % path, "r") as handle:
+            meta = json.load(handle)
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.block_shape = np.array(meta["block_shape"])
+        self.block_index = np.load("%s/index.npy" % path)
+
+        nr_blocks = max(int(np.count_nonzero(self.block_index >= 0)), 1)
+        data_shape = (nr_blocks,) + tuple(self.block_shape) + self.shape[2:]
+        self.data = np.memmap(
+            "%s/data.bin" % path, dtype=self.dtype, mode=mode, shape=data_shape
+        )
+        return
+
+    @property
+    def nbytes(self):
+        """Number of bytes allocated for the blocks."""
+        return self.data.nbytes
+
+    def __get_block_list(self, key):
+        """Get the blocks overlapping a region, and their overlap wrt both."""
+        assert len(key) == 2 and all(isinstance(v, slice) for v in key)
+        assert all(v.step in [None, 1] for v in key), "Only contiguous slicing"
+        tl, br = np.zeros(2, dtype=np.int64), np.zeros(2, dtype=np.int64)
+        for axis, axis_slice in enumerate(key):
+            tl[axis], br[axis], _ = axis_slice.indices(self.shape[axis])
+        br = np.maximum(br, tl)
+
+        block_list = []
+        if np.any(br <= tl):
+            return tl, br, block_list
+        block_tl = tl // self.block_shape
+        block_br = (br - 1) // self.block_shape + 1
+        for block_y in range(block_tl[0], block_br[0]):
+            for block_x in range(block_tl[1], block_br[1]):
+                block_origin = np.array([block_y, block_x]) * self.block_shape
+                overlap_tl = np.maximum(tl, block_origin)
+                overlap_br = np.minimum(br, block_origin + self.block_shape)
+                region = np.s_[
+                    overlap_tl[0] - tl[0] : overlap_br[0] - tl[0],
+                    overlap_tl[1] - tl[1] : overlap_br[1] - tl[1],
+                ]
+                within_block = np.s_[
+                    overlap_tl[0] - block_origin[0] : overlap_br[0] - block_origin[0],
+                    overlap_tl[1] - block_origin[1] : overlap_br[1] - block_origin[1],
+                ]
+                slot = self.block_index[block_y, block_x]
+                block_list.append((slot, region, within_block))
+        return tl, br, block_list
+
+    def __getitem__(self, key):
+        tl, br, block_list = self.__get_block_list(key)
+        output = np.zeros(tuple(br - tl) + self.shape[2:], dtype=self.dtype)
+        for slot, region, within_block in block_list:
+            if slot >= 0:
+                output[region] = self.data[slot][within_block]
+        return output
+
+    def __setitem__(self, key, value):
+        tl, br, block_list = self.__get_block_list(key)
+        value = np.broadcast_to(value, tuple(br - tl) + self.shape[2:])
+        for slot, region, within_block in block_list:
+            if slot >= 0:
+                self.data[slot][within_block] = value[region]
+                continue
+            assert not np.any(value[region]), (
+                "Non zero values written outside of the allocated blocks of `%s`"
+                % self.path
+            )
+        return
+
+    def flush(self):
+        self.data.flush()
+        return
+
+
+####
+def get_block_mask(shape, block_shape, bbox_list):
+    """Flag the blocks overlapping any of the boxes.
+
+    Args:
+        shape: (H, W) of the array
+        block_shape: (block_h, block_w)
+        bbox_list: Nx2x2 array of boxes [[top_left], [bot_right]] in (Y, X),
+                   each box must not be larger than a block
+
+    """
+    block_shape = np.array(block_shape)
+    nr_blocks = (np.array(shape[:2]) + block_shape - 1) // block_shape
+    block_mask = np.zeros(tuple(nr_blocks), dtype=bool)
+    bbox_list = np.asarray(bbox_list).reshape(-1, 2, 2)
+    # blocks of the top left and bottom right (inclusive) pixels of each box
+    block_tl = bbox_list[:, 0] // block_shape
+    block_br = (np.maximum(bbox_list[:, 1], bbox_list[:, 0] + 1) - 1) // block_shape
+    block_tl = np.clip(block_tl, 0, nr_blocks - 1)
+    block_br = np.clip(block_br, 0, nr_blocks - 1)
+    # * boxes are not larger than a block, so their 4 corners cover all
+    # * the blocks they overlap
+    for block_y in [block_tl[:, 0], block_br[:, 0]]:
+        for block_x in [block_tl[:, 1], block_br[:, 1]]:
+            block_mask[block_y, block_x] = True
+    return block_mask
+
+
+####
+def open_cache_array(path, mode="r"):
+    """Open a wsi holder within the cache, either a `.npy` or a `BlockArray`."""
+    if os.path.isdir(path):
+        return BlockArray(path, mode=mode)
+    return np.load(path, mmap_mode=mode)
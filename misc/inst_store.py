@@ -0,0 +1,438 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+# columns of the binary format, see `InstanceTable.to_arrays`
+INST_COLUMN_LIST = [
+    "id",
+    "bbox",
+    "centroid",
+    "type",
+    "type_prob",
+    "contour",
+    "contour_offset",
+]
+
+
+####
+class InstanceTable(object):
+    """Columnar store of the instances of a whole-slide image.
+
+    Each instance is a row within growable numpy columns (id, bbox, centroid,
+    type and type_prob) while the contours are concatenated within a single
+    ragged buffer indexed by per-row offsets. Removed rows are only flagged,
+    the storage is compacted when the columns need to grow.
+
+    `items()` yields `(inst_id, inst_info)` in insertion order with the same
+    `inst_info` format as the output of the post processing, so that the table
+    can be used in place of a dict of dicts.
+
+    Args:
+        capacity: initial number of rows
+        contour_capacity: initial number of contour points
+
+    """
+
+    def __init__(self, capacity=1024, contour_capacity=32768):
+        self.nr_rows = 0
+        self.nr_alive = 0
+        self.nr_points = 0
+        self.max_id = 0
+
+        self.id = np.zeros(capacity, dtype=np.int64)
+        self.bbox = np.zeros((capacity, 2, 2), dtype=np.int64)
+        self.centroid = np.zeros((capacity, 2), dtype=np.float64)
+        self.type = np.zeros(capacity, dtype=np.int32)  # -1 for None
+        self.type_prob = np.zeros(capacity, dtype=np.float64)  # nan for None
+        self.alive = np.zeros(capacity, dtype=bool)
+        # contour of row i is contour[contour_offset[i] : contour_offset[i + 1]]
+        self.contour_offset = np.zeros(capacity + 1, dtype=np.int64)
+        self.contour = np.zeros((contour_capacity, 2), dtype=np.int32)
+        # row of each id, -1 if the id is not within the table
+        self.id_to_row = np.full(capacity, -1, dtype=np.int64)
+        # changes since the last `pop_change_log`, `None` if not logged
+        self.change_log = None
+        return
+
+    def __len__(self):
+        return self.nr_alive
+
+    def __contains__(self, inst_id):
+        return 0 < inst_id < len(self.id_to_row) and self.id_to_row[inst_id] >= 0
+
+    @staticmethod
+    def __grow(array, min_length, fill_value=0):
+        """Return `array` enlarged along the 1st axis to at least `min_length`."""
+        if array.shape[0] >= min_length:
+            return array
+        new_length = max(min_length, 2 * array.shape[0])
+        new_array = np.full((new_length,) + array.shape[1:], fill_value, array.dtype)
+        new_array[: array.shape[0]] = array
+        return new_array
+
+    def __reserve_rows(self, nr_rows, nr_points):
+        if self.nr_rows + nr_rows > self.id.shape[0]:
+            # reclaim the space of removed rows before growing
+            if self.nr_alive < self.nr_rows // 2:
+                self.__compact()
+        min_length = self.nr_rows + nr_rows
+        self.id = self.__grow(self.id, min_length)
+        self.bbox = self.__grow(self.bbox, min_length)
+        self.centroid = self.__grow(self.centroid, min_length)
+        self.type = self.__grow(self.type, min_length)
+        self.type_prob = self.__grow(self.type_prob, min_length)
+        self.alive = self.__grow(self.alive, min_length)
+        self.contour_offset = self.__grow(self.contour_offset, min_length + 1)
+        self.contour = self.__grow(self.contour, self.nr_points + nr_points)
+        return
+
+    def __compact(self):
+        """Drop the removed rows and their contours, keeping the insertion order."""
+        arrays = self.to_arrays()
+        nr_alive = arrays["id"].shape[0]
+        self.id[:nr_alive] = arrays["id"]
+        self.bbox[:nr_alive] = arrays["bbox"]
+        self.centroid[:nr_alive] = arrays["centroid"]
+        self.type[:nr_alive] = arrays["type"]
+        self.type_prob[:nr_alive] = arrays["type_prob"]
+        self.alive[:] = False
+        self.alive[:nr_alive] = True
+        self.contour_offset[: nr_alive + 1] = arrays["contour_offset"]
+        self.contour[: arrays["contour"].shape[0]] = arrays["contour"]
+        self.id_to_row[:] = -1
+        self.id_to_row[arrays["id"]] = np.arange(nr_alive)
+        self.nr_rows = nr_alive
+        self.nr_points = arrays["contour"].shape[0]
+        return
+
+    def reserve_id(self, nr_ids):
+        """Reserve a range of `nr_ids` ids above all those used so far.
+
+        Returns:
+            the offset to add to ids in [1, nr_ids] to obtain the reserved ids
+
+        """
+        id_offset = self.max_id
+        self.max_id += int(nr_ids)
+        return id_offset
+
+    def add(
+        self,
+        inst_id_list,
+        bbox_list,
+        centroid_list,
+        contour_list,
+        type_list=None,
+        type_prob_list=None,
+    ):
+        """Insert a batch of instances.
+
+        Args:
+            inst_id_list: N ids, must not be within the table
+            bbox_list: Nx2x2 bounding boxes
+            centroid_list: Nx2 centroids
+            contour_list: list of N arrays of Mx2 contour points
+            type_list: N types, `None` if there is no type
+            type_prob_list: N type probabilities, `None` if there is no type
+
+        """
+        inst_id_list = np.asarray(inst_id_list, dtype=np.int64)
+        nr_insts = inst_id_list.shape[0]
+        if nr_insts == 0:
+            return
+        if self.change_log is not None:
+            change = (
+                inst_id_list,
+                np.asarray(bbox_list),
+                np.asarray(centroid_list),
+                [np.asarray(v, dtype=np.int32) for v in contour_list],
+                type_list,
+                type_prob_list,
+            )
+            self.change_log.append(("add", change))
+        contour_length = np.array([len(v) for v in contour_list], dtype=np.int64)
+        nr_points = int(contour_length.sum())
+        self.__reserve_rows(nr_insts, nr_points)
+
+        row_start, row_end = self.nr_rows, self.nr_rows + nr_insts
+        self.id[row_start:row_end] = inst_id_list
+        self.bbox[row_start:row_end] = bbox_list
+        self.centroid[row_start:row_end] = centroid_list
+        self.type[row_start:row_end] = -1 if type_list is None else type_list
+        self.type_prob[row_start:row_end] = (
+            np.nan if type_prob_list is None else type_prob_list
+        )
+        self.alive[row_start:row_end] = True
+        self.contour_offset[row_start + 1 : row_end + 1] = self.nr_points + np.cumsum(
+            contour_length
+        )
+        self.contour[self.nr_points : self.nr_points + nr_points] = np.concatenate(
+            contour_list, axis=0
+        )
+
+        self.max_id = max(self.max_id, int(inst_id_list.max()))
+        self.id_to_row = self.__grow(self.id_to_row, self.max_id + 1, -1)
+        self.id_to_row[inst_id_list] = np.arange(row_start, row_end)
+        self.nr_rows = row_end
+        self.nr_points += nr_points
+        self.nr_alive += nr_insts
+        return
+
+    def add_dict(self, inst_info_dict, id_offset=0, top_left=(0, 0), inst_id_list=None):
+        """Insert the instances output by the post processing.
+
+        Args:
+            inst_info_dict: dict of `{inst_id: inst_info}`
+            id_offset: value added to the ids of `inst_info_dict`
+            top_left: value added to the bbox, contour and centroid coordinates
+            inst_id_list: ids of `inst_info_dict` to insert, all if `None`
+
+        """
+        if inst_id_list is None:
+            inst_id_list = list(inst_info_dict.keys())
+        if len(inst_id_list) == 0:
+            return
+        inst_info_list = [inst_info_dict[inst_id] for inst_id in inst_id_list]
+        top_left = np.array(top_left)
+        bbox_list = np.array([v["bbox"] for v in inst_info_list]) + top_left
+        centroid_list = np.array([v["centroid"] for v in inst_info_list]) + top_left
+        contour_list = [v["contour"] + top_left for v in inst_info_list]
+        type_list, type_prob_list = None, None
+        if inst_info_list[0]["type"] is not None:
+            type_list = [v["type"] for v in inst_info_list]
+            type_prob_list = [v["type_prob"] for v in inst_info_list]
+        self.add(
+            np.array(inst_id_list, dtype=np.int64) + id_offset,
+            bbox_list,
+            centroid_list,
+            contour_list,
+            type_list,
+            type_prob_list,
+        )
+        return
+
+    def remove(self, inst_id_list):
+        """Remove a batch of instances, ids not within the table are ignored."""
+        inst_id_list = np.asarray(inst_id_list, dtype=np.int64)
+        if self.change_log is not None:
+            self.change_log.append(("remove", inst_id_list))
+        inst_id_list = inst_id_list[
+            (inst_id_list > 0) & (inst_id_list < len(self.id_to_row))
+        ]
+        row_list = self.id_to_row[inst_id_list]
+        row_list = np.unique(row_list[row_list >= 0])
+        self.alive[row_list] = False
+        self.id_to_row[self.id[row_list]] = -1
+        self.nr_alive -= row_list.shape[0]
+        return
+
+    def enable_change_log(self):
+        """Start logging the changes made to the table, see `pop_change_log`."""
+        self.change_log = []
+        return
+
+    def pop_change_log(self):
+        """Get the changes made since the previous call, and reset the log."""
+        change_log, self.change_log = self.change_log, []
+        return change_log
+
+    def apply_change_log(self, change_log):
+        """Replay changes obtained from `pop_change_log`, e.g on another table."""
+        for change_type, change in change_log:
+            if change_type == "add":
+                self.add(*change)
+            else:
+                self.remove(change)
+        return
+
+    def __get_info(self, row):
+        inst_type = int(self.type[row])
+        type_prob = float(self.type_prob[row])
+        contour = self.contour[self.contour_offset[row] : self.contour_offset[row + 1]]
+        return {
+            "bbox": self.bbox[row],
+            "centroid": self.centroid[row],
+            "contour": contour,
+            "type_prob": None if inst_type < 0 else type_prob,
+            "type": None if inst_type < 0 else inst_type,
+        }
+
+    def __getitem__(self, inst_id):
+        assert inst_id in self, "Nuclei id=%d not in the table." % inst_id
+        return self.__get_info(self.id_to_row[inst_id])
+
+    def keys(self):
+        return self.id[: self.nr_rows][self.alive[: self.nr_rows]].tolist()
+
+    def items(self):
+        """Yield `(inst_id, inst_info)` of the instances in insertion order."""
+        for row in np.nonzero(self.alive[: self.nr_rows])[0]:
+            yield int(self.id[row]), self.__get_info(row)
+
+    def to_arrays(self):
+        """Get compact copies of the columns of the instances within the table.
+
+        Returns:
+            dict of arrays, `contour` holds the points of all instances and the
+            contour of the i-th instance is `contour[contour_offset[i] : contour_offset[i + 1]]`
+
+        """
+        row_list = np.nonzero(self.alive[: self.nr_rows])[0]
+        contour_start = self.contour_offset[row_list]
+        contour_length = self.contour_offset[row_list + 1] - contour_start
+        contour_offset = np.zeros(row_list.shape[0] + 1, dtype=np.int64)
+        contour_offset[1:] = np.cumsum(contour_length)
+        # gather the points of each kept row in one pass
+        point_list = np.repeat(contour_start - contour_offset[:-1], contour_length)
+        point_list += np.arange(contour_offset[-1])
+        return {
+            "id": self.id[row_list],
+            "bbox": self.bbox[row_list],
+            "centroid": self.centroid[row_list],
+            "type": self.type[row_list],
+            "type_prob": self.type_prob[row_list],
+            "contour": self.contour[point_list],
+            "contour_offset": contour_offset,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Create a table from the output of `to_arrays`."""
+        nr_insts = arrays["id"].shape[0]
+        table = cls(max(nr_insts, 1), max(arrays["contour"].shape[0], 1))
+        if nr_insts == 0:
+            return table
+        table.id[:nr_insts] = arrays["id"]
+        table.bbox[:nr_insts] = arrays["bbox"]
+        table.centroid[:nr_insts] = arrays["centroid"]
+        table.type[:nr_insts] = arrays["type"]
+        table.type_prob[:nr_insts] = arrays["type_prob"]
+        table.alive[:nr_insts] = True
+        table.contour_offset[: nr_insts + 1] = arrays["contour_offset"]
+        table.contour[: arrays["contour"].shape[0]] = arrays["contour"]
+        table.max_id = int(arrays["id"].max())
+        table.id_to_row = np.full(table.max_id + 1, -1, dtype=np.int64)
+        table.id_to_row[arrays["id"]] = np.arange(nr_insts)
+        table.nr_rows = table.nr_alive = nr_insts
+        table.nr_points = arrays["contour"].shape[0]
+        return table
+
+
+####
+def save_inst_arrays(path, arrays, mag=None):
+    """Save the instance columns (see `InstanceTable.to_arrays`) in binary format.
+
+    `path` is a directory holding 1 `.npy` file per column, which can be memory
+    mapped, along with a `manifest.json` describing them. The directory is
+    written under a temporary name then renamed, so it only exists once complete.
+
+    Args:
+        path: path to the output directory, usually ending with `.nuc`
+        arrays: dict of columns
+        mag: magnification the instances are defined at
+
+    """
+    tmp_path = "%s.tmp" % path
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = {
+        "format": "hovernet-nuc",
+        "version": 1,
+        "mag": mag,
+        "nr_insts": int(arrays["id"].shape[0]),
+        "columns": {},
+    }
+    for name in INST_COLUMN_LIST:
+        np.save("%s/%s.npy" % (tmp_path, name), arrays[name])
+        manifest["columns"][name] = {
+            "dtype": arrays[name].dtype.str,
+            "shape": list(arrays[name].shape),
+        }
+    with open("%s/manifest.json" % tmp_path, "w") as handle:
+        json.dump(manifest, handle)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return
+
+
+####
+class InstanceReader(object):
+    """Lazy reader of the binary instance format written by `save_inst_arrays`.
+
+    Columns are memory-mapped upon first access, hence reading a range of
+    instances (e.g `reader[1000:2000]`) only touches the corresponding part of
+    the files rather than parsing the whole output.
+
+    Args:
+        path: path to the directory written by `save_inst_arrays`
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open("%s/manifest.json" % path, "r") as handle:
+            self.manifest = json.load(handle)
+        assert self.manifest["format"] == "hovernet-nuc", (
+            "`%s` is not a binary instance output." % path
+        )
+        self.mag = self.manifest["mag"]
+        self.column_dict = {}
+        return
+
+    def __len__(self):
+        return self.manifest["nr_insts"]
+
+    def column(self, name):
+        """Get a column as a read only memory-mapped array."""
+        if name not in self.column_dict:
+            self.column_dict[name] = np.load(
+                "%s/%s.npy" % (self.path, name), mmap_mode="r"
+            )
+        return self.column_dict[name]
+
+    def __getitem__(self, index):
+        """Get the columns of a contiguous range of instances.
+
+        Args:
+            index: slice with a step of 1 over the instances
+
+        Returns:
+            dict of arrays like `InstanceTable.to_arrays`, the contour offsets
+            being relative to the returned contour points
+
+        """
+        assert isinstance(index, slice), "Only slicing by instance range is supported."
+        start, stop, step = index.indices(len(self))
+        assert step == 1, "Only slicing by instance range is supported."
+        stop = max(start, stop)
+        arrays = {}
+        for name in ["id", "bbox", "centroid", "type", "type_prob"]:
+            arrays[name] = np.array(self.column(name)[start:stop])
+        contour_offset = np.array(self.column("contour_offset")[start : stop + 1])
+        arrays["contour"] = np.array(
+            self.column("contour")[contour_offset[0] : contour_offset[-1]]
+        )
+        arrays["contour_offset"] = contour_offset - contour_offset[0]
+        return arrays
+
+    def items(self, start=0, stop=None, batch_size=65536):
+        """Yield `(inst_id, inst_info)` like `InstanceTable.items`, within a range.
+
+        Args:
+            start: index of the first instance
+            stop: index after the last instance, `None` for all the remaining
+            batch_size: number of instances read from the files at once
+
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            table = InstanceTable.from_arrays(self[batch_start:batch_stop])
+            for item in table.items():
+                yield item
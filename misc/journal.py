@@ -0,0 +1,91 @@
+import os
+import pickle
+
+
+####
+class ProgressJournal(object):
+    """Append-only journal of the progress made on a slide, to resume a run.
+
+    Records are pickled one after another and synced to disk upon writing, a
+    record cut short by a crash is ignored when reading the journal back. The
+    journal starts with the `signature` of the run, an existing journal with a
+    different signature (e.g another slide or other settings) is discarded.
+
+    Records:
+        ("chunk", chunk_idx): output of the chunk is durable in the prediction map
+        ("commit", state): post processing tiles merged since the previous commit,
+                           see `log_commit`
+
+    Args:
+        path: path to the journal file
+        signature: picklable description of the run, compared with `==`
+
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+
+        self.resumed = False
+        self.chunk_list = []
+        self.commit_list = []
+        record_list = self.__read()
+        if len(record_list) > 0 and record_list[0] == ("header", signature):
+            self.resumed = True
+            for record_type, record_value in record_list[1:]:
+                if record_type == "chunk":
+                    self.chunk_list.append(record_value)
+                elif record_type == "commit":
+                    self.commit_list.append(record_value)
+
+        if self.resumed:
+            self.handle = open(path, "ab")
+        else:
+            self.handle = open(path, "wb")
+            self.__write(("header", signature))
+        return
+
+    def __read(self):
+        record_list = []
+        if not os.path.exists(self.path):
+            return record_list
+        with open(self.path, "rb") as handle:
+            while True:
+                try:
+                    record_list.append(pickle.load(handle))
+                except Exception:  # end of file or torn record
+                    break
+        return record_list
+
+    def __write(self, record):
+        pickle.dump(record, self.handle, protocol=pickle.HIGHEST_PROTOCOL)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        return
+
+    def log_chunk(self, chunk_idx):
+        self.__write(("chunk", int(chunk_idx)))
+        return
+
+    def log_commit(self, tile_list, table_log, max_id):
+        """Record post processing tiles whose merging is durable.
+
+        Args:
+            tile_list: indices of the tiles merged since the previous commit
+            table_log: changes of the instance table made by merging these tiles
+            max_id: max instance id reserved so far
+
+        """
+        state = {"tile_list": list(tile_list), "table_log": table_log, "max_id": max_id}
+        self.__write(("commit", state))
+        return
+
+    @property
+    def merged_tile_list(self):
+        return [idx for state in self.commit_list for idx in state["tile_list"]]
+
+    def close(self, remove=False):
+        self.handle.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+        return
@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+
+
+####
+class TissueMaskIndex(object):
+    """Summed-area table of a tissue mask to query the amount of tissue within
+    many boxes at once.
+
+    The table is built once per slide, each query is then 4 lookups per box
+    regardless of the box size.
+
+    Args:
+        mask: binary tissue mask, may be at a lower resolution than the slide
+        target_shape: shape (Y, X) of the image the query boxes are defined on
+
+    """
+
+    def __init__(self, mask, target_shape):
+        self.mask_shape = np.array(mask.shape[:2])
+        # ! same ratio for both axes, as mask and slide may be off some pixels
+        self.down_sample_ratio = mask.shape[0] / target_shape[0]
+
+        dtype = np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+        self.integral = np.zeros(tuple(self.mask_shape + 1), dtype=dtype)
+        np.cumsum(mask > 0, axis=0, dtype=dtype, out=self.integral[1:, 1:])
+        np.cumsum(self.integral[1:, 1:], axis=1, out=self.integral[1:, 1:])
+        return
+
+    def count(self, bbox_list):
+        """Count the number of tissue pixels (at mask resolution) within each box.
+
+        Args:
+            bbox_list: Nx2x2 array of boxes [[top_left], [bot_right]] in (Y, X),
+                       defined at `target_shape`
+
+        Returns:
+            array of N counts
+
+        """
+        bbox_list = np.asarray(bbox_list).reshape(-1, 2, 2)
+        bbox_list = np.rint(bbox_list * self.down_sample_ratio).astype(np.int64)
+        # follow the slicing protocol, box is clipped to the mask and may be empty
+        tl = np.clip(bbox_list[:, 0], 0, self.mask_shape)
+        br = np.clip(bbox_list[:, 1], 0, self.mask_shape)
+        br = np.maximum(br, tl)
+        count = (
+            self.integral[br[:, 0], br[:, 1]]
+            - self.integral[tl[:, 0], br[:, 1]]
+            - self.integral[br[:, 0], tl[:, 1]]
+            + self.integral[tl[:, 0], tl[:, 1]]
+        )
+        return count
+
+    def has_tissue(self, bbox_list):
+        """Flag the boxes that contain at least 1 tissue pixel."""
+        return self.count(bbox_list) > 0
+
+
+####
+def _remove_small_components(mask, min_size, connectivity):
+    """Remove the connected components of `mask` with less than `min_size` pixels."""
+    nr_labels, label_map, stats, _ = cv2.connectedComponentsWithStats(
+        mask.astype(np.uint8), connectivity=connectivity
+    )
+    keep_lut = stats[:, cv2.CC_STAT_AREA] >= min_size
+    keep_lut[0] = False  # background
+    return keep_lut[label_map]
+
+
+####
+def get_tissue_mask(wsi_thumb_rgb):
+    """Extract the tissue regions of a slide thumbnail via intensity thresholding.
+
+    Otsu thresholding, then removal of small objects, filling of small holes
+    and dilation. Morphology is done with OpenCV rather than skimage, which is
+    several times slower, the output is the same as with
+    `remove_small_objects(connectivity=2)`, `remove_small_holes` (4-connected)
+    and `binary_dilation(disk(16))`.
+
+    Args:
+        wsi_thumb_rgb: RGB thumbnail of the slide at 1.25x
+
+    Returns:
+        binary (0/1) uint8 mask of the tissue
+
+    """
+    gray = cv2.cvtColor(wsi_thumb_rgb, cv2.COLOR_RGB2GRAY)
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_OTSU)
+    mask = _remove_small_components(mask == 0, 16 * 16, connectivity=8)
+    # holes are the small components of the background
+    mask = ~_remove_small_components(~mask, 128 * 128, connectivity=4)
+    yy, xx = np.mgrid[-16:17, -16:17]
+    disk = np.array(yy ** 2 + xx ** 2 <= 16 ** 2, dtype=np.uint8)
+    mask = cv2.dilate(mask.astype(np.uint8), disk)
+    return mask
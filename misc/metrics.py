@@ -0,0 +1,147 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import psutil
+
+from misc.utils import log_info
+
+
+####
+def get_disk_usage(dir_path):
+    """Bytes actually allocated for the files within a directory, recursively."""
+    nr_bytes = 0
+    for root, _, file_name_list in os.walk(dir_path):
+        for file_name in file_name_list:
+            try:
+                file_stat = os.stat(os.path.join(root, file_name))
+            except FileNotFoundError:
+                continue  # removed meanwhile
+            # * sparse files (e.g untouched parts of a memmap) are not counted
+            nr_bytes += file_stat.st_blocks * 512
+    return nr_bytes
+
+
+####
+class MetricsWriter(object):
+    """Periodically write a snapshot of the progress of a run into a file.
+
+    A background thread calls `collect_func` every `interval` seconds, then
+    atomically replaces the file with the snapshot, so that a job monitor may
+    read it at any time. The counters themselves are kept by the caller, and
+    are only read at that point, so that the processing is not slowed down.
+    The RSS of the process and of its children, the elapsed time and the rate
+    of the metrics within `rate_name_list` are added to the snapshot.
+
+    Args:
+        path: output file, in Prometheus text format if it ends with `.prom`,
+              else in JSON
+        collect_func: function returning a list of `(name, value)`, `value`
+                      being a number or `(label_name, {label_value: number})`
+        interval: seconds between the snapshots
+        rate_name_list: names of the metrics whose rate per second is added
+                        as `<name>_per_second`
+        prefix: prefix of the metric names within the Prometheus format
+
+    """
+
+    def __init__(
+        self, path, collect_func, interval=30.0, rate_name_list=None, prefix="hovernet"
+    ):
+        self.path = path
+        self.collect_func = collect_func
+        self.interval = interval
+        self.rate_name_list = [] if rate_name_list is None else rate_name_list
+        self.prefix = prefix
+        self.process = psutil.Process()
+        self.start_time = time.time()
+        self.last_rate_dict = {}  # name => (time, value) of the previous snapshot
+
+        self.stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.__run_writer)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        return
+
+    def __get_rss(self):
+        rss = self.process.memory_info().rss
+        rss_children = 0
+        for child in self.process.children(recursive=True):
+            try:
+                rss_children += child.memory_info().rss
+            except psutil.Error:
+                continue  # exited meanwhile
+        return rss, rss_children
+
+    def __collect(self):
+        now = time.time()
+        metric_list = list(self.collect_func())
+        for name, value in list(metric_list):
+            if name not in self.rate_name_list:
+                continue
+            last_time, last_value = self.last_rate_dict.get(name, (self.start_time, 0))
+            self.last_rate_dict[name] = (now, value)
+            rate = (value - last_value) / max(now - last_time, 1.0e-6)
+            metric_list.append(("%s_per_second" % name, rate))
+        rss, rss_children = self.__get_rss()
+        metric_list.append(("rss_bytes", rss))
+        metric_list.append(("rss_children_bytes", rss_children))
+        metric_list.append(("elapsed_seconds", now - self.start_time))
+        metric_list.append(("timestamp_seconds", now))
+        return metric_list
+
+    def __to_prometheus(self, metric_list):
+        line_list = []
+        for name, value in metric_list:
+            name = "%s_%s" % (self.prefix, name)
+            line_list.append("# TYPE %s gauge" % name)
+            if not isinstance(value, tuple):
+                line_list.append("%s %s" % (name, float(value)))
+                continue
+            label_name, value_dict = value
+            for label_value, sub_value in value_dict.items():
+                label_value = str(label_value).replace("\\", "\\\\").replace('"', '\\"')
+                line_list.append(
+                    '%s{%s="%s"} %s' % (name, label_name, label_value, float(sub_value))
+                )
+        return "\n".join(line_list) + "\n"
+
+    def __to_json(self, metric_list):
+        metric_dict = collections.OrderedDict()
+        for name, value in metric_list:
+            if isinstance(value, tuple):
+                value = value[1]
+            metric_dict[name] = value
+        # numpy scalars are not json serializable
+        return json.dumps(metric_dict, indent=2, default=lambda v: v.item())
+
+    def write(self):
+        """Write a snapshot now."""
+        metric_list = self.__collect()
+        if self.path.endswith(".prom"):
+            content = self.__to_prometheus(metric_list)
+        else:
+            content = self.__to_json(metric_list)
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as handle:
+            handle.write(content)
+        os.replace(tmp_path, self.path)
+        return
+
+    def __run_writer(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except Exception as exception:
+                # ! the monitoring must never crash the run
+                log_info("WARNING: Failed to write the metrics: %s" % exception)
+        return
+
+    def close(self):
+        """Stop the background thread, then write the final snapshot."""
+        self.stop_event.set()
+        self.writer_thread.join()
+        self.write()
+        return
@@ -0,0 +1,124 @@
+import shutil
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+####
+def shared_memory_available(nbytes, shm_dir="/dev/shm"):
+    """Check if `nbytes` can be allocated as shared memory.
+
+    Docker and some clusters mount a small `/dev/shm`, writing beyond its size
+    will crash the process (SIGBUS) instead of raising an error, so check the
+    free space beforehand.
+
+    Args:
+        nbytes: number of bytes to allocate
+        shm_dir: mount point of the shared memory file system
+
+    """
+    if shared_memory is None:
+        return False
+    try:
+        free_bytes = shutil.disk_usage(shm_dir).free
+    except OSError:  # not mounted, let the OS decide
+        return True
+    return free_bytes > nbytes
+
+
+####
+class SharedArray(object):
+    """Numpy array view onto a named shared memory block.
+
+    Only the name, shape and dtype are pickled, so passing this object to
+    another process (e.g. torch DataLoader workers) attaches to the same
+    memory instead of copying the data. The view covers the first
+    `prod(shape)` elements of the block, so a block can hold smaller arrays.
+
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(int(v) for v in shape)
+        self.dtype = np.dtype(dtype)
+        self._shm = None
+        return
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def create(cls, shape, dtype):
+        """Allocate a zero filled block for an array, see `unlink` to release it."""
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        handle = cls(None, shape, dtype)
+        handle._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        handle.name = handle._shm.name
+        return handle
+
+    @property
+    def array(self):
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def unlink(self):
+        """Release the block, the views of `array` must be dropped beforehand."""
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # ! a view is still alive, the memory is unmapped along with it
+        self._shm.unlink()
+        self._shm = None
+        return
+
+
+####
+class SharedArrayPool(object):
+    """Fixed set of shared memory slots reused for arrays up to `max_shape`.
+
+    The pool owns the memory, call `close` to release it once all consumers
+    are done with the handles returned by `put`.
+
+    Args:
+        nr_slots: number of slots to allocate
+        max_shape: largest array shape to be stored in a slot
+        dtype: data type of the stored arrays
+
+    """
+
+    def __init__(self, nr_slots, max_shape, dtype=np.uint8):
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(max_shape)) * self.dtype.itemsize
+        self.slot_list = []
+        for _ in range(nr_slots):
+            shm = shared_memory.SharedMemory(create=True, size=self.slot_nbytes)
+            self.slot_list.append(shm)
+        return
+
+    def put(self, slot_idx, array):
+        """Copy `array` into slot `slot_idx` and return a handle to it."""
+        assert array.nbytes <= self.slot_nbytes, "Array exceeds slot size."
+        shm = self.slot_list[slot_idx]
+        handle = SharedArray(shm.name, array.shape, self.dtype)
+        view = np.ndarray(array.shape, dtype=self.dtype, buffer=shm.buf)
+        view[:] = array
+        del view  # ! release the buffer export, else close() will fail
+        return handle
+
+    def close(self):
+        for shm in self.slot_list:
+            shm.close()
+            shm.unlink()
+        self.slot_list = []
+        return
@@ -0,0 +1,137 @@
+import contextlib
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+# * state of the tracer within this process, disabled if `_trace_dir` is None
+_trace_dir = None
+_trace_file = None
+_trace_lock = threading.Lock()
+_named_thread_set = set()
+
+
+####
+def init_tracer(trace_dir, process_name="main"):
+    """Enable the tracer within this process.
+
+    Each process appends its events to its own file within `trace_dir`, call
+    this within every process to trace (e.g as the initializer of a pool),
+    then `save_trace` once all of them are done.
+
+    Args:
+        trace_dir: directory shared by the traced processes
+        process_name: name of this process within the trace viewer
+
+    """
+    global _trace_dir, _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _named_thread_set.clear()
+        trace_name = "%s_%d.jsonl" % (socket.gethostname(), os.getpid())
+        # line buffered, so that events are kept if the process is killed
+        _trace_file = open("%s/%s" % (trace_dir, trace_name), "a", buffering=1)
+        _trace_dir = trace_dir
+        _write_event(
+            {"name": "process_name", "ph": "M", "args": {"name": process_name}}
+        )
+    return
+
+
+####
+def get_trace_dir():
+    """Directory of the tracer within this process, `None` if disabled."""
+    return _trace_dir
+
+
+####
+def _write_event(event):
+    """Write an event of the calling thread, `_trace_lock` must be held."""
+    event["pid"] = os.getpid()
+    event["tid"] = threading.get_ident()
+    if event["tid"] not in _named_thread_set:
+        _named_thread_set.add(event["tid"])
+        thread_event = {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": event["pid"],
+            "tid": event["tid"],
+            "args": {"name": threading.current_thread().name},
+        }
+        _trace_file.write(json.dumps(thread_event) + "\n")
+    _trace_file.write(json.dumps(event) + "\n")
+    return
+
+
+####
+@contextlib.contextmanager
+def trace_span(name, cat="wsi", **args):
+    """Record the duration of the enclosed block as a span, if the tracer is enabled.
+
+    Args:
+        name: name of the span
+        cat: category of the span, to filter spans within the trace viewer
+        args: json serializable values shown along with the span
+
+    """
+    if _trace_dir is None:
+        yield
+        return
+    # * perf_counter is monotonic and system wide, so comparable across processes
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start * 1.0e6,
+            "dur": (end - start) * 1.0e6,
+            "args": args,
+        }
+        with _trace_lock:
+            if _trace_file is not None:
+                _write_event(event)
+    return
+
+
+####
+def close_tracer():
+    """Disable the tracer within this process."""
+    global _trace_dir, _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_dir, _trace_file = None, None
+    return
+
+
+####
+def save_trace(trace_dir, output_path):
+    """Merge the events of all traced processes into a trace-event JSON file.
+
+    The output can be loaded in `chrome://tracing` or https://ui.perfetto.dev.
+
+    Args:
+        trace_dir: directory given to `init_tracer`, the processes writing
+                   into it must be done or have called `close_tracer`
+        output_path: path of the JSON file to write
+
+    """
+    event_list = []
+    for trace_path in sorted(glob.glob("%s/*.jsonl" % trace_dir)):
+        with open(trace_path, "r") as handle:
+            for line in handle:
+                # ! the last line may be truncated if the process was killed
+                try:
+                    event_list.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    with open(output_path, "w") as handle:
+        json.dump({"traceEvents": event_list, "displayTimeUnit": "ms"}, handle)
+    return
@@ -0,0 +1,183 @@
+import collections
+import os
+import socket
+import threading
+import time
+import uuid
+
+from misc.utils import log_info
+
+
+####
+class SlideClaimer(object):
+    """Claim slides via lock files within a directory shared by several nodes.
+
+    A slide is claimed by atomically creating `<lock_dir>/<name>.lock` with
+    `O_CREAT | O_EXCL` (also atomic on NFSv3 and later), the file holds the
+    token of the claimer. Held locks are touched every `heartbeat_interval`
+    seconds by a background thread. A lock that has not been touched for
+    `stale_timeout` seconds is deemed left by a dead node and is broken, so
+    that the slide can be claimed again.
+
+    Args:
+        lock_dir: directory shared by all nodes
+        stale_timeout: seconds without heartbeat after which a lock is broken,
+                       must be well above `heartbeat_interval` and the clock
+                       skew between the nodes
+        heartbeat_interval: seconds between the touches of the held locks,
+                            `stale_timeout / 10` if `None`
+
+    """
+
+    def __init__(self, lock_dir, stale_timeout=600.0, heartbeat_interval=None):
+        self.lock_dir = lock_dir
+        self.stale_timeout = stale_timeout
+        if heartbeat_interval is None:
+            heartbeat_interval = stale_timeout / 10.0
+        self.heartbeat_interval = heartbeat_interval
+        self.token = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        os.makedirs(lock_dir, exist_ok=True)
+
+        self.held_dict = {}  # name => lock path
+        self.held_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.__run_heartbeat)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+        return
+
+    def __get_lock_path(self, name):
+        return "%s/%s.lock" % (self.lock_dir, name)
+
+    def __read_token(self, lock_path):
+        try:
+            with open(lock_path, "r") as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return None
+
+    def __is_stale(self, lock_path):
+        try:
+            lock_stat = os.stat(lock_path)
+        except FileNotFoundError:
+            return False
+        return time.time() - lock_stat.st_mtime > self.stale_timeout
+
+    def __break_lock(self, lock_path):
+        """Remove a stale lock, guarded by a lock on the breaking itself.
+
+        Without the guard, a node could remove the lock freshly created by
+        another node that has just broken the same stale lock.
+        """
+        break_path = "%s.break" % lock_path
+        try:
+            break_fd = os.open(break_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # ! the node breaking the lock may have died midway
+            if self.__is_stale(break_path):
+                try:
+                    os.remove(break_path)
+                except FileNotFoundError:
+                    pass
+            return
+        try:
+            if self.__is_stale(lock_path):
+                log_info("Break stale lock: %s" % lock_path)
+                os.remove(lock_path)
+        finally:
+            os.close(break_fd)
+            os.remove(break_path)
+        return
+
+    def __run_heartbeat(self):
+        while not self.stop_event.wait(self.heartbeat_interval):
+            with self.held_lock:
+                held_list = list(self.held_dict.items())
+            for name, lock_path in held_list:
+                if self.__read_token(lock_path) != self.token:
+                    log_info("WARNING: Lost the claim of %s!" % name)
+                    with self.held_lock:
+                        self.held_dict.pop(name, None)
+                    continue
+                try:
+                    os.utime(lock_path, None)
+                except FileNotFoundError:
+                    pass  # released meanwhile
+        return
+
+    def claim(self, name):
+        """Try to claim a slide, return `True` if the slide is now held."""
+        lock_path = self.__get_lock_path(name)
+        for _ in range(2):  # once more after breaking a stale lock
+            try:
+                lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.__is_stale(lock_path):
+                    return False
+                self.__break_lock(lock_path)
+                continue
+            with os.fdopen(lock_fd, "w") as handle:
+                handle.write(self.token)
+            with self.held_lock:
+                self.held_dict[name] = lock_path
+            return True
+        return False
+
+    def claim_iter(self, name_list, is_done, poll_interval=5.0):
+        """Claim the slides that are not done yet, one after another.
+
+        Slides held by other nodes are revisited until they are done, as their
+        claim turns stale if the node holding them dies midway. Each slide is
+        yielded at most once and must be released by the caller once processed,
+        whether it succeeded or not.
+
+        Args:
+            name_list: names of the slides, in processing order
+            is_done: function telling whether the output of a slide exists
+            poll_interval: seconds to wait when all remaining slides are held
+                           by other nodes
+
+        """
+        name_queue = collections.deque(name_list)
+        held_by_others_set = set()
+        nr_held_by_others = 0  # consecutive failed claims
+        while len(name_queue) > 0:
+            if nr_held_by_others >= len(name_queue):
+                time.sleep(poll_interval)  # only held by others
+                nr_held_by_others = 0
+            name = name_queue.popleft()
+            if is_done(name):
+                continue
+            if not self.claim(name):
+                if name not in held_by_others_set:
+                    log_info("Claimed by another node: %s" % name)
+                    held_by_others_set.add(name)
+                name_queue.append(name)
+                nr_held_by_others += 1
+                continue
+            nr_held_by_others = 0
+            # another node may have finished the slide since the check above
+            if is_done(name):
+                self.release(name)
+                continue
+            yield name
+        return
+
+    def release(self, name):
+        """Release a held slide, so that it may be claimed again if not done."""
+        with self.held_lock:
+            lock_path = self.held_dict.pop(name, None)
+        if lock_path is None:
+            return
+        if self.__read_token(lock_path) == self.token:
+            os.remove(lock_path)
+        return
+
+    def close(self):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        with self.held_lock:
+            name_list = list(self.held_dict.keys())
+        for name in name_list:
+            self.release(name)
+        return
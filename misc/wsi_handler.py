@@ -1,12 +1,26 @@
 from collections import OrderedDict
+from fractions import Fraction
 import cv2
 import numpy as np
 from skimage import img_as_ubyte
 from skimage import color
 import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import openslide
+try:
+    import openslide
+except ImportError:  # only needed to read actual slides
+    openslide = None
+
+# smaller regions are not worth splitting across the reading threads
+_MIN_SPLIT_NR_PIXELS = 2 ** 20
+# * regions are rescaled from a window of the level read with a margin beyond
+# * the support of the bicubic kernel, starting where the output and source
+# * pixels align for scales of at most that denominator
+_RESCALE_MARGIN = 4
+_RESCALE_MAX_DENOMINATOR = 64
 
 
 class FileHandler(object):
@@ -21,17 +35,45 @@ class FileHandler(object):
             ("mpp  ", None),
             ("base_shape", None),
         }
-        pass
+        # set by `prepare_reading`
+        self.read_lv = None
+        self.scale_factor = None
 
     def __load_metadata(self):
         raise NotImplementedError
 
+    def _get_level_dimensions(self, read_lv):
+        """Shape of the level `read_lv`, in X, Y."""
+        raise NotImplementedError
+
+    def _read_level_region(self, coords, size, read_lv):
+        """Read a region of the level `read_lv`, `coords` and `size` in X, Y wrt it.
+
+        Out of the level is read as 0.
+        """
+        raise NotImplementedError
+
     def get_full_img(self, read_mag=None, read_mpp=None):
         """Only use `read_mag` or `read_mpp`, not both, prioritize `read_mpp`.
 
         `read_mpp` is in X, Y format
         """
-        raise NotImplementedError
+        read_lv, scale_factor = self._get_read_info(
+            read_mag=read_mag, read_mpp=read_mpp
+        )
+
+        read_size = self._get_level_dimensions(read_lv)
+        wsi_img = self._read_level_region((0, 0), read_size, read_lv)
+        if scale_factor is not None:
+            # now rescale then return
+            if scale_factor > 1.0:
+                interp = cv2.INTER_CUBIC
+            else:
+                interp = cv2.INTER_LINEAR
+            wsi_img = cv2.resize(
+                wsi_img, (0, 0), fx=scale_factor, fy=scale_factor, interpolation=interp
+            )
+        return wsi_img
 
     def read_region(self, coords, size):
         """Must call `prepare_reading` before hand.
@@ -45,7 +87,72 @@ class FileHandler(object):
                           `read_mag` or `read_mpp` from `prepare_reading`       
 
         """
-        raise NotImplementedError
+        if self.scale_factor is None:
+            return self._read_level_region(coords, size, self.read_lv)
+        return self.__read_rescaled_region(coords, size)
+
+    def __read_rescaled_region(self, coords, size):
+        """Read a region of the level `read_lv` rescaled by `scale_factor`.
+
+        Only the window of the level covering the region, plus a margin for the
+        interpolation, is read then resized, as `get_full_img` resizes the whole
+        level. Out of the rescaled level is read as 0.
+        """
+        scale_factor = self.scale_factor
+        interp = cv2.INTER_CUBIC if scale_factor > 1.0 else cv2.INTER_LINEAR
+        level_shape = np.array(self._get_level_dimensions(self.read_lv))
+        # as `cv2.resize` rounds the shape of its output
+        rescaled_shape = np.rint(level_shape * scale_factor).astype(np.int64)
+
+        coords, size = np.array(coords, dtype=np.int64), np.array(size, dtype=np.int64)
+        region = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        tl = np.maximum(coords, 0)
+        br = np.minimum(coords + size, rescaled_shape)
+        if np.any(br <= tl):
+            return region
+
+        margin = _RESCALE_MARGIN  # source pixels
+        ratio = Fraction(scale_factor).limit_denominator(_RESCALE_MAX_DENOMINATOR)
+        if float(ratio) == scale_factor:
+            # * start the window where the output and source pixels align, so
+            # * that resizing the window gives the pixels of the whole level
+            step_dst, step_src = ratio.numerator, ratio.denominator
+            nr_steps = -(-margin // step_src)
+            window_tl = np.maximum((tl // step_dst - nr_steps) * step_dst, 0)
+            src_tl = window_tl // step_dst * step_src
+            src_br = np.ceil(br / scale_factor).astype(np.int64) + margin
+            src_br = np.minimum(src_br, level_shape)
+            src = self._read_level_region(src_tl, src_br - src_tl, self.read_lv)
+            window = cv2.resize(
+                src, (0, 0), fx=scale_factor, fy=scale_factor, interpolation=interp
+            )
+            window = window[
+                tl[1] - window_tl[1] : br[1] - window_tl[1],
+                tl[0] - window_tl[0] : br[0] - window_tl[0],
+            ]
+        else:
+            # ! the sub-pixel positions are quantized by `cv2.warpAffine`, so
+            # ! the pixels may be off by a few intensities wrt `get_full_img`
+            src_tl = np.floor(tl / scale_factor).astype(np.int64) - margin
+            src_tl = np.maximum(src_tl, 0)
+            src_br = np.ceil(br / scale_factor).astype(np.int64) + margin
+            src_br = np.minimum(src_br, level_shape)
+            src = self._read_level_region(src_tl, src_br - src_tl, self.read_lv)
+            # output pixel x is at (x + 0.5) / scale_factor - 0.5 within the level
+            offset = (tl + 0.5) / scale_factor - 0.5 - src_tl
+            matrix = np.array(
+                [[1.0 / scale_factor, 0, offset[0]], [0, 1.0 / scale_factor, offset[1]]]
+            )
+            window = cv2.warpAffine(
+                src,
+                matrix,
+                tuple(int(v) for v in br - tl),
+                flags=interp | cv2.WARP_INVERSE_MAP,
+                borderMode=cv2.BORDER_REPLICATE,
+            )
+        dst_tl, dst_br = tl - coords, br - coords
+        region[dst_tl[1] : dst_br[1], dst_tl[0] : dst_br[0]] = window
+        return region
 
     def get_dimensions(self, read_mag=None, read_mpp=None):
         """Will be in X, Y."""
@@ -56,21 +163,19 @@ class FileHandler(object):
         # may off some pixels wrt existing mag
         return (self.metadata["base_shape"] * scale).astype(np.int32)
 
-    def prepare_reading(self, read_mag=None, read_mpp=None, cache_path=None):
+    def close(self):
+        """Release what is only needed to read regions, e.g threads."""
+        return
+
+    def prepare_reading(self, read_mag=None, read_mpp=None):
         """Only use `read_mag` or `read_mpp`, not both, prioritize `read_mpp`.
 
-        `read_mpp` is in X, Y format.
+        `read_mpp` is in X, Y format. When it is not the magnification of a
+        level, each region is read from the level above then rescaled.
         """
-        read_lv, scale_factor = self._get_read_info(
+        self.read_lv, self.scale_factor = self._get_read_info(
             read_mag=read_mag, read_mpp=read_mpp
         )
-
-        if scale_factor is None:
-            self.image_ptr = None
-            self.read_lv = read_lv
-        else:
-            np.save(cache_path, self.get_full_img(read_mag=read_mag))
-            self.image_ptr = np.load(cache_path, mmap_mode="r")
         return
 
     def _get_read_info(self, read_mag=None, read_mpp=None):
@@ -99,18 +204,99 @@ class FileHandler(object):
         return hires_lv, scale_factor
 
 
+class TileCache(object):
+    """LRU cache of decoded tiles within a budget of bytes, safe across threads.
+
+    Args:
+        max_nbytes: budget of the cache, disabled if 0
+
+    """
+
+    def __init__(self, max_nbytes):
+        self.max_nbytes = max_nbytes
+        self.tile_dict = OrderedDict()  # key => tile, least recently used first
+        self.nbytes = 0
+        self.nr_hits = 0
+        self.nr_misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Get the tile of `key`, `None` if not cached."""
+        with self.lock:
+            tile = self.tile_dict.get(key)
+            if tile is None:
+                self.nr_misses += 1
+                return None
+            self.nr_hits += 1
+            self.tile_dict.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        """Cache `tile`, evicting the least recently used tiles beyond the budget."""
+        if tile.nbytes > self.max_nbytes:
+            return
+        with self.lock:
+            if key in self.tile_dict:  # read meanwhile by another thread
+                return
+            self.tile_dict[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_nbytes:
+                _, old_tile = self.tile_dict.popitem(last=False)
+                self.nbytes -= old_tile.nbytes
+        return
+
+
 class OpenSlideHandler(FileHandler):
     """Class for handling OpenSlide supported whole-slide images."""
 
-    def __init__(self, file_path):
-        """file_path (string): path to single whole-slide image."""
+    def __init__(
+        self, file_path, tile_cache_size=0, nr_read_threads=1, tile_cache_margin=None
+    ):
+        """Init.
+
+        Args:
+            file_path (string): path to single whole-slide image
+            tile_cache_size: budget in MB of the cache of decoded tiles shared
+                             by the reads at the levels of the slide, disabled
+                             if 0, 'auto' to size it from `tile_cache_margin`
+                             in `prepare_reading`
+            nr_read_threads: number of threads decoding the stripes of a large
+                             region at once, each with its own OpenSlide object
+            tile_cache_margin: if given, only the tiles within this many pixels
+                               (at the read magnification) of the right or
+                               bottom border of a region are cached, i.e those
+                               read again by the next overlapping regions
+
+        """
         super().__init__()
+        assert openslide is not None, "OpenSlide is required to read `%s`" % file_path
+        self.file_path = file_path
         self.file_ptr = openslide.OpenSlide(file_path)  # load OpenSlide object
         self.metadata = self.__load_metadata()
 
-        # only used for cases where the read magnification is different from
-        self.image_ptr = None  # the existing modes of the read file
-        self.read_level = None
+        self.nr_read_threads = nr_read_threads
+        self.read_pool = None  # created by the first region to split
+        self.thread_local = threading.local()
+        self.thread_file_ptr_list = []  # OpenSlide objects of the read threads
+        self.thread_file_ptr_lock = threading.Lock()
+
+        # * adjacent chunks overlap, so their common tiles are decoded once,
+        # * using the native tile grid of each level
+        assert tile_cache_size != "auto" or tile_cache_margin is not None
+        self.tile_cache_size = tile_cache_size
+        self.tile_cache_margin = tile_cache_margin
+        self.level_cache_margin = None  # wrt `read_lv`, set by `prepare_reading`
+        max_nbytes = 0 if tile_cache_size == "auto" else tile_cache_size * 2 ** 20
+        self.tile_cache = TileCache(int(max_nbytes))
+        self.tile_size_list = []
+        for level in range(self.file_ptr.level_count):
+            tile_size = [
+                self.file_ptr.properties.get("openslide.level[%d].tile-%s" % (level, v))
+                for v in ["width", "height"]
+            ]
+            # unknown for some formats, any grid is then as good
+            tile_size = [256, 256] if None in tile_size else tile_size
+            self.tile_size_list.append(np.array(tile_size, dtype=np.int64))
 
     def __load_metadata(self):
         metadata = {}
@@ -137,60 +323,167 @@ class OpenSlideHandler(FileHandler):
         ]
         return OrderedDict(metadata)
 
-    def read_region(self, coords, size):
-        """Must call `prepare_reading` before hand.
-
-        Args:
-            coords (tuple): (dims_x, dims_y), 
-                          top left coordinates of image region at selected 
-                          `read_mag` or `read_mpp` from `prepare_reading` 
-            size (tuple): (dims_x, dims_y)
-                          width and height of image region at selected 
-                          `read_mag` or `read_mpp` from `prepare_reading`       
+    def _get_level_dimensions(self, read_lv):
+        return self.file_ptr.level_dimensions[read_lv]
+
+    def prepare_reading(self, read_mag=None, read_mpp=None):
+        super().prepare_reading(read_mag=read_mag, read_mpp=read_mpp)
+        if self.tile_cache_margin is None:
+            return
+        margin = self.tile_cache_margin
+        if self.scale_factor is not None:
+            # the windows read to rescale the regions overlap further
+            margin = int(np.ceil(margin / self.scale_factor))
+            margin += 2 * (_RESCALE_MARGIN + _RESCALE_MAX_DENOMINATOR)
+        self.level_cache_margin = margin
+        if self.tile_cache_size == "auto":
+            # * the margin tiles of the regions read along a row or a column
+            # * of the slide, and those of the region next to it
+            tile_size = self.tile_size_list[self.read_lv]
+            level_shape = np.array(self._get_level_dimensions(self.read_lv))
+            strip_width = margin + 2 * np.max(tile_size)
+            self.tile_cache.max_nbytes = int(strip_width * np.sum(level_shape) * 3)
+        return
 
+    def __get_level_0_coords(self, file_ptr, coords, read_lv):
+        """Convert the coordinates (X, Y) wrt `read_lv` to the level 0."""
+        lv_0_shape = np.array(file_ptr.level_dimensions[0])
+        lv_r_shape = np.array(file_ptr.level_dimensions[read_lv])
+        up_sample = (lv_0_shape / lv_r_shape)[0]
+        return [int(coords[0] * up_sample), int(coords[1] * up_sample)]
+
+    def __get_thread_file_ptr(self):
+        """OpenSlide object of the calling read thread, opened on its first read."""
+        file_ptr = getattr(self.thread_local, "file_ptr", None)
+        if file_ptr is None:
+            file_ptr = openslide.OpenSlide(self.file_path)
+            self.thread_local.file_ptr = file_ptr
+            with self.thread_file_ptr_lock:
+                self.thread_file_ptr_list.append(file_ptr)
+        return file_ptr
+
+    def _read_level_region(self, coords, size, read_lv):
+        coords = np.array(coords, dtype=np.int64)
+        size = np.array(size, dtype=np.int64)
+        # tiles reaching beyond `cache_tl` are cached
+        cache_tl = coords
+        if self.level_cache_margin is not None:
+            cache_tl = coords + size - self.level_cache_margin
+        # * OpenSlide decodes a region within a single thread, so large regions
+        # * are split into stripes of whole tile rows decoded concurrently
+        tile_height = self.tile_size_list[read_lv][1]
+        first_row = coords[1] // tile_height
+        nr_rows = (coords[1] + size[1] - 1) // tile_height - first_row + 1
+        nr_stripes = min(self.nr_read_threads, nr_rows)
+        if nr_stripes <= 1 or size[0] * size[1] < _MIN_SPLIT_NR_PIXELS:
+            return self.__read_stripe(self.file_ptr, coords, size, read_lv, cache_tl)
+
+        nr_rows_per_stripe = -(-nr_rows // nr_stripes)
+        bound_list = [coords[1]]
+        for stripe_idx in range(1, nr_stripes):
+            bound = (first_row + stripe_idx * nr_rows_per_stripe) * tile_height
+            if bound < coords[1] + size[1]:
+                bound_list.append(bound)
+        bound_list.append(coords[1] + size[1])
+
+        region = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+
+        def read_stripe(start_y, end_y):
+            stripe = self.__read_stripe(
+                self.__get_thread_file_ptr(),
+                (coords[0], start_y),
+                (size[0], end_y - start_y),
+                read_lv,
+                cache_tl,
+            )
+            region[start_y - coords[1] : end_y - coords[1]] = stripe
+            return
+
+        if self.read_pool is None:
+            self.read_pool = ThreadPoolExecutor(self.nr_read_threads)
+        future_list = [
+            self.read_pool.submit(read_stripe, start_y, end_y)
+            for start_y, end_y in zip(bound_list[:-1], bound_list[1:])
+        ]
+        for future in future_list:
+            future.result()
+        return region
+
+    def __read_stripe(self, file_ptr, coords, size, read_lv, cache_tl):
+        """Read a region with `file_ptr`, `coords` and `size` are wrt `read_lv`."""
+        if self.tile_cache.max_nbytes > 0:
+            return self.__read_cached_region(file_ptr, coords, size, read_lv, cache_tl)
+        new_coord = self.__get_level_0_coords(file_ptr, coords, read_lv)
+        size = (int(size[0]), int(size[1]))
+        region = file_ptr.read_region(new_coord, read_lv, size)
+        return np.array(region)[..., :3]  # remove alpha channel
+
+    def __read_cached_region(self, file_ptr, coords, size, read_lv, cache_tl):
+        """Read a region via the tile cache, `coords` and `size` are wrt `read_lv`.
+
+        Only the tiles reaching beyond `cache_tl` (X, Y) are cached.
         """
-        if self.image_ptr is None:
-            # convert coord from read lv to lv zero
-            lv_0_shape = np.array(self.file_ptr.level_dimensions[0])
-            lv_r_shape = np.array(self.file_ptr.level_dimensions[self.read_lv])
-            up_sample = (lv_0_shape / lv_r_shape)[0]
-            new_coord = [0, 0]
-            new_coord[0] = int(coords[0] * up_sample)
-            new_coord[1] = int(coords[1] * up_sample)
-            region = self.file_ptr.read_region(new_coord, self.read_lv, size)
-        else:
-            region = self.image_ptr[
-                coords[1] : coords[1] + size[1], coords[0] : coords[0] + size[0]
+        tile_size = self.tile_size_list[read_lv]
+        coords, size = np.array(coords, dtype=np.int64), np.array(size, dtype=np.int64)
+        tile_tl = coords // tile_size
+        tile_br = (coords + size - 1) // tile_size + 1
+
+        region = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        for tile_y in range(tile_tl[1], tile_br[1]):
+            tile_list = [
+                self.tile_cache.get((read_lv, tile_x, tile_y))
+                for tile_x in range(tile_tl[0], tile_br[0])
             ]
-        return np.array(region)[..., :3]
-
-    def get_full_img(self, read_mag=None, read_mpp=None):
-        """Only use `read_mag` or `read_mpp`, not both, prioritize `read_mpp`.
-
-        `read_mpp` is in X, Y format.
-        """
-
-        read_lv, scale_factor = self._get_read_info(
-            read_mag=read_mag, read_mpp=read_mpp
-        )
-
-        read_size = self.file_ptr.level_dimensions[read_lv]
-
-        wsi_img = self.file_ptr.read_region((0, 0), read_lv, read_size)
-        wsi_img = np.array(wsi_img)[..., :3]  # remove alpha channel
-        if scale_factor is not None:
-            # now rescale then return
-            if scale_factor > 1.0:
-                interp = cv2.INTER_CUBIC
-            else:
-                interp = cv2.INTER_LINEAR
-            wsi_img = cv2.resize(
-                wsi_img, (0, 0), fx=scale_factor, fy=scale_factor, interpolation=interp
-            )
-        return wsi_img
+            # * each run of missing tiles in the row is read at once
+            tile_idx = 0
+            while tile_idx < len(tile_list):
+                if tile_list[tile_idx] is not None:
+                    tile_idx += 1
+                    continue
+                run_end = tile_idx
+                while run_end < len(tile_list) and tile_list[run_end] is None:
+                    run_end += 1
+                run_tl = np.array([tile_tl[0] + tile_idx, tile_y]) * tile_size
+                run_size = ((run_end - tile_idx) * tile_size[0], tile_size[1])
+                run_lv0_tl = self.__get_level_0_coords(file_ptr, run_tl, read_lv)
+                run = file_ptr.read_region(run_lv0_tl, read_lv, run_size)
+                run = np.array(run)[..., :3]
+                for run_idx in range(tile_idx, run_end):
+                    offset = (run_idx - tile_idx) * tile_size[0]
+                    tile = run[:, offset : offset + tile_size[0]]
+                    tile_list[run_idx] = tile
+                    tile_key = (read_lv, tile_tl[0] + run_idx, tile_y)
+                    tile_end = (np.array(tile_key[1:]) + 1) * tile_size
+                    if np.any(tile_end > cache_tl):
+                        self.tile_cache.put(tile_key, tile.copy())
+                tile_idx = run_end
+
+            for tile_x, tile in zip(range(tile_tl[0], tile_br[0]), tile_list):
+                tile_coords = np.array([tile_x, tile_y]) * tile_size
+                src_tl = np.maximum(coords - tile_coords, 0)
+                src_br = np.minimum(coords + size - tile_coords, tile_size)
+                dst_tl = tile_coords + src_tl - coords
+                dst_br = tile_coords + src_br - coords
+                region[dst_tl[1] : dst_br[1], dst_tl[0] : dst_br[0]] = tile[
+                    src_tl[1] : src_br[1], src_tl[0] : src_br[0]
+                ]
+        return region
+
+    def close(self):
+        """Stop the read threads and close their OpenSlide objects."""
+        if self.read_pool is not None:
+            self.read_pool.shutdown()
+            self.read_pool = None
+        with self.thread_file_ptr_lock:
+            for file_ptr in self.thread_file_ptr_list:
+                file_ptr.close()
+            self.thread_file_ptr_list = []
+        return
 
 
-def get_file_handler(path, backend):
+def get_file_handler(
+    path, backend, tile_cache_size=0, nr_read_threads=1, tile_cache_margin=None
+):
     if backend in [
             '.svs', '.tif', 
             '.vms', '.vmu', '.ndpi',
@@ -198,7 +491,12 @@ def get_file_handler(path, backend):
             '.svslide',
             '.bif',
             ]:
-        return OpenSlideHandler(path)
+        return OpenSlideHandler(
+            path,
+            tile_cache_size=tile_cache_size,
+            nr_read_threads=nr_read_threads,
+            tile_cache_margin=tile_cache_margin,
+        )
     else:
         assert False, "Unknown WSI format `%s`" % backend
 
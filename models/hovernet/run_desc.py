@@ -168,12 +168,12 @@ def valid_step(batch_data, run_info):
 
 
 ####
-def infer_step(batch_data, model):
+def infer_step(batch_data, model, device="cuda"):
 
     ####
     patch_imgs = batch_data
 
-    patch_imgs_gpu = patch_imgs.to("cuda").type(torch.float32)  # to NCHW
+    patch_imgs_gpu = patch_imgs.to(device).type(torch.float32)  # to NCHW
     patch_imgs_gpu = patch_imgs_gpu.permute(0, 3, 1, 2).contiguous()
 
     ####
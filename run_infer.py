@@ -33,7 +33,8 @@ Arguments for processing tiles.
 
 usage:
     tile (--input_dir=<path>) (--output_dir=<path>) \
-         [--draw_dot] [--save_qupath] [--save_raw_map] [--mem_usage=<n>]
+         [--draw_dot] [--save_qupath] [--save_raw_map] [--mem_usage=<n>] \
+         [--metrics_interval=<n>] [--metrics_format=<fmt>]
     
 options:
    --input_dir=<path>     Path to input data directory. Assumes the files are not nested within directory.
@@ -45,6 +46,9 @@ options:
    --draw_dot             To draw nuclei centroid on overlay. [default: False]
    --save_qupath          To optionally output QuPath v0.2.3 compatible format. [default: False]
    --save_raw_map         To save raw prediction or not. [default: False]
+   --metrics_interval=<n> Seconds between the snapshots of the progress written into `output_dir`
+                          (`metrics.json` or `metrics.prom`), disabled if 0. [default: 0]
+   --metrics_format=<fmt> Format of the progress snapshots, 'json' or 'prometheus' (text format). [default: json]
 """
 
 wsi_cli = """
@@ -54,7 +58,11 @@ usage:
     wsi (--input_dir=<path>) (--output_dir=<path>) [--proc_mag=<n>]\
         [--cache_path=<path>] [--input_mask_dir=<path>] \
         [--ambiguous_size=<n>] [--chunk_shape=<n>] [--tile_shape=<n>] \
-        [--save_thumb] [--save_mask]
+        [--chunk_prefetch=<n>] [--chunk_transport=<mode>] [--mem_usage=<n>] \
+        [--tile_cache_size=<n>] [--nr_read_threads=<n>] \
+        [--pred_map_dtype=<dtype>] [--sparse_cache] [--cache_mode=<mode>] [--save_thumb] [--save_mask] [--save_binary] \
+        [--resume] [--nr_slides_in_flight=<n>] [--claim_slides] [--claim_timeout=<n>] \
+        [--trace_path=<path>] [--metrics_interval=<n>] [--metrics_format=<fmt>]
     
 options:
     --input_dir=<path>      Path to input data directory. Assumes the files are not nested within directory.
@@ -65,10 +73,43 @@ options:
 
     --proc_mag=<n>          Magnification level (objective power) used for WSI processing. [default: 40]
     --ambiguous_size=<int>  Define ambiguous region along tiling grid to perform re-post processing. [default: 128]
-    --chunk_shape=<n>       Shape of chunk for processing. [default: 10000]
-    --tile_shape=<n>        Shape of tiles for processing. [default: 2048]
+    --chunk_shape=<n>       Shape of chunk for processing, 'auto' to plan it wrt `mem_usage`. [default: 10000]
+    --tile_shape=<n>        Shape of tiles for processing, 'auto' to plan it wrt `mem_usage`. [default: 2048]
+    --mem_usage=<n>         Fraction of the available memory the chunks and the post processing tiles
+                            may use when their shape is 'auto', and the cache when its mode is 'auto'. [default: 0.5]
+    --chunk_prefetch=<n>    Number of chunks to read ahead while a chunk is being inferred. [default: 1]
+    --tile_cache_size=<n>   Budget in MB of the cache of the decoded tiles of the slide, so that the tiles
+                            shared by adjacent chunks are decoded once, 0 to disable, 'auto' to fit
+                            the overlaps of the chunks along a row and a column of the slide. [default: auto]
+    --nr_read_threads=<n>   Number of threads decoding the stripes of each chunk of the slide at once. [default: 4]
+    --chunk_transport=<mode>  Pass chunks to inference workers via shared memory 'shm', 
+                            or via files within `cache_path` 'file'. [default: shm]
+    --pred_map_dtype=<dtype>  Data type to store the raw prediction of the wsi within the cache,
+                            'float32', 'float16' or 'uint8' (scaled). [default: float32]
+    --sparse_cache          To only allocate the cache of the predictions where there is tissue,
+                            as blocks within a single file. [default: False]
+    --cache_mode=<mode>     Keep the cache of the predictions within shared memory 'ram', within memory-mapped
+                            files in `cache_path` 'mmap', or in 'ram' when it fits within `mem_usage` 'auto'.
+                            'ram' can not be used along with `resume` or `sparse_cache`, with which
+                            'auto' falls back to 'mmap'. [default: mmap]
     --save_thumb            To save thumb. [default: False]
     --save_mask             To save mask. [default: False]
+    --save_binary           To also save the nuclei in memory-mappable binary format 
+                            (`.nuc` directory along with the json). [default: False]
+    --resume                To journal the progress within `cache_path` and resume the slide
+                            being processed when a run dies midway. [default: False]
+    --nr_slides_in_flight=<n>  Number of slides processed at once, the post processing and saving
+                            of a slide overlap the inference of the next one if > 1. Each slide
+                            in flight holds its own directory within `cache_path`. [default: 1]
+    --claim_slides          To claim each slide via a lock file within `output_dir` before processing it,
+                            so that several nodes may process the same `input_dir`. [default: False]
+    --claim_timeout=<n>     Seconds without heartbeat after which the claim of a node is deemed stale
+                            and the slide is claimed again by another node. [default: 600]
+    --trace_path=<path>     If given, record the timeline of the reading, inference, post processing and
+                            saving across all processes, as a trace-event JSON file (e.g for ui.perfetto.dev).
+    --metrics_interval=<n>  Seconds between the snapshots of the progress written into `output_dir`
+                            (`metrics.json` or `metrics.prom`), disabled if 0. [default: 0]
+    --metrics_format=<fmt>  Format of the progress snapshots, 'json' or 'prometheus' (text format). [default: json]
 """
 
 import torch
@@ -158,9 +199,13 @@ if __name__ == '__main__':
             'draw_dot'    : sub_args['draw_dot'],
             'save_qupath' : sub_args['save_qupath'],
             'save_raw_map': sub_args['save_raw_map'],
+            'metrics_interval' : float(sub_args['metrics_interval']),
+            'metrics_format' : sub_args['metrics_format'],
         })
 
     if sub_cmd == 'wsi':
+        to_shape = lambda x: x if x == 'auto' else int(x)
+        to_size = lambda x: x if x == 'auto' else float(x)
         run_args.update({
             'input_dir'      : sub_args['input_dir'],
             'output_dir'     : sub_args['output_dir'],
@@ -169,10 +214,26 @@ if __name__ == '__main__':
 
             'proc_mag'       : int(sub_args['proc_mag']),
             'ambiguous_size' : int(sub_args['ambiguous_size']),
-            'chunk_shape'    : int(sub_args['chunk_shape']),
-            'tile_shape'     : int(sub_args['tile_shape']),
+            'chunk_shape'    : to_shape(sub_args['chunk_shape']),
+            'tile_shape'     : to_shape(sub_args['tile_shape']),
+            'mem_usage'      : float(sub_args['mem_usage']),
+            'chunk_prefetch' : int(sub_args['chunk_prefetch']),
+            'tile_cache_size': to_size(sub_args['tile_cache_size']),
+            'nr_read_threads': int(sub_args['nr_read_threads']),
+            'chunk_transport': sub_args['chunk_transport'],
+            'pred_map_dtype' : sub_args['pred_map_dtype'],
+            'sparse_cache'   : sub_args['sparse_cache'],
+            'cache_mode'     : sub_args['cache_mode'],
             'save_thumb'     : sub_args['save_thumb'],
             'save_mask'      : sub_args['save_mask'],
+            'save_binary'    : sub_args['save_binary'],
+            'resume'         : sub_args['resume'],
+            'nr_slides_in_flight' : int(sub_args['nr_slides_in_flight']),
+            'claim_slides'   : sub_args['claim_slides'],
+            'claim_timeout'  : int(sub_args['claim_timeout']),
+            'trace_path'     : sub_args['trace_path'],
+            'metrics_interval' : float(sub_args['metrics_interval']),
+            'metrics_format' : sub_args['metrics_format'],
         })
     # ***
     